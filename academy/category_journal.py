@@ -1,21 +1,42 @@
 from dotenv import load_dotenv, find_dotenv
+import argparse
 import asyncio
 import json
-from tqdm import tqdm
-from tqdm.asyncio import tqdm_asyncio
-from tenacity import retry, stop_after_attempt, wait_fixed
+import openai
+from tenacity import retry, retry_if_not_exception_type, stop_after_attempt, wait_fixed
 import os
+import sys
 import logging
+import math
+import time
+from datetime import datetime, timezone
 
 load_dotenv(find_dotenv())
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pyarrow as pa
 from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_core.prompts import PromptTemplate
+from langchain_core.callbacks import get_usage_metadata_callback
 from langchain_openai import ChatOpenAI
 
+from batch_runner import BatchRunner, JsonlJob
+from journal_index import JournalIndex
+from llm_cache import cached_llm, get_response_cache
+from metrics import get_metrics, instrument
+from router import get_route, routed
+from runtime import get_http_clients
+from openai_batch import write_batch_requests, run_batch
+from output_repair import PackedOutputParser, repairing
+from prompt_layout import cacheable_prompt, openai_messages
+from results_store import ParquetRunWriter, new_run_id
+from structured import structured_chain
+from token_budget import OUTPUT_OVERHEAD, OUTPUT_SLACK, count_messages, estimate_batch
+
 llm = ChatOpenAI(
     model_name="gpt-4o-mini",
     temperature=0.5,
+    **get_http_clients(),
 )
 
 
@@ -32,26 +53,79 @@ format_instructions = output_parser.get_format_instructions()
 
 # print(format_instructions)
 
-prompt_template = """
+# 角色和格式说明对所有期刊都相同，作为可缓存的 system 前缀；期刊名放在最后 (见 prompt_layout.py)
+system_template = """
+I am a librarian. I need to classify the journal in the query into a category.
+
 <format_instructions>
 {format_instructions}
 </format_instructions>
+"""
 
+prompt_template = """
 <query>
-I am a librarian. I need to classify the following journal into a category.
-
 {journal}
 </query>
 """
 
-prompt = PromptTemplate.from_template(
-    prompt_template,
-    partial_variables={'format_instructions': format_instructions}
+prompt = cacheable_prompt(system_template, prompt_template, {'format_instructions': format_instructions})
+
+# 分类结果是确定性的，走响应缓存：失败后重跑只会为未命中的期刊请求 API
+# 优先使用原生结构化输出 (提示词中不再附带格式说明)，失败时回退到格式说明 + 解析器
+# 模型、温度和单次调用的时限见 router.py 中的 "category_journal" 路由 (打包模式为 "category_journal_packed")
+route = get_route("category_journal")
+chain = routed("category_journal", lambda llm: structured_chain(prompt, llm, output_parser, "category_journal"),
+               prompt=prompt).with_config(instrument("category_journal"))
+# 批处理模式的回复没有重试机会，解析失败时同样逐级修复
+batch_parser = repairing(output_parser, "category_journal_batch")
+
+# --- 打包模式：一次调用分类多个期刊，格式说明只发送一次 ---
+
+packed_fields = "\n".join(
+    f'\t\t"{schema.name}": {schema.type}  // {schema.description}' for schema in response_schemas
 )
+packed_format_instructions = f"""The output should be a markdown code snippet formatting a JSON array with one object per journal in the query, including the leading and trailing "```json" and "```":
 
-chain = prompt | llm | output_parser
+```json
+[
+\t{{
+\t\t"id": integer  // The id in square brackets before the journal in the query
+{packed_fields}
+\t}}
+]
+```"""
 
-semaphore = asyncio.Semaphore(5)
+packed_system_template = """
+I am a librarian. I need to classify each of the journals in the query into a category.
+
+<format_instructions>
+{format_instructions}
+</format_instructions>
+"""
+
+packed_prompt_template = """
+<query>
+{journals}
+</query>
+"""
+
+packed_prompt = cacheable_prompt(packed_system_template, packed_prompt_template,
+                                 {'format_instructions': packed_format_instructions})
+
+# 打包调用每个期刊的输出 token 数 (估算值，用于限速和成本估算)
+PACK_OUTPUT_TOKENS = 60
+
+packed_parser = PackedOutputParser(chain_name="category_journal_packed")
+
+def packed_chain(pack_size):
+    """打包调用的链：与逐条分类一样走路由 (模型、温度、时限、输入预算) 和响应缓存，
+    中断后重跑时已完成的包直接命中缓存；路由没有指定 max_output_tokens 时按包大小留出余量"""
+    packed_route = get_route("category_journal_packed")
+    if not packed_route.max_output_tokens:
+        packed_route = packed_route.model_copy(update={
+            "max_output_tokens": math.ceil(PACK_OUTPUT_TOKENS * pack_size * OUTPUT_SLACK) + OUTPUT_OVERHEAD})
+    return routed("category_journal_packed", lambda llm: packed_prompt | cached_llm(llm, packed_parser),
+                  route=packed_route, prompt=packed_prompt).with_config(instrument("category_journal_packed"))
 
 log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../logs"))
 os.makedirs(log_dir, exist_ok=True)
@@ -67,39 +141,425 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+# 429 交给 BatchRunner 统一降速重试，其余错误在这里重试
+@retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_not_exception_type(openai.RateLimitError),
+       before_sleep=lambda _: get_metrics().count_retry("category_journal"))
 async def category_journal(journal):
-    async with semaphore:
-        try:
-            logger.info(f"开始处理: {journal}")
-            result = await chain.ainvoke({"journal": journal})
-            logger.info(f"处理成功: {journal} -> {result}")
-            return result
-        except Exception as e:
-            logger.error(f"处理失败: {journal}，错误: {e}")
-            raise
+    try:
+        logger.info(f"开始处理: {journal}")
+        result = await chain.ainvoke({"journal": journal})
+        logger.info(f"处理成功: {journal} -> {result}")
+        return result
+    except Exception as e:
+        logger.error(f"处理失败: {journal}，错误: {e}")
+        raise
+
+def estimate_tokens(journal):
+    # 提示词的 token 数 (tiktoken)；输出上限由 BatchRunner 按路由的 max_tokens 另行计入
+    return count_messages(prompt.format_messages(journal=journal), route.models[0])
+
+def runner_budget():
+    """BatchRunner 的 model / max_tokens 参数：用于 tpm 限速和开始前的成本估算"""
+    return {"model": route.models[0], "max_tokens": route.max_tokens(route.models[0]) or 0}
+
+def call_stats(usage_by_model, latency):
+    # 没有发生模型调用 (usage 为空) 即为命中响应缓存
+    return {
+        "model": ",".join(usage_by_model) or None,
+        "latency_s": latency,
+        "prompt_tokens": sum(usage.get("input_tokens", 0) for usage in usage_by_model.values()),
+        "completion_tokens": sum(usage.get("output_tokens", 0) for usage in usage_by_model.values()),
+        "cache_hit": not usage_by_model,
+    }
+
+async def category_journal_tracked(journal):
+    """category_journal，同时返回本次调用 (含重试) 的耗时、token 和是否命中响应缓存"""
+    started_at = time.perf_counter()
+    with get_usage_metadata_callback() as usage:
+        result = await category_journal(journal)
+    return result, call_stats(usage.usage_metadata, time.perf_counter() - started_at)
+
+def fallback_result(journal, error):
+    logger.error(f"最终失败: {journal}，任务兜底空结果，错误: {error}")
+    return {"title": "", "issn": "", "category": "", "publisher": ""}
+
+def journal_key(journal):
+    """任务断点使用的 key：优先 ISSN，没有时用标题"""
+    return journal.get("print issn") or journal.get("online issn") or journal["title"]
+
+INDEX_PATH = "data/journal_index.json"
+INDEX_SOURCES = ["data/tjsem_table2.json", "data/tjsem_table2.jsonl"]
+
+def open_journal_index(sources=INDEX_SOURCES):
+    """加载 (或从以往输出重建) 本地期刊索引，兜底的空结果不会进入索引"""
+    index = JournalIndex.load_or_build(
+        INDEX_PATH,
+        "data/Table II.json",
+        sources,
+        is_valid=lambda record: bool(record and record.get("category")),
+    )
+    logger.info(f"本地期刊索引已就绪: {index.stats()}")
+    return index
+
+def lookup_journal(index, journal):
+    return index.lookup(journal["title"], [journal.get("print issn"), journal.get("online issn")])
+
+def plan_journals(journals, index=None):
+    """调用 LLM 前的预处理：本地索引命中的直接作答，输入中重复的期刊只分类一次。
+
+    返回 (输入序号 -> 结果, 需要调用 LLM 的 [(输入序号, 期刊)], 重复项 [(输入序号, 首次出现的序号)])
+    """
+    results = {}
+    misses = []
+    duplicates = []
+    first_seen = {}
+    for i, journal in enumerate(journals):
+        key = journal_key(journal)
+        if key in first_seen:
+            duplicates.append((i, first_seen[key]))
+            continue
+        first_seen[key] = i
+        record = lookup_journal(index, journal) if index else None
+        if record:
+            results[i] = record
+        else:
+            misses.append((i, journal))
+    logger.info(f"本地命中 {len(results)} 项，重复 {len(duplicates)} 项，需调用 LLM {len(misses)} 项")
+    return results, misses, duplicates
 
-async def main():
-    logger.info("任务开始")
+def fill_duplicates(results, duplicates):
+    for i, first in duplicates:
+        results[i] = results[first]
+    return [results[i] for i in range(len(results))]
+
+# --- 列式结果：每次运行的结果连同输入表的 ISSN 按 run=<运行 id> 分区追加到 Parquet (见 results_store.py) ---
+
+RESULTS_ROOT = "data/results/category_journal"
+
+result_schema = pa.schema([
+    ("row", pa.int32()),
+    ("title", pa.string()),
+    ("print_issn", pa.string()),
+    ("online_issn", pa.string()),
+    ("subject_area", pa.string()),
+    ("category", pa.string()),
+    ("result_title", pa.string()),
+    ("result_issn", pa.string()),
+    ("publisher", pa.string()),
+    # ok / failed；source: llm / packed / batch / index (本地索引命中) / duplicate (输入中的重复项)
+    ("status", pa.string()),
+    ("source", pa.string()),
+    ("error", pa.string()),
+    ("model", pa.string()),
+    # 打包模式：latency_s 和 token 为整包按期刊数均摊的值，pack_latency_s / pack_size 为整包的耗时和期刊数
+    ("latency_s", pa.float64()),
+    ("pack_latency_s", pa.float64()),
+    ("pack_size", pa.int32()),
+    ("prompt_tokens", pa.int64()),
+    ("completion_tokens", pa.int64()),
+    ("cache_hit", pa.bool_()),
+    ("finished_at", pa.timestamp("ms", tz="UTC")),
+])
+
+def result_row(i, journal, result, source, error=None, stats=None):
+    result = result or {}
+    stats = stats or {}
+    return {
+        "row": i,
+        "title": journal["title"],
+        "print_issn": journal.get("print issn") or None,
+        "online_issn": journal.get("online issn") or None,
+        "subject_area": journal.get("subject area") or None,
+        "category": result.get("category") or None,
+        "result_title": result.get("title") or None,
+        "result_issn": result.get("issn") or None,
+        "publisher": result.get("publisher") or None,
+        "status": "ok" if error is None and result.get("category") else "failed",
+        "source": source,
+        "error": repr(error) if error is not None else None,
+        "model": stats.get("model"),
+        "latency_s": stats.get("latency_s"),
+        "pack_latency_s": stats.get("pack_latency_s"),
+        "pack_size": stats.get("pack_size"),
+        "prompt_tokens": stats.get("prompt_tokens"),
+        "completion_tokens": stats.get("completion_tokens"),
+        "cache_hit": stats.get("cache_hit"),
+        "finished_at": datetime.now(timezone.utc),
+    }
+
+def write_planned(writer, journals, results):
+    """plan_journals 之后 results 中已有的项即本地索引命中"""
+    if writer:
+        writer.extend(result_row(i, journals[i], result, "index") for i, result in sorted(results.items()))
+
+def write_duplicates(writer, journals, results, duplicates):
+    if writer:
+        writer.extend(result_row(i, journals[i], results[first], "duplicate") for i, first in duplicates)
+
+async def main(concurrency=5, rpm=None, tpm=None, index=None, writer=None):
+    logger.info(f"任务开始，并发数: {concurrency}")
     with open("data/Table II.json", "r") as f:
         journals = json.load(f)
-        journals = [journal["title"] for journal in journals]
 
-    results = []
-    for coro in tqdm([category_journal(journal) for journal in journals], desc="分类中", total=len(journals)):
+    results, misses, duplicates = plan_journals(journals, index)
+    write_planned(writer, journals, results)
+    runner = BatchRunner(
+        lambda entry: category_journal_tracked(entry[1]["title"]),
+        concurrency=concurrency,
+        rpm=rpm,
+        tpm=tpm,
+        estimate_tokens=lambda entry: estimate_tokens(entry[1]["title"]),
+        **runner_budget(),
+        desc="分类中",
+    )
+    # 按完成顺序逐条追加到 Parquet
+    async for _, (i, journal), outcome, error in runner.iter_completed(misses):
+        result, stats = outcome if error is None else (fallback_result(journal["title"], error), None)
+        results[i] = result
+        if writer:
+            writer.append(result_row(i, journal, result, "llm", error, stats))
+    write_duplicates(writer, journals, results, duplicates)
+
+    logger.info(f"任务结束，缓存统计: {get_response_cache().stats()}，限流次数: {runner.limiter.rate_limited}")
+    if index:
+        logger.info(f"本地索引统计: {index.stats()}")
+    return fill_duplicates(results, duplicates)
+
+
+def normalize_title(title):
+    return " ".join(str(title).lower().split())
+
+def match_packed_output(records, pack):
+    """把打包调用的输出记录 (PackedOutputParser 的结果) 对应回输入：优先按 id，其次按标题匹配。
+
+    返回 (输入序号 -> 结果, 重复项数量)；未出现在返回值中的输入视为缺失。
+    被截断的最后一条记录已由解析器丢弃；category 为空的记录同样不接受，这些期刊都会在下一轮重新排队。
+    """
+    titles = dict(pack)
+    by_title = {normalize_title(title): index for index, title in pack}
+    matched = {}
+    duplicated = 0
+    for record in records:
         try:
-            result = await coro
-        except Exception:
-            logger.error("最终失败: 任务兜底空结果")
-            result = {"title": "", "issn": "", "category": "", "publisher": ""}
-        results.append(result)
+            index = int(record.get("id"))
+        except (TypeError, ValueError):
+            index = None
+        if index not in titles:
+            index = by_title.get(normalize_title(record.get("title", "")))
+        if index is None or not record.get("category"):
+            continue
+        if index in matched:
+            duplicated += 1
+            continue
+        matched[index] = {schema.name: record.get(schema.name, "") for schema in response_schemas}
+    return matched, duplicated
+
+def pack_payload(pack):
+    return {"journals": "\n".join(f"[{index}] {title}" for index, title in pack)}
+
+@retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_not_exception_type(openai.RateLimitError),
+       before_sleep=lambda _: get_metrics().count_retry("category_journal_packed"))
+async def classify_pack(pack, chain):
+    """pack: [(输入序号, 期刊名), ...]，chain: packed_chain(包大小)；返回 (匹配结果, 重复项数量, 调用统计)。
+    调用统计中的耗时和 token 按包内期刊数均摊，pack_latency_s 和 total_tokens 为整包的耗时和 token 数"""
+    started_at = time.perf_counter()
+    with get_usage_metadata_callback() as usage:
+        records = await chain.ainvoke(pack_payload(pack))
+    matched, duplicated = match_packed_output(records, pack)
+    stats = call_stats(usage.usage_metadata, time.perf_counter() - started_at)
+    total_tokens = stats["prompt_tokens"] + stats["completion_tokens"]
+    stats.update({
+        "latency_s": stats["latency_s"] / len(pack),
+        "pack_latency_s": stats["latency_s"],
+        "pack_size": len(pack),
+        "prompt_tokens": round(stats["prompt_tokens"] / len(pack)),
+        "completion_tokens": round(stats["completion_tokens"] / len(pack)),
+        "total_tokens": total_tokens,
+    })
+    return matched, duplicated, stats
+
+async def main_packed(pack_size, concurrency=5, rpm=None, tpm=None, max_rounds=3, index=None, writer=None):
+    """打包模式：每次调用分类 pack_size 个期刊，缺失的期刊重新排队，多轮后仍缺失的逐条兜底"""
+    logger.info(f"打包模式开始，每次 {pack_size} 个，并发数: {concurrency}")
+    with open("data/Table II.json", "r") as f:
+        journals = json.load(f)
+
+    results, misses, duplicates = plan_journals(journals, index)
+    write_planned(writer, journals, results)
+    local_count = len(results)
+    pending = [(i, journal["title"]) for i, journal in misses]
+    chain = packed_chain(pack_size)
+    model = get_route("category_journal_packed").models[0]
+    total_tokens = 0
+    calls = 0
+    duplicated = 0
+    for round_index in range(max_rounds):
+        if not pending:
+            break
+        packs = [pending[i:i + pack_size] for i in range(0, len(pending), pack_size)]
+        runner = BatchRunner(
+            lambda pack: classify_pack(pack, chain),
+            concurrency=concurrency,
+            rpm=rpm,
+            tpm=tpm,
+            estimate_tokens=lambda pack: count_messages(packed_prompt.format_messages(**pack_payload(pack)), model),
+            model=model,
+            max_tokens=PACK_OUTPUT_TOKENS * pack_size,
+            desc=f"打包分类中 (第 {round_index + 1} 轮)",
+        )
+        async for _, pack, outcome, error in runner.iter_completed(packs):
+            if error is not None:
+                logger.error(f"打包调用失败: {[title for _, title in pack]}，错误: {error}")
+                continue
+            matched, pack_duplicated, stats = outcome
+            calls += 1
+            total_tokens += stats["total_tokens"]
+            duplicated += pack_duplicated
+            results.update(matched)
+            if writer:
+                writer.extend(result_row(i, journals[i], result, "packed", stats=stats) for i, result in matched.items())
+        pending = [(index, title) for index, title in pending if index not in results]
+        logger.info(f"第 {round_index + 1} 轮结束，缺失 {len(pending)} 项重新排队，重复 {duplicated} 项")
 
-    logger.info("任务结束")
-    return results
+    packed_count = len(results) - local_count
+    if pending:
+        logger.info(f"{len(pending)} 项多轮打包后仍缺失，逐条分类")
+        runner = BatchRunner(lambda entry: category_journal_tracked(entry[1]), concurrency=concurrency, rpm=rpm,
+                             tpm=tpm, estimate_tokens=lambda entry: estimate_tokens(entry[1]), **runner_budget(),
+                             desc="逐条兜底")
+        async for _, (i, title), outcome, error in runner.iter_completed(pending):
+            result, stats = outcome if error is None else (fallback_result(title, error), None)
+            results[i] = result
+            if writer:
+                writer.append(result_row(i, journals[i], result, "llm", error, stats))
+
+    tokens_per_item = total_tokens / packed_count if packed_count else 0
+    logger.info(f"打包模式结束，调用 {calls} 次，打包完成 {packed_count} 项，每项 token: {tokens_per_item:.1f}")
+    if index:
+        logger.info(f"本地索引统计: {index.stats()}")
+    write_duplicates(writer, journals, results, duplicates)
+    return fill_duplicates(results, duplicates)
+
+async def run_job(output_path, concurrency=5, rpm=None, tpm=None, index=None, writer=None):
+    """任务模式：逐条写入 JSONL，重启后跳过已完成的期刊，失败项单独记录等待重试；
+    writer 只记录本次运行处理过的期刊 (以往运行已完成的不重复写入)"""
+    with open("data/Table II.json", "r") as f:
+        journals = json.load(f)
+
+    rows = {}
+    for i, journal in enumerate(journals):
+        rows.setdefault(journal_key(journal), i)
+    calls = {}
+
+    async def classify(journal):
+        result, calls[journal_key(journal)] = await category_journal_tracked(journal["title"])
+        return result
+
+    def on_done(journal, result, error, resolved):
+        if writer:
+            key = journal_key(journal)
+            writer.append(result_row(rows[key], journal, result, "index" if resolved else "llm", error, calls.pop(key, None)))
+
+    job = JsonlJob(output_path, key_fn=journal_key)
+    logger.info(f"任务开始，输出: {output_path}，已完成: {len(job.done_keys)}，并发数: {concurrency}")
+    runner = BatchRunner(
+        classify,
+        concurrency=concurrency,
+        rpm=rpm,
+        tpm=tpm,
+        estimate_tokens=lambda journal: estimate_tokens(journal["title"]),
+        **runner_budget(),
+        desc="分类中",
+    )
+    stats = await job.run(runner, journals, resolve=(lambda journal: lookup_journal(index, journal)) if index else None,
+                          on_done=on_done)
+    logger.info(f"任务结束: {stats}，失败记录: {job.failures_path}，缓存统计: {get_response_cache().stats()}")
+    if index:
+        logger.info(f"本地索引统计: {index.stats()}")
+    return stats
+
+async def run_batch_mode(poll_interval=30.0, index=None, writer=None):
+    """离线模式：所有提示词写入一个批处理请求文件，交给服务端 batch 接口处理后统一解析"""
+    with open("data/Table II.json", "r") as f:
+        journals = json.load(f)
+
+    results, misses, duplicates = plan_journals(journals, index)
+    write_planned(writer, journals, results)
+    requests_path = "data/batch/category_journal.requests.jsonl"
+    budget = runner_budget()
+    # batch 接口按半价计费，这里给出的是按实时价格计算的上限
+    estimate = estimate_batch(misses, lambda entry: estimate_tokens(entry[1]["title"]), budget["model"], budget["max_tokens"])
+    logger.info(f"批处理预估: {estimate}")
+    count = write_batch_requests(
+        requests_path,
+        ((str(i), openai_messages(prompt, journal=journal["title"])) for i, journal in misses),
+        model=llm.model_name,
+        temperature=llm.temperature,
+        max_tokens=budget["max_tokens"],
+    )
+    logger.info(f"批处理模式开始，请求数: {count}，请求文件: {requests_path}")
+    replies = await run_batch(requests_path, poll_interval=poll_interval) if count else {}
+
+    for i, journal in misses:
+        reply = replies.get(str(i))
+        error = None
+        try:
+            if reply is None or isinstance(reply, Exception):
+                raise ValueError(reply or "缺少结果")
+            results[i] = batch_parser.parse(reply)
+        except Exception as e:
+            error = e
+            results[i] = fallback_result(journal["title"], e)
+        if writer:
+            writer.append(result_row(i, journal, results[i], "batch", error, {"model": llm.model_name}))
+    logger.info("批处理模式结束")
+    write_duplicates(writer, journals, results, duplicates)
+    return fill_duplicates(results, duplicates)
 
 
 if __name__ == "__main__":
-    results = asyncio.run(main())
+    arg_parser = argparse.ArgumentParser(description="批量对期刊进行分类")
+    arg_parser.add_argument("--concurrency", type=int, default=5, help="同时在途的请求数")
+    arg_parser.add_argument("--rpm", type=float, default=None, help="每分钟请求数上限")
+    arg_parser.add_argument("--tpm", type=float, default=None, help="每分钟 token 数上限")
+    arg_parser.add_argument("--job", default=None, help="任务模式的 JSONL 输出路径 (如 data/tjsem_table2.jsonl)，支持断点续跑")
+    arg_parser.add_argument("--mode", choices=["online", "batch"], default="online", help="online: 逐条实时调用；batch: 使用服务端批处理接口")
+    arg_parser.add_argument("--poll-interval", type=float, default=30.0, help="批处理模式下轮询任务状态的间隔 (秒)")
+    arg_parser.add_argument("--pack", type=int, default=1, help="打包模式：每次调用分类的期刊数，1 表示逐条分类")
+    arg_parser.add_argument("--no-index", action="store_true", help="不使用本地期刊索引，所有期刊都调用 LLM")
+    arg_parser.add_argument("--parquet", default=RESULTS_ROOT,
+                            help="本次运行的结果追加到 <目录>/run=<运行 id>/ 下的 Parquet，设为空字符串则不写")
+    args = arg_parser.parse_args()
+    if args.mode == "batch" and args.job:
+        arg_parser.error("--job 仅支持 online 模式")
+    if args.pack > 1 and (args.job or args.mode == "batch"):
+        arg_parser.error("--pack 仅支持 online 模式且不能与 --job 同时使用")
+
+    index = None if args.no_index else open_journal_index(INDEX_SOURCES + ([args.job] if args.job else []))
+
+    label = "job" if args.job else "batch" if args.mode == "batch" else "packed" if args.pack > 1 else "online"
+    writer = ParquetRunWriter(args.parquet, result_schema, new_run_id(label)) if args.parquet else None
+    try:
+        if args.job:
+            asyncio.run(run_job(args.job, concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm, index=index,
+                                writer=writer))
+        else:
+            if args.mode == "batch":
+                results = asyncio.run(run_batch_mode(poll_interval=args.poll_interval, index=index, writer=writer))
+            elif args.pack > 1:
+                results = asyncio.run(main_packed(args.pack, concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm,
+                                                  index=index, writer=writer))
+            else:
+                results = asyncio.run(main(concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm, index=index,
+                                           writer=writer))
+
+            with open("data/tjsem_table2.json", "w") as f:
+                json.dump(results, f, indent=4, ensure_ascii=False)
+    finally:
+        if writer:
+            writer.close()
+            if writer.rows:
+                logger.info(f"本次运行的结果: {writer.directory} ({writer.rows} 行，{writer.row_groups} 个文件)，"
+                            f"汇总: python results_store.py {args.parquet}")
 
-    with open("data/tjsem_table2.json", "w") as f:
-        json.dump(results, f, indent=4, ensure_ascii=False)
\ No newline at end of file
+    logger.info(f"调用指标汇总:\n{get_metrics().format_summary()}")
\ No newline at end of file
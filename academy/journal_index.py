@@ -0,0 +1,166 @@
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import defaultdict
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Optional
+
+_ISSN_PATTERN = re.compile(r"^\d{7}[\dX]$")
+
+
+def normalize_title(title) -> str:
+    title = unicodedata.normalize("NFKC", str(title or "")).lower().replace("&", " and ")
+    title = re.sub(r"[^\w\s]", " ", title)
+    title = " ".join(title.split())
+    return title[4:] if title.startswith("the ") else title
+
+
+def normalize_issn(issn) -> Optional[str]:
+    issn = re.sub(r"[^0-9X]", "", str(issn or "").upper())
+    return issn if _ISSN_PATTERN.match(issn) else None
+
+
+def _trigrams(title: str) -> set:
+    padded = f"  {title} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class JournalIndex:
+    """本地期刊索引：按 ISSN、规范化标题和模糊标题查找已有的结果，命中时无需调用 LLM。
+
+    模糊匹配先用三字母组倒排索引挑出候选，再用 SequenceMatcher 打分，超过 fuzzy_threshold 视为命中。
+    """
+
+    def __init__(self, fuzzy_threshold: float = 0.92, max_candidates: int = 5):
+        self.fuzzy_threshold = fuzzy_threshold
+        self.max_candidates = max_candidates
+        self.records: List[dict] = []
+        self.by_issn: Dict[str, int] = {}
+        self.by_title: Dict[str, int] = {}
+        self.by_trigram: Dict[str, List[int]] = defaultdict(list)
+        self.build_seconds = 0.0
+        self.load_seconds = 0.0
+        self.hits = {"issn": 0, "title": 0, "fuzzy": 0}
+        self.misses = 0
+        self.lookup_seconds = 0.0
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, title, issns: Iterable, record: dict):
+        normalized = normalize_title(title)
+        position = len(self.records)
+        self.records.append({"title": title, "issns": [i for i in map(normalize_issn, issns) if i], "record": record})
+        for issn in self.records[-1]["issns"]:
+            self.by_issn.setdefault(issn, position)
+        if normalized and normalized not in self.by_title:
+            self.by_title[normalized] = position
+            for gram in _trigrams(normalized):
+                self.by_trigram[gram].append(position)
+
+    def _fuzzy(self, normalized: str) -> Optional[int]:
+        grams = _trigrams(normalized)
+        overlap: Dict[int, int] = defaultdict(int)
+        for gram in grams:
+            for position in self.by_trigram.get(gram, ()):
+                overlap[position] += 1
+        candidates = sorted(overlap, key=overlap.get, reverse=True)[:self.max_candidates]
+        best, best_score = None, self.fuzzy_threshold
+        for position in candidates:
+            score = SequenceMatcher(None, normalized, normalize_title(self.records[position]["title"])).ratio()
+            if score >= best_score:
+                best, best_score = position, score
+        return best
+
+    def lookup(self, title, issns: Iterable = ()) -> Optional[dict]:
+        started_at = time.perf_counter()
+        try:
+            for issn in map(normalize_issn, issns):
+                if issn and issn in self.by_issn:
+                    self.hits["issn"] += 1
+                    return self.records[self.by_issn[issn]]["record"]
+            normalized = normalize_title(title)
+            if normalized in self.by_title:
+                self.hits["title"] += 1
+                return self.records[self.by_title[normalized]]["record"]
+            position = self._fuzzy(normalized) if normalized else None
+            if position is not None:
+                self.hits["fuzzy"] += 1
+                return self.records[position]["record"]
+            self.misses += 1
+            return None
+        finally:
+            self.lookup_seconds += time.perf_counter() - started_at
+
+    def stats(self) -> dict:
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return {
+            "entries": len(self.records),
+            "build_ms": round(self.build_seconds * 1000, 2),
+            "load_ms": round(self.load_seconds * 1000, 2),
+            "lookups": lookups,
+            "hits": dict(self.hits),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "avg_lookup_us": round(self.lookup_seconds / lookups * 1e6, 2) if lookups else 0.0,
+        }
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"fuzzy_threshold": self.fuzzy_threshold, "records": self.records}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "JournalIndex":
+        started_at = time.perf_counter()
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(fuzzy_threshold=data.get("fuzzy_threshold", 0.92))
+        for entry in data["records"]:
+            index.add(entry["title"], entry["issns"], entry["record"])
+        index.load_seconds = time.perf_counter() - started_at
+        return index
+
+    @classmethod
+    def build(cls, source_table: str, outputs: Iterable[str], is_valid=None, **kwargs) -> "JournalIndex":
+        """从以往的输出构建索引。
+
+        - source_table: 原始期刊表 (data/Table II.json)，提供标题和 ISSN
+        - outputs: 以往的结果文件；.json 为与原始表按位置对齐的列表，.jsonl 为任务模式的输出 ({"input", "output"})
+        - is_valid: 过滤掉兜底的空结果等无效记录
+        """
+        started_at = time.perf_counter()
+        index = cls(**kwargs)
+        is_valid = is_valid or (lambda record: bool(record))
+        with open(source_table, "r", encoding="utf-8") as f:
+            journals = json.load(f)
+        for path in outputs:
+            if not os.path.exists(path):
+                continue
+            if path.endswith(".jsonl"):
+                with open(path, "r", encoding="utf-8") as f:
+                    pairs = [(entry["input"], entry["output"]) for entry in map(json.loads, filter(str.strip, f))]
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    pairs = list(zip(journals, json.load(f)))
+            for journal, record in pairs:
+                if not isinstance(journal, dict):
+                    journal = {"title": journal}
+                if not is_valid(record):
+                    continue
+                # 只使用原始表中的 ISSN，LLM 返回的 ISSN 不可靠
+                issns = [journal.get("print issn"), journal.get("online issn")]
+                index.add(journal.get("title") or record.get("title"), issns, record)
+        index.build_seconds = time.perf_counter() - started_at
+        return index
+
+    @classmethod
+    def load_or_build(cls, path: str, source_table: str, outputs: List[str], **kwargs) -> "JournalIndex":
+        """索引文件比所有输出都新时直接加载，否则重新构建并保存"""
+        sources = [p for p in outputs + [source_table] if os.path.exists(p)]
+        if os.path.exists(path) and all(os.path.getmtime(path) >= os.path.getmtime(p) for p in sources):
+            return cls.load(path)
+        index = cls.build(source_table, outputs, **kwargs)
+        index.save(path)
+        return index
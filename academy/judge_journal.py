@@ -1,14 +1,37 @@
 from dotenv import load_dotenv, find_dotenv
+import argparse
 import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import time
+from collections import defaultdict
 load_dotenv(find_dotenv())
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
 from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 
+from batch_runner import BatchRunner
+from journal_index import JournalIndex
+from llm_cache import cached_llm
+from metrics import get_metrics, instrument
+from output_repair import PackedOutputParser
+from prompt_layout import cacheable_prompt
+from router import get_route, routed
+from runtime import get_http_clients
+from structured import structured_chain
+from token_budget import OUTPUT_OVERHEAD, OUTPUT_SLACK, count_messages
+
+logger = logging.getLogger(__name__)
+
 llm = ChatOpenAI(
     model_name="gpt-4o-mini",
     temperature=0.5,
+    **get_http_clients(),
 )
 
 response_schemas = [
@@ -22,38 +45,374 @@ format_instructions = output_parser.get_format_instructions()
 
 # print(format_instructions)
 
-prompt_template = """
+constraints = """<constraints>
+1. The journal should be a peer-reviewed journal.
+2. The journal should be published in the last 10 years.
+3. The journal should be published in the United States.
+4. The journal should be published in the field of the research topic.
+5. Match means the journal is relevant to the research topic.
+6. Other factors that may affect the match are the journal.
+7. Give a reason for your judgement.
+</constraints>"""
+
+# 约束和格式说明对同一批判断都相同，作为可缓存的 system 前缀；研究主题和期刊放在最后 (见 prompt_layout.py)
+system_template = """
+I am doing research on a topic. Help me judge whether the journal in the query matches my research topic.
+
+""" + constraints + """
+
 <format_instructions>
 {format_instructions}
 </format_instructions>
+"""
 
+prompt_template = """
 <query>
-I am doing research on the topic of "{topic}". Can you help me judge whether the following journal matches my research topic:
+Research topic: "{topic}"
 
 {journal}
 </query>
-
-<constraints>
-1. The journal should be a peer-reviewed journal.
-2. The journal should be published in the last 10 years.
-3. The journal should be published in the United States.
-4. The journal should be published in the field of "{topic}".
-5. Match means the journal is relevant to the research topic.
-6. Other factors that may affect the match are the journal.
-7. Give a reason for your judgement.
-</constraints>
 """
 
-prompt = PromptTemplate.from_template(
-    prompt_template,
-    partial_variables={'format_instructions': format_instructions}
-)
+prompt = cacheable_prompt(system_template, prompt_template, {'format_instructions': format_instructions})
+
+# 模型、温度和单次调用的时限见 router.py 中的 "judge_journal" 路由 (矩阵模式为 "judge_journal_packed")
+route = get_route("judge_journal")
+chain = routed("judge_journal", lambda llm: structured_chain(prompt, llm, output_parser, "judge_journal"),
+               prompt=prompt).with_config(instrument("judge_journal"))
 
-chain = prompt | llm | output_parser
+def runner_budget(topic_of=lambda entry: entry[0], journal_of=lambda entry: entry[1]):
+    """BatchRunner 的 estimate_tokens / model / max_tokens 参数：用于 tpm 限速和开始前的成本估算"""
+    model = route.models[0]
+    return {
+        "estimate_tokens": lambda entry: count_messages(
+            prompt.format_messages(topic=topic_of(entry), journal=journal_of(entry)), model),
+        "model": model,
+        "max_tokens": route.max_tokens(model) or 0,
+    }
 
 async def judge_journal(topic, journal):
     return await chain.ainvoke({"topic": topic, "journal": journal})
-    
+
+def load_known_judgements(path):
+    """把以往同一主题的判断结果 ([{journal, title, match, reason}, ...]) 载入本地索引，失败项不计入"""
+    started_at = time.perf_counter()
+    index = JournalIndex()
+    with open(path, "r") as f:
+        for record in json.load(f):
+            if record.get("match") is not None:
+                index.add(record.get("journal") or record["title"], [], record)
+    index.build_seconds = time.perf_counter() - started_at
+    return index
+
+async def judge_journals(topic, journals, concurrency=5, rpm=None, tpm=None, index=None):
+    """并发判断一批期刊是否匹配研究主题，结果按输入顺序返回，失败项的 match 为 None。
+
+    index 为同一主题以往判断结果的本地索引，命中的期刊不再调用 LLM；重复的期刊只判断一次。
+    """
+    results = {}
+    first_seen = {}
+    duplicates = []
+    misses = []
+    for i, journal in enumerate(journals):
+        if journal in first_seen:
+            duplicates.append((i, first_seen[journal]))
+            continue
+        first_seen[journal] = i
+        record = index.lookup(journal) if index else None
+        if record:
+            results[i] = record
+        else:
+            misses.append((i, journal))
+
+    runner = BatchRunner(
+        lambda entry: judge_journal(topic, entry[1]),
+        concurrency=concurrency,
+        rpm=rpm,
+        tpm=tpm,
+        **runner_budget(topic_of=lambda entry: topic),
+        desc=f"判断中 ({topic})",
+    )
+    judged = await runner.run(
+        misses,
+        on_error=lambda entry, e: {"title": entry[1], "match": None, "reason": f"error: {e}"},
+    )
+    # 记录输入的期刊名，LLM 返回的 title 不一定与输入一致
+    results.update({i: {"journal": journal, **result} for (i, journal), result in zip(misses, judged)})
+    for i, first in duplicates:
+        results[i] = results[first]
+    if index:
+        logger.info(f"本地索引统计: {index.stats()}")
+    return [results[i] for i in range(len(journals))]
+
+# --- 矩阵模式：多个研究主题 × 期刊表，每次调用固定一个主题判断多个期刊 (或固定一个期刊判断多个主题) ---
+
+packed_schemas = [
+    ResponseSchema(name="id", description="The id in square brackets before the item in the query", type='integer'),
+    ResponseSchema(name="match", description="Whether the pair matches", type='boolean'),
+    ResponseSchema(name="confidence", description="Confidence of the judgement, from 0 to 1", type='number'),
+    ResponseSchema(name="reason", description="The reason for the match or mismatch", type='string'),
+]
+
+packed_fields = "\n".join(
+    f'\t\t"{schema.name}": {schema.type}  // {schema.description}' for schema in packed_schemas
+)
+packed_format_instructions = f"""The output should be a markdown code snippet formatting a JSON array with one object per numbered item in the query, including the leading and trailing "```json" and "```":
+
+```json
+[
+\t{{
+{packed_fields}
+\t}}
+]
+```"""
+
+packed_system_template = """
+I am doing research on several topics. Help me judge whether journals match my research topics.
+The query fixes either one research topic or one journal, followed by numbered items (journals or research topics).
+Each numbered item forms one (research topic, journal) pair with the fixed part. Judge every pair independently.
+
+""" + constraints + """
+
+<format_instructions>
+{format_instructions}
+</format_instructions>
+"""
+
+packed_prompt_template = """
+<query>
+{fixed}
+
+{items}
+</query>
+"""
+
+packed_prompt = cacheable_prompt(packed_system_template, packed_prompt_template,
+                                 {'format_instructions': packed_format_instructions})
+
+# 打包调用每个组合的输出 token 数 (估算值，用于限速和成本估算)
+PACK_OUTPUT_TOKENS = 60
+
+packed_parser = PackedOutputParser(chain_name="judge_journal_packed")
+
+def packed_chain(pack_size):
+    """打包调用的链：走 "judge_journal_packed" 路由和响应缓存，重新执行时已完成的包直接命中缓存；
+    路由没有指定 max_output_tokens 时按包大小留出余量"""
+    packed_route = get_route("judge_journal_packed")
+    if not packed_route.max_output_tokens:
+        packed_route = packed_route.model_copy(update={
+            "max_output_tokens": math.ceil(PACK_OUTPUT_TOKENS * pack_size * OUTPUT_SLACK) + OUTPUT_OVERHEAD})
+    return routed("judge_journal_packed", lambda llm: packed_prompt | cached_llm(llm, packed_parser),
+                  route=packed_route, prompt=packed_prompt).with_config(instrument("judge_journal_packed"))
+
+class MatchMatrix:
+    """稀疏的 主题 × 期刊 匹配矩阵：每个判断追加一行 JSONL ({topic, journal, match, confidence, reason})。
+
+    只记录已经判断过的组合，同一组合以最后一行为准；重新执行时 match 不为空的组合直接跳过。
+    path 为 None 时只保存在内存中。
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.cells = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.cells[(record["topic"], record["journal"])] = record
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def decided(self, topic, journal):
+        record = self.cells.get((topic, journal))
+        return record is not None and record.get("match") is not None
+
+    def add(self, records):
+        for record in records:
+            self.cells[(record["topic"], record["journal"])] = record
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+    def ranked(self, topics):
+        """每个主题下已判断的期刊：匹配的在前，按置信度从高到低排序"""
+        by_topic = defaultdict(list)
+        for (topic, _), record in self.cells.items():
+            if record.get("match") is not None:
+                by_topic[topic].append({key: value for key, value in record.items() if key != "topic"})
+        return {
+            topic: sorted(by_topic[topic], key=lambda record: (not record["match"], -float(record.get("confidence") or 0)))
+            for topic in topics
+        }
+
+    def stats(self):
+        decided = sum(record.get("match") is not None for record in self.cells.values())
+        return {"cells": len(self.cells), "decided": decided,
+                "matches": sum(bool(record.get("match")) for record in self.cells.values())}
+
+def plan_packs(pairs, group_by="auto", pack_size=20):
+    """把待判断的 (topic, journal) 分组打包，返回 [(分组方式, 固定项, [可变项, ...]), ...]。
+
+    group_by="topic" 时每个包固定一个主题、列出多个期刊；"journal" 反之；"auto" 选择调用次数更少的一种。
+    """
+    if group_by == "auto":
+        counts = {
+            orientation: sum(math.ceil(len(items) / pack_size) for items in _group(pairs, orientation).values())
+            for orientation in ("topic", "journal")
+        }
+        group_by = min(counts, key=counts.get)
+    return [(group_by, fixed, items[i:i + pack_size])
+            for fixed, items in _group(pairs, group_by).items()
+            for i in range(0, len(items), pack_size)]
+
+def _group(pairs, group_by):
+    groups = defaultdict(list)
+    for topic, journal in pairs:
+        if group_by == "topic":
+            groups[topic].append(journal)
+        else:
+            groups[journal].append(topic)
+    return groups
+
+def _pair(orientation, fixed, item):
+    return (fixed, item) if orientation == "topic" else (item, fixed)
+
+def pack_payload(pack):
+    orientation, fixed, items = pack
+    header = f'Research topic: "{fixed}"\nJournals:' if orientation == "topic" else f'Journal: {fixed}\nResearch topics:'
+    return {"fixed": header, "items": "\n".join(f"[{i}] {item}" for i, item in enumerate(items))}
+
+async def judge_pack(pack, chain):
+    """pack: (分组方式, 固定项, [可变项, ...])，chain: packed_chain(包大小)；
+    返回能对应回输入的判断记录列表，缺失的项 (含被截断丢弃的最后一条) 不在其中"""
+    orientation, fixed, items = pack
+    records = await chain.ainvoke(pack_payload(pack))
+    judged = {}
+    for record in records:
+        try:
+            i = int(record.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= i < len(items) and i not in judged and isinstance(record.get("match"), bool):
+            topic, journal = _pair(orientation, fixed, items[i])
+            judged[i] = {"topic": topic, "journal": journal, "match": record["match"],
+                         "confidence": record.get("confidence"), "reason": record.get("reason", "")}
+    return list(judged.values())
+
+async def judge_matrix(topics, journals, matrix, group_by="auto", pack_size=20, concurrency=5, rpm=None, tpm=None,
+                       max_rounds=3):
+    """填充 topics × journals 的匹配矩阵：已判断的组合跳过，其余打包并发判断，每完成一包就写入 matrix。
+
+    多轮打包后仍缺失的组合逐个调用 judge_journal 兜底。返回统计。
+    """
+    topics = list(dict.fromkeys(topics))
+    journals = list(dict.fromkeys(journals))
+    pending = [(topic, journal) for topic in topics for journal in journals if not matrix.decided(topic, journal)]
+    stats = {"pairs": len(topics) * len(journals), "skipped": len(topics) * len(journals) - len(pending),
+             "calls": 0, "packed": 0, "single": 0, "failed": 0}
+    logger.info(f"矩阵模式开始: {len(topics)} 个主题 × {len(journals)} 个期刊，待判断 {len(pending)} 项")
+    chain = packed_chain(pack_size)
+    model = get_route("judge_journal_packed").models[0]
+    for round_index in range(max_rounds):
+        if not pending:
+            break
+        packs = plan_packs(pending, group_by, pack_size)
+        runner = BatchRunner(
+            lambda pack: judge_pack(pack, chain),
+            concurrency=concurrency,
+            rpm=rpm,
+            tpm=tpm,
+            estimate_tokens=lambda pack: count_messages(packed_prompt.format_messages(**pack_payload(pack)), model),
+            model=model,
+            max_tokens=PACK_OUTPUT_TOKENS * pack_size,
+            desc=f"矩阵判断中 (第 {round_index + 1} 轮)",
+        )
+        async for _, pack, records, error in runner.iter_completed(packs):
+            if error is not None:
+                logger.error(f"打包调用失败: {pack[1]} ({len(pack[2])} 项)，错误: {error!r}")
+                continue
+            stats["calls"] += 1
+            stats["packed"] += len(records)
+            matrix.add(records)
+        pending = [(topic, journal) for topic, journal in pending if not matrix.decided(topic, journal)]
+        logger.info(f"第 {round_index + 1} 轮结束，缺失 {len(pending)} 项")
+
+    if pending:
+        logger.info(f"{len(pending)} 项多轮打包后仍缺失，逐个判断")
+
+        async def single(pair):
+            result = await judge_journal(*pair)
+            return {"topic": pair[0], "journal": pair[1], "match": result.get("match"), "confidence": None,
+                    "reason": result.get("reason", "")}
+
+        runner = BatchRunner(single, concurrency=concurrency, rpm=rpm, tpm=tpm, **runner_budget(), desc="逐个兜底")
+        async for _, _, record, error in runner.iter_completed(pending):
+            if error is None:
+                stats["single"] += 1
+                matrix.add([record])
+            else:
+                stats["failed"] += 1
+    logger.info(f"矩阵模式结束: {stats}，矩阵: {matrix.stats()}")
+    return stats
+
+def read_topics(values):
+    """--topics 的每个值可以是主题本身，也可以是每行一个主题的文本文件"""
+    topics = []
+    for value in values:
+        if os.path.isfile(value):
+            with open(value, "r", encoding="utf-8") as f:
+                topics.extend(line.strip() for line in f if line.strip())
+        else:
+            topics.append(value)
+    return topics
+
 if __name__ == "__main__":
-    result = asyncio.run(judge_journal("IBD", "Internet Research"))
-    print(result)
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="判断期刊是否匹配研究主题")
+    arg_parser.add_argument("--topic", default="IBD")
+    arg_parser.add_argument("--topics", nargs="+", default=None,
+                            help="矩阵模式：多个研究主题，或每行一个主题的文本文件；需同时指定 --table 和 --matrix")
+    arg_parser.add_argument("--matrix", default=None, help="矩阵模式的稀疏匹配矩阵 (JSONL)，重新执行时跳过已判断的组合")
+    arg_parser.add_argument("--group-by", choices=["auto", "topic", "journal"], default="auto",
+                            help="矩阵模式的打包方式：每次调用固定一个主题或一个期刊，auto 选择调用次数更少的一种")
+    arg_parser.add_argument("--pack", type=int, default=20, help="矩阵模式每次调用判断的组合数")
+    arg_parser.add_argument("--journal", default="Internet Research", help="单个期刊名")
+    arg_parser.add_argument("--table", default=None, help="期刊表 (如 data/Table II.json)，指定后批量判断")
+    arg_parser.add_argument("--known", default=None, help="同一主题以往的判断结果 (JSON)，已判断过的期刊不再调用 LLM")
+    arg_parser.add_argument("--output", default=None,
+                            help="批量判断结果 (矩阵模式为每个主题排序后的结果) 的输出路径，默认打印到标准输出")
+    arg_parser.add_argument("--concurrency", type=int, default=5)
+    arg_parser.add_argument("--rpm", type=float, default=None)
+    arg_parser.add_argument("--tpm", type=float, default=None)
+    args = arg_parser.parse_args()
+    if args.topics and not (args.table and args.matrix):
+        arg_parser.error("--topics 需要同时指定 --table 和 --matrix")
+
+    if args.topics:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+        with open(args.table, "r") as f:
+            journals = [journal["title"] for journal in json.load(f)]
+        topics = read_topics(args.topics)
+        matrix = MatchMatrix(args.matrix)
+        asyncio.run(judge_matrix(topics, journals, matrix, group_by=args.group_by, pack_size=args.pack,
+                                 concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm))
+        result = matrix.ranked(topics)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=4, ensure_ascii=False)
+        else:
+            print(json.dumps(result, indent=4, ensure_ascii=False))
+    elif args.table:
+        with open(args.table, "r") as f:
+            journals = [journal["title"] for journal in json.load(f)]
+        index = load_known_judgements(args.known) if args.known and os.path.exists(args.known) else None
+        result = asyncio.run(judge_journals(args.topic, journals, args.concurrency, args.rpm, args.tpm, index=index))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=4, ensure_ascii=False)
+        else:
+            print(json.dumps(result, indent=4, ensure_ascii=False))
+    else:
+        result = asyncio.run(judge_journal(args.topic, args.journal))
+        print(result)
+    print(f"调用指标汇总:\n{get_metrics().format_summary()}")
\ No newline at end of file
@@ -1,125 +1,235 @@
 import streamlit as st
-from llm import state_generation_chain, guiding_questions_chain, story_generation_chain, GeneratedStates, GuidedQuestions, QuestionWithOptions, FinalStory # 修改: 导入新内容
-import asyncio
-from langchain.chat_models import ChatOpenAI
+from llm import SetupPool
+from story_graph import StoryState, astream_story_opening, astream_story_step, story_text, story_finished
+from session_store import get_session_store
+import os
+import uuid
 
 # 设置页面标题
 st.set_page_config(page_title="无限冒险剧本生成器", layout="wide")
 
 st.title("🎲 无限冒险剧本生成器")
-st.caption("根据随机生成的起点和终点，通过一系列选择来构建你自己的冒险故事！")
+st.caption("根据随机生成的起点和终点，每做出一个选择，故事就向前推进一段，直到抵达终点！")
+
+@st.cache_resource
+def get_setup_pool():
+    """进程级共享的预生成开局池 (初始/结束状态 + 开篇 + 第一个问题)，SETUP_POOL_SIZE=0 (默认) 时不启用"""
+    size = int(os.getenv("SETUP_POOL_SIZE", "0"))
+    if size <= 0:
+        return None
+    return SetupPool(size=size).start()
 
 # 初始化 session state
 if 'initial_state' not in st.session_state:
     st.session_state.initial_state = ""
 if 'final_state' not in st.session_state:
     st.session_state.final_state = ""
-if 'guided_questions' not in st.session_state:
-    st.session_state.guided_questions = [] # List[QuestionWithOptions]
-if 'user_choices' not in st.session_state:
-    st.session_state.user_choices = {} # Dict[str, str] e.g. {"user_choice_0": "selected_option_for_q0"}
+if 'story' not in st.session_state:
+    st.session_state.story = None # StoryState：已生成的各段剧情、滚动梗概和当前问题
 if 'final_story' not in st.session_state: # 新增
     st.session_state.final_story = ""
 if 'story_generated' not in st.session_state:
     st.session_state.story_generated = False
-if 'questions_generated' not in st.session_state:
-    st.session_state.questions_generated = False
+if 'story_first_token_latency' not in st.session_state:
+    st.session_state.story_first_token_latency = None # 最近一段剧情的首字延迟
+if 'user_id' not in st.session_state:
+    # 生成服务按玩家轮流调度，保证玩家之间公平；写入链接后刷新页面或重启服务也能找回自己的历史冒险
+    st.session_state.user_id = st.query_params.get("user") or uuid.uuid4().hex
+    st.query_params["user"] = st.session_state.user_id
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = None # 当前冒险在会话存储中的 id，每推进一步都会落盘
+if 'pending_job' not in st.session_state:
+    st.session_state.pending_job = None # 正在排队或执行中的生成任务 id
+if 'job_error' not in st.session_state:
+    st.session_state.job_error = None
+if 'celebrate' not in st.session_state:
+    st.session_state.celebrate = False
+
+def submit_job(kind: str, work):
+    """把生成任务交给后台生成服务，本次脚本运行立即返回，由 show_pending_job 轮询进度"""
+    # 生成服务依赖 openai / langchain_core，推迟到第一次提交任务时再导入
+    from job_service import JobRejected, get_job_service
 
-async def generate_states_and_questions():
-    """生成初始/结束状态，然后生成引导问题"""
     try:
-        # 重置状态
-        st.session_state.initial_state = ""
-        st.session_state.final_state = ""
-        st.session_state.guided_questions = []
-        st.session_state.user_choices = {}
-        st.session_state.final_story = ""
-        st.session_state.story_generated = False
-        st.session_state.questions_generated = False
-
-        with st.spinner("正在生成初始和结束状态..."):
-            generated_states: GeneratedStates = await state_generation_chain.ainvoke({})
-            st.session_state.initial_state = generated_states.initial_state
-            st.session_state.final_state = generated_states.final_state
-
-        if st.session_state.initial_state and st.session_state.final_state:
-            with st.spinner("正在生成引导问题..."):
-                questions_data: GuidedQuestions = await guiding_questions_chain.ainvoke({
-                    "initial_state": st.session_state.initial_state,
-                    "final_state": st.session_state.final_state
-                })
-                st.session_state.guided_questions = questions_data.questions
-                # 初始化用户的选择字典的key，确保后续能直接赋值
-                for i in range(len(st.session_state.guided_questions)):
-                    st.session_state.user_choices[f"user_choice_{i}"] = None 
-                st.session_state.questions_generated = True
-        else:
-            st.error("未能成功生成初始或结束状态，请重试。")
+        job = get_job_service().submit(st.session_state.user_id, work, kind=kind)
+    except JobRejected as e:
+        st.warning(f"当前玩家较多，请稍后再试（{e}）")
+        return
+    st.session_state.pending_job = job.id
 
-    except Exception as e:
-        st.error(f"生成过程中发生错误: {e}")
-        st.session_state.questions_generated = False
+def submit_story_step(choice: str = ""):
+    """续写下一段剧情：任务的 partial 为 (本段已生成的文本, None)，完成时结果为 (本段文本, 新的 StoryState)"""
+    story = st.session_state.story
+    session_id = st.session_state.session_id
 
-async def generate_the_final_story():
-    """根据用户选择生成最终剧本"""
-    if not st.session_state.initial_state or not st.session_state.final_state or not st.session_state.user_choices:
-        st.warning("请先生成初始设定并回答所有问题。")
-        return
+    async def work():
+        async for text, new_state in astream_story_step(story, choice):
+            if new_state is not None:
+                # 在任务内落盘，玩家在生成途中断开连接，这一步也不会丢失
+                get_session_store().save_step(session_id, new_state)
+            yield text, new_state
 
-    # 检查用户是否已回答所有问题 (简单的检查方式，可以根据需要完善)
-    # GuidedQuestions 固定为5个问题
-    if len(st.session_state.user_choices) < 5 or any(v is None for v in st.session_state.user_choices.values()):
-        # 确保guided_questions 也被正确加载了
-        if len(st.session_state.guided_questions) == 5 and len(st.session_state.user_choices) < len(st.session_state.guided_questions):
-            st.warning("请回答所有的引导问题后再生成剧本。")
-            return
-        elif any(st.session_state.user_choices.get(f"user_choice_{i}") is None for i in range(len(st.session_state.guided_questions))):
-             st.warning("请回答所有的引导问题后再生成剧本。")
-             return
+    submit_job("step", work)
 
-    try:
-        with st.spinner("正在融合您的选择，创作最终剧本..."):
-            choices_for_prompt = {
-                f"user_choice_{i}": st.session_state.user_choices.get(f"user_choice_{i}", "[未选择]") 
-                for i in range(len(st.session_state.guided_questions)) # 使用实际问题数量
-            }
-            payload = {
-                "initial_state": st.session_state.initial_state,
-                "final_state": st.session_state.final_state,
-                **choices_for_prompt
-            }
-            final_story_data: FinalStory = await story_generation_chain.ainvoke(payload)
-            st.session_state.final_story = final_story_data.story
-            st.session_state.story_generated = True
-            st.balloons() # 庆祝一下
-    except Exception as e:
-        st.error(f"生成最终剧本时发生错误: {e}")
+def restore_session(session_id: str) -> bool:
+    """按 id 从会话存储中恢复一次冒险，不存在时返回 False"""
+    store = get_session_store()
+    info = store.get(session_id)
+    story = store.load(session_id) if info else None
+    if story is None:
+        return False
+    st.session_state.initial_state = story["initial_state"]
+    st.session_state.final_state = story["final_state"]
+    st.session_state.story = story
+    st.session_state.session_id = session_id
+    st.session_state.story_first_token_latency = None
+    st.session_state.story_generated = info["finished"] or story_finished(story)
+    st.session_state.final_story = story_text(story) if st.session_state.story_generated else ""
+    st.query_params["session"] = session_id
+    if not story["segments"]:
+        submit_story_step() # 旧版本先建会话、再写开篇，开篇没写完服务就重启了时补写开篇
+    return True
+
+def save_story_opening(user_id: str, story: StoryState) -> str:
+    """开局拿到状态和开篇后才建会话，返回会话 id"""
+    store = get_session_store()
+    session_id = store.create(user_id, story["initial_state"], story["final_state"])
+    store.save_step(session_id, story)
+    return session_id
+
+def submit_story_opening():
+    """开局只需一次调用：任务的 partial 为 (开篇已生成的文本, None, None)，完成时结果为 (开篇文本, StoryState, 会话 id)"""
+    user_id = st.session_state.user_id
+
+    async def work():
+        async for text, state in astream_story_opening():
+            if state is None:
+                yield text, None, None
+                continue
+            # 与续写一样在任务内落盘
+            yield text, state, save_story_opening(user_id, state)
+
+    submit_job("opening", work)
+
+def apply_story_opening(story: StoryState, session_id: str):
+    st.session_state.initial_state = story["initial_state"]
+    st.session_state.final_state = story["final_state"]
+    st.session_state.story = story
+    st.session_state.session_id = session_id
+    st.query_params["session"] = session_id
+
+def start_new_adventure():
+    """一次调用生成初始/结束状态、开篇和第一个问题"""
+    # 重置状态
+    st.session_state.initial_state = ""
+    st.session_state.final_state = ""
+    st.session_state.story = None
+    st.session_state.session_id = None
+    st.session_state.final_story = ""
+    st.session_state.story_generated = False
+    st.session_state.story_first_token_latency = None
+
+    # 优先从预生成池中直接取用整份开局，池为空时实时生成
+    setup_pool = get_setup_pool()
+    story: StoryState = setup_pool.take() if setup_pool else None
+    if story is not None:
+        apply_story_opening(story, save_story_opening(st.session_state.user_id, story))
+        st.rerun() # 没有待完成的任务，重跑一次才能显示开篇
+    else:
+        submit_story_opening()
+
+def finish_story():
+    """最终剧本就是已生成各段剧情的拼接，不需要再调用模型"""
+    st.session_state.final_story = story_text(st.session_state.story)
+    st.session_state.story_generated = True
+    st.session_state.celebrate = True
+    get_session_store().mark_finished(st.session_state.session_id)
+
+def fork_story(steps: int):
+    """从当前冒险的第 steps 段之后分支出一次新的冒险，在那里做出不同的选择"""
+    fork_id = get_session_store().fork(st.session_state.session_id, steps, user=st.session_state.user_id)
+    restore_session(fork_id)
+
+@st.fragment(run_every=0.5)
+def show_pending_job():
+    """定时只重跑这一小段：显示排队位置或正在生成的剧情，任务结束后写回 session state 并刷新整页"""
+    from job_service import DONE, FAILED, QUEUED, get_job_service
+
+    service = get_job_service()
+    job = service.get(st.session_state.pending_job)
+    if job is None:
+        st.session_state.pending_job = None
+        st.rerun()
+    if job.status == QUEUED:
+        position = service.position(job.id)
+        st.info(f"排队中，前面还有 {position} 个任务..." if position else "即将开始生成...")
+    elif not job.finished:
+        if job.partial:
+            st.caption(f"首字延迟 {job.first_output_at - job.created_at:.2f}s，正在续写...")
+            st.markdown(job.partial[0] + "▌")
+        elif job.kind == "step":
+            st.info("正在根据您的选择续写剧情...")
+        else:
+            st.info("正在生成初始状态、结束状态和开篇...")
+    else:
+        st.session_state.pending_job = None
+        if job.status == DONE:
+            if job.kind == "opening":
+                apply_story_opening(job.result[1], job.result[2])
+            else:
+                st.session_state.story = job.result[1]
+            st.session_state.story_first_token_latency = job.first_output_at - job.created_at
+            if story_finished(st.session_state.story):
+                finish_story()
+        elif job.status == FAILED:
+            action = "续写剧情时" if job.kind == "step" else "生成过程中"
+            st.session_state.job_error = f"{action}发生错误: {job.error}"
+        st.rerun()
+
+# 刷新页面、断线重连或服务重启后，按链接中的 session 恢复上次的冒险
+if st.session_state.story is None and st.session_state.pending_job is None and st.query_params.get("session"):
+    if not restore_session(st.query_params["session"]):
+        del st.query_params["session"]
 
 # --- 按钮和界面布局 ---
+story = st.session_state.story
+story_in_progress = story is not None and not st.session_state.story_generated
+job_pending = st.session_state.pending_job is not None
+
 col_button1, col_button2 = st.columns(2)
 
 with col_button1:
-    if st.button("✨ 生成剧本初始设定", type="primary", use_container_width=True, disabled=st.session_state.questions_generated and not st.session_state.story_generated):
-        asyncio.run(generate_states_and_questions())
+    if st.button("✨ 开始新的冒险", type="primary", use_container_width=True, disabled=job_pending or story_in_progress):
+        start_new_adventure()
 
 with col_button2:
-    # 只有在问题生成后且故事尚未生成时，才启用生成最终剧本按钮
-    if st.button("📜 生成最终剧本", type="primary", use_container_width=True, disabled=not st.session_state.questions_generated or st.session_state.story_generated):
-        asyncio.run(generate_the_final_story())
+    # 随时可以在当前段落处收尾，已生成的剧情即为最终剧本
+    if st.button("🏁 结束冒险，生成剧本", type="primary", use_container_width=True, disabled=job_pending or not story_in_progress or not story["segments"]):
+        finish_story()
+        st.rerun()
+
+if st.session_state.job_error:
+    st.error(st.session_state.job_error)
+    st.session_state.job_error = None
+
+if st.session_state.celebrate:
+    st.balloons() # 庆祝一下
+    st.session_state.celebrate = False
 
 if st.session_state.story_generated: # 提供一个重新开始的选项
     if st.button("🔄 重新开始一段新冒险", use_container_width=True):
         # 重置所有相关状态以重新开始
         st.session_state.initial_state = ""
         st.session_state.final_state = ""
-        st.session_state.guided_questions = []
-        st.session_state.user_choices = {}
+        st.session_state.story = None
+        st.session_state.session_id = None
         st.session_state.final_story = ""
         st.session_state.story_generated = False
-        st.session_state.questions_generated = False
+        st.session_state.story_first_token_latency = None
+        st.query_params.pop("session", None)
         st.rerun() # 重新运行脚本以刷新界面
 
-if st.session_state.questions_generated and not st.session_state.story_generated:
+if story_in_progress:
     st.subheader("🚀 你的冒险起点和可能的终点：")
     col1, col2 = st.columns(2)
     with col1:
@@ -127,24 +237,27 @@ if st.session_state.questions_generated and not st.session_state.story_generated
     with col2:
         st.warning(f"**结束状态:** {st.session_state.final_state}")
 
-    st.subheader("🗺️ 请通过以下问题引导剧本创作：")
-    
-    for i, q_item in enumerate(st.session_state.guided_questions):
-        question_text = f"{i+1}. {q_item.question}"
-        options = [opt for opt in q_item.options]
-        choice_key = f"user_choice_{i}"
-        
-        # 从 session_state 获取当前为此问题保存的答案
-        current_choice_val = st.session_state.user_choices.get(choice_key)
-        current_choice_idx = options.index(current_choice_val) if current_choice_val in options else 0
-
-        selected_option = st.radio(
-            question_text,
-            options,
-            key=f"radio_{choice_key}", # 确保key是唯一的，并且在重新生成问题时能正确更新
-            index=current_choice_idx,
-        )
-        st.session_state.user_choices[choice_key] = selected_option
+    if story["segments"]:
+        st.subheader("📖 故事进行中：")
+        for i, segment in enumerate(story["segments"]):
+            if i > 0:
+                st.caption(f"➡️ {story['choices'][i - 1]}")
+            st.markdown(segment)
+
+if st.session_state.pending_job is not None:
+    show_pending_job()
+elif story_in_progress and story["options"]:
+    step = len(story["segments"])
+    if st.session_state.story_first_token_latency is not None:
+        st.caption(f"上一段首字延迟 {st.session_state.story_first_token_latency:.2f}s")
+    selected_option = st.radio(
+        f"🗺️ {story['question']}",
+        story["options"],
+        key=f"radio_step_{step}", # 每一步使用新的 key，新问题不会沿用上一题的选择
+    )
+    if st.button("➡️ 就这么做", use_container_width=True):
+        submit_story_step(selected_option)
+        st.rerun()
 
 if st.session_state.story_generated and st.session_state.final_story:
     st.subheader("🎉 恭喜！你的冒险剧本已生成：")
@@ -156,6 +269,55 @@ if st.session_state.story_generated and st.session_state.final_story:
         mime="text/plain"
     )
 
+# 分支：回到某一段结束时的问题，做出不同的选择，原来的冒险保持不变
+if story is not None and len(story["segments"]) > 1 and st.session_state.pending_job is None:
+    with st.expander("🔀 回到某个选择，开启平行冒险"):
+        fork_steps = st.selectbox(
+            "保留前几段剧情", list(range(1, len(story["segments"]))),
+            format_func=lambda n: f"前 {n} 段（之后原本选择了：{story['choices'][n - 1]}）",
+        )
+        if st.button("🔀 从这里分支", use_container_width=True):
+            fork_story(fork_steps)
+            st.rerun()
+
+
+# 历史冒险：列出本玩家最近的冒险，点击即可恢复
+with st.sidebar:
+    history = get_session_store().list_sessions(st.session_state.user_id, limit=20)
+    if history:
+        st.subheader("📚 我的冒险")
+        for item in history:
+            mark = "🏁" if item["finished"] else ("🔀" if item["parent_id"] else "📖")
+            label = f"{mark} {item['initial_state'][:16]}… · {item['steps']} 段"
+            current = item["id"] == st.session_state.session_id
+            if st.button(label, key=f"session_{item['id']}", use_container_width=True, disabled=current or job_pending):
+                restore_session(item["id"])
+                st.rerun()
+
+# 调试面板：展示本进程内各 chain 的调用指标（所有会话共享）
+with st.sidebar:
+    if st.checkbox("🔧 显示调试面板"):
+        # 只在打开面板时才导入 pandas 和指标模块，不拖慢普通页面的启动
+        import pandas as pd
+        from metrics import get_metrics
+
+        metrics_summary = get_metrics().summary()
+        if metrics_summary:
+            st.dataframe(pd.DataFrame.from_dict(metrics_summary, orient="index"))
+        else:
+            st.caption("暂无调用记录")
+        connections = get_metrics().connection_summary()
+        if connections["requests"]:
+            st.caption(
+                f"HTTP 请求 {connections['requests']} 次，新建连接 {connections['connections_opened']} 个，"
+                f"连接复用率 {connections['reuse_rate']:.1%}"
+            )
+        from job_service import get_job_service
+
+        st.caption("生成服务")
+        st.json(get_job_service().stats(), expanded=False)
+        st.caption("会话存储")
+        st.json(get_session_store().stats(), expanded=False)
 
 # 添加一些说明和页脚
 st.markdown("---")
@@ -0,0 +1,313 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import openai
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """令牌桶：按每分钟 rate 个令牌匀速补充，容量默认等于一分钟的配额"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.max_rate = rate_per_minute
+        self.rate = rate_per_minute
+        self.capacity = capacity or rate_per_minute
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate / 60)
+        self._updated_at = now
+
+    async def acquire(self, amount: float = 1):
+        # 单次请求超过桶容量时按容量计，避免永远等不到
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) * 60 / self.rate)
+
+    def scale(self, factor: float, floor: float = 0.05):
+        self._refill()
+        self.rate = min(self.max_rate, max(self.max_rate * floor, self.rate * factor))
+
+
+class RateLimiter:
+    """按 requests/minute 和 tokens/minute 限速，遇到 429 时自适应降速并整体冷却"""
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 backoff_base: float = 2.0, backoff_max: float = 60.0, recover_after: int = 20):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.recover_after = recover_after
+        self.rate_limited = 0
+        self._consecutive_429 = 0
+        self._successes = 0
+        self._cooldown_until = 0.0
+
+    async def acquire(self, tokens: int = 0):
+        delay = self._cooldown_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.requests:
+            await self.requests.acquire(1)
+        if self.tokens and tokens:
+            await self.tokens.acquire(tokens)
+
+    def on_success(self):
+        self._consecutive_429 = 0
+        self._successes += 1
+        if self._successes % self.recover_after == 0:
+            for bucket in (self.requests, self.tokens):
+                if bucket:
+                    bucket.scale(1.1)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> float:
+        self.rate_limited += 1
+        self._consecutive_429 += 1
+        self._successes = 0
+        for bucket in (self.requests, self.tokens):
+            if bucket:
+                bucket.scale(0.5)
+        delay = retry_after or min(self.backoff_max, self.backoff_base ** self._consecutive_429)
+        delay *= 1 + random.random() * 0.2
+        self._cooldown_until = max(self._cooldown_until, time.monotonic() + delay)
+        return delay
+
+
+def _retry_after(error: openai.RateLimitError) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class BatchRunner:
+    """基于 asyncio.Queue 的工作池：固定数量的 worker 并发处理输入，按完成顺序产出结果。
+
+    - concurrency: 同时在途的请求数
+    - rpm / tpm: 每分钟请求数 / token 数上限，None 表示不限
+    - estimate_tokens: 单个输入的提示词 token 数 (见 token_budget.py)，与 max_tokens 一起用于 tpm 限速
+    - model / max_tokens: 输入是列表时，开始前按模型价格、max_tokens 和 expected_latency 估算成本与耗时并写入日志
+    - 遇到 429 时自动降速、冷却后重新入队，最多重试 max_rate_limit_retries 次
+    """
+
+    def __init__(self, worker: Callable[[Any], Awaitable[Any]], concurrency: int = 5,
+                 rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 estimate_tokens: Optional[Callable[[Any], int]] = None, model: Optional[str] = None,
+                 max_tokens: int = 0, expected_latency: float = 3.0,
+                 max_rate_limit_retries: int = 8, desc: Optional[str] = None):
+        self.worker = worker
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.estimate_tokens = estimate_tokens
+        self.model = model
+        self.max_tokens = max_tokens
+        self.expected_latency = expected_latency
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.desc = desc
+        self.estimate: Optional[dict] = None
+
+    def preflight(self, items: List) -> dict:
+        """开始前的估算：请求数、输入 token、输出 token 上限、成本上限和预计耗时 (分钟)"""
+        from token_budget import estimate_batch
+
+        self.estimate = estimate_batch(items, self.estimate_tokens, self.model, self.max_tokens,
+                                       concurrency=self.concurrency, rpm=self.rpm, tpm=self.tpm,
+                                       latency=self.expected_latency)
+        logger.info(f"{self.desc or '批处理'} 预估: {self.estimate}")
+        return self.estimate
+
+    async def _process(self, item) -> Tuple[Any, Optional[BaseException]]:
+        # 服务端按提示词 + max_tokens 计算 tpm 占用
+        tokens = self.estimate_tokens(item) + self.max_tokens if self.estimate_tokens else 0
+        for attempt in range(self.max_rate_limit_retries + 1):
+            await self.limiter.acquire(tokens)
+            try:
+                result = await self.worker(item)
+            except openai.RateLimitError as e:
+                if attempt == self.max_rate_limit_retries:
+                    return None, e
+                delay = self.limiter.on_rate_limited(_retry_after(e))
+                logger.warning(f"触发限流 (429)，{delay:.1f}s 后重试，当前已限流 {self.limiter.rate_limited} 次")
+                continue
+            except Exception as e:
+                return None, e
+            self.limiter.on_success()
+            return result, None
+
+    async def iter_completed(self, items: Iterable) -> AsyncIterator[Tuple[int, Any, Any, Optional[BaseException]]]:
+        """按完成顺序产出 (输入序号, 输入, 结果, 异常)，输入按需从可迭代对象中读取"""
+        if self.model and self.estimate_tokens and isinstance(items, (list, tuple)):
+            self.preflight(items)
+        pending: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        done: asyncio.Queue = asyncio.Queue()
+        stop = object()
+
+        async def produce():
+            error = None
+            try:
+                for index, item in enumerate(items):
+                    await pending.put((index, item))
+            except Exception as e:
+                # 读取输入出错时同样要让消费者结束，否则它们会一直等待新的输入；已读取的输入处理完后重新抛出
+                error = e
+            for _ in range(self.concurrency):
+                await pending.put(stop)
+            if error is not None:
+                raise error
+
+        async def consume():
+            while True:
+                entry = await pending.get()
+                if entry is stop:
+                    await done.put(stop)
+                    return
+                index, item = entry
+                result, error = await self._process(item)
+                await done.put((index, item, result, error))
+
+        tasks = [asyncio.create_task(produce())]
+        tasks += [asyncio.create_task(consume()) for _ in range(self.concurrency)]
+        total = len(items) if hasattr(items, "__len__") else None
+        finished_workers = 0
+        try:
+            with tqdm(total=total, desc=self.desc) as progress:
+                while finished_workers < self.concurrency:
+                    entry = await done.get()
+                    if entry is stop:
+                        finished_workers += 1
+                        continue
+                    progress.update(1)
+                    yield entry
+            await tasks[0]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self, items: Iterable,
+                  on_error: Optional[Callable[[Any, BaseException], Any]] = None) -> List:
+        """处理全部输入并按输入顺序返回结果；失败项由 on_error(输入, 异常) 给出兜底值，未提供时抛出异常"""
+        results = {}
+        async for index, item, result, error in self.iter_completed(items):
+            if error is not None:
+                if on_error is None:
+                    raise error
+                result = on_error(item, error)
+            results[index] = result
+        return [results[i] for i in range(len(results))]
+
+
+class JsonlJob:
+    """可断点续跑的批处理任务：每完成一项就追加一行 JSONL，结果不在内存中保留。
+
+    - output_path: 成功结果，每行 {"key", "input", "output"}
+    - <output_path>.manifest: 已完成的 key，每行一个，重启时据此跳过
+    - <output_path>.failures.jsonl: 本次运行失败的输入及错误，下次运行会自动重试
+    """
+
+    def __init__(self, output_path: str, key_fn: Callable[[Any], str]):
+        self.output_path = output_path
+        self.manifest_path = output_path + ".manifest"
+        self.failures_path = output_path + ".failures.jsonl"
+        self.key_fn = key_fn
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.resolved = 0
+        directory = os.path.dirname(os.path.abspath(output_path))
+        os.makedirs(directory, exist_ok=True)
+        self.done_keys = set()
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.done_keys = {line.rstrip("\n") for line in f if line.strip()}
+
+    def pending(self, items: Iterable) -> Iterator:
+        """过滤掉已完成的输入，重复的 key 只保留第一次出现"""
+        seen = set()
+        for item in items:
+            key = self.key_fn(item)
+            if key in self.done_keys or key in seen:
+                self.skipped += 1
+                continue
+            seen.add(key)
+            yield item
+
+    async def run(self, runner: "BatchRunner", items: Iterable,
+                  resolve: Optional[Callable[[Any], Any]] = None,
+                  on_done: Optional[Callable[[Any, Any, Optional[BaseException], bool], Any]] = None) -> dict:
+        """resolve(输入) 返回非空结果时直接写入，不再交给 runner (如本地索引命中)；
+        每处理完一项调用 on_done(输入, 结果, 异常, 是否由 resolve 给出)"""
+        with open(self.output_path, "a", encoding="utf-8") as output, \
+                open(self.manifest_path, "a", encoding="utf-8") as manifest, \
+                open(self.failures_path, "w", encoding="utf-8") as failures:
+
+            def write_success(key, item, result):
+                # 先写结果再写 manifest：崩溃在两者之间时最多重复处理一项
+                output.write(json.dumps({"key": key, "input": item, "output": result}, ensure_ascii=False) + "\n")
+                output.flush()
+                manifest.write(key + "\n")
+                manifest.flush()
+                self.done_keys.add(key)
+                self.succeeded += 1
+
+            def unresolved():
+                for item in self.pending(items):
+                    result = resolve(item) if resolve else None
+                    if result:
+                        self.resolved += 1
+                        write_success(self.key_fn(item), item, result)
+                        if on_done:
+                            on_done(item, result, None, True)
+                    else:
+                        yield item
+
+            async for _, item, result, error in runner.iter_completed(unresolved()):
+                key = self.key_fn(item)
+                if error is not None:
+                    failures.write(json.dumps({"key": key, "input": item, "error": repr(error)}, ensure_ascii=False) + "\n")
+                    failures.flush()
+                    self.failed += 1
+                    if on_done:
+                        on_done(item, None, error, False)
+                    continue
+                write_success(key, item, result)
+                if on_done:
+                    on_done(item, result, None, False)
+        return self.stats()
+
+    def stats(self) -> dict:
+        return {"succeeded": self.succeeded, "failed": self.failed, "skipped": self.skipped, "resolved": self.resolved}
+
+    @staticmethod
+    def read(output_path: str) -> Iterator[dict]:
+        """逐行读取任务输出，同一个 key 重复写入时只返回第一条"""
+        seen = set()
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["key"] in seen:
+                    continue
+                seen.add(record["key"])
+                yield record
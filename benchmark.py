@@ -0,0 +1,582 @@
+"""离线基准测试：把所有 ChatOpenAI 指向本地模拟服务 (mock_openai.py)，无需网络即可衡量性能回归。
+
+测试项：
+- chains: llm.py 中各条链的端到端延迟
+- journal: academy/category_journal.py 在不同并发数下处理 data/Table II.json 的吞吐
+- scene: scene_change.py 的场景衔接生成
+- parsers: 各输出解析器解析一次的耗时
+- startup: 全新进程中 import llm 以及首次构建各条链的耗时 (Streamlit 冷启动的主要开销)
+- structured: 原生结构化输出与“格式说明 + 解析器”两条路径的输入 token、延迟和失败率对比，
+  以及解析失败时各级修复的次数 (配合 --malformed-rate 模拟模型输出损坏的 JSON)
+- story: 交互式剧情引擎 (story_graph.py) 一次调用开局后连续推进多步，开局和每步的首 token 延迟、总延迟，
+  以及每步的输入 token，用于确认提示词长度不随步数增长
+- prompt_cache: 每次调用的输入都不同时，“静态前缀在前” (现有提示词) 与 “可变内容在前” 两种布局的
+  前缀缓存命中率和延迟 (配合 --prefill-rate 模拟预填充耗时)
+- chapter: scene_change.py 章节模式整章构建与逐段串行生成的耗时对比，以及修改一个场景后增量构建实际生成的段数
+- semantic_cache: 十万条规模的语义缓存索引的查询耗时、近似输入与无关输入的命中率，
+  以及 guiding_questions_chain 在不同 diversity 下实际调用模型的比例
+- routing: 模型路由 (router.py) 开启/关闭对冲时的延迟分位数、额外请求比例，以及流式调用的首 chunk 延迟
+  (配合 --slow-rate / --slow-latency 模拟偶发的长尾请求)
+- token_budget: 各条链渲染后提示词的 token 数和 max_tokens，以及发送前计数 (静态前缀命中缓存) 的耗时
+
+用法:
+    python benchmark.py --latency lognormal --latency-mean 0.3 --concurrency 1 5 20
+    python benchmark.py --only chains parsers --output logs/benchmark.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv, find_dotenv
+
+from mock_openai import add_mock_arguments, canned_content, mock_from_args, start_in_thread
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["chains", "journal", "scene", "parsers", "startup", "structured", "story", "prompt_cache", "chapter", "semantic_cache",
+             "routing", "token_budget"]
+
+STORY_PAYLOAD = {
+    "initial_state": "主角在一座漂浮于云海之上的废弃图书馆中醒来",
+    "final_state": "主角找回了失落的记忆并成为图书馆的新守护者",
+    **{f"user_choice_{i}": f"选项 {i}" for i in range(5)},
+}
+
+
+def summarize(values):
+    from metrics import percentile
+
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+    }
+
+
+async def _timed(coro):
+    started_at = time.perf_counter()
+    await coro
+    return time.perf_counter() - started_at
+
+
+async def bench_chains(iterations):
+    import llm
+
+    cases = [
+        ("state_generation_chain", llm.state_generation_chain, {}),
+        ("guiding_questions_chain", llm.guiding_questions_chain,
+         {"initial_state": STORY_PAYLOAD["initial_state"], "final_state": STORY_PAYLOAD["final_state"]}),
+        ("story_opening_chain", llm.story_opening_chain, {}),
+        ("story_generation_chain", llm.story_generation_chain, STORY_PAYLOAD),
+    ]
+    report = {}
+    for name, chain, payload in cases:
+        report[name] = summarize([await _timed(chain.ainvoke(payload)) for _ in range(iterations)])
+    return report
+
+
+async def bench_journal(concurrencies):
+    sys.path.insert(0, os.path.join(ROOT, "academy"))
+    import category_journal
+
+    logging.getLogger().setLevel(logging.WARNING)
+    category_journal.logger.setLevel(logging.WARNING)
+    report = {}
+    for concurrency in concurrencies:
+        started_at = time.perf_counter()
+        results = await category_journal.main(concurrency=concurrency)
+        elapsed = time.perf_counter() - started_at
+        failed = sum(1 for result in results if not result.get("category"))
+        report[f"concurrency={concurrency}"] = {
+            "items": len(results),
+            "failed": failed,
+            "seconds": elapsed,
+            "items_per_sec": len(results) / elapsed,
+        }
+    return report
+
+
+async def bench_scene(iterations):
+    import scene_change
+
+    latencies = [await _timed(scene_change.generate_scene_change(scene_change.scenes_scene_change)) for _ in range(iterations)]
+    return summarize(latencies)
+
+
+def bench_parsers(iterations):
+    """解析器开销：对模拟服务给出的标准回复重复解析，统计单次耗时 (微秒)"""
+    import llm
+
+    sys.path.insert(0, os.path.join(ROOT, "academy"))
+    import category_journal
+
+    cases = [
+        ("GuidedQuestions", llm.parser, llm.prompt.format(initial_state="a", final_state="b")),
+        ("GeneratedStates", llm.states_parser, llm.states_prompt.format()),
+        ("StoryOpening", llm.opening_parser, llm.opening_prompt.format()),
+        ("FinalStory", llm.story_parser, llm.story_prompt.format(**STORY_PAYLOAD)),
+        ("category_journal", category_journal.output_parser, category_journal.prompt.format(journal="Journal of Finance")),
+    ]
+    report = {}
+    for name, parser, prompt in cases:
+        text = canned_content(prompt)
+        started_at = time.perf_counter()
+        for _ in range(iterations):
+            parser.parse(text)
+        report[name] = {"us_per_parse": (time.perf_counter() - started_at) / iterations * 1e6}
+    return report
+
+
+NATIVE_BENCH_MODEL = "gpt-4o-mini"
+
+
+async def bench_structured(iterations):
+    import llm
+    from metrics import REPAIR_TIERS, get_metrics, instrument
+    from structured import structured_chain
+
+    sys.path.insert(0, os.path.join(ROOT, "academy"))
+    import category_journal
+    import judge_journal
+
+    guiding_payload = {"initial_state": STORY_PAYLOAD["initial_state"], "final_state": STORY_PAYLOAD["final_state"]}
+    cases = [
+        ("GuidedQuestions", llm.prompt, llm.llm, llm.parser, guiding_payload),
+        ("GeneratedStates", llm.states_prompt, llm.llm, llm.states_parser, {}),
+        ("StoryOpening", llm.opening_prompt, llm.llm, llm.opening_parser, {}),
+        ("FinalStory", llm.story_prompt, llm.llm, llm.story_parser, STORY_PAYLOAD),
+        ("category_journal", category_journal.prompt, category_journal.llm, category_journal.output_parser,
+         {"journal": "Journal of Finance"}),
+        ("judge_journal", judge_journal.prompt, judge_journal.llm, judge_journal.output_parser,
+         {"topic": "IBD", "journal": "Internet Research"}),
+    ]
+    report = {}
+    for name, prompt, model, parser, payload in cases:
+        for mode in ("parser", "native"):
+            chain_name = f"{name}[{mode}]"
+            # 默认的 gpt-3.5-turbo 不支持严格结构化输出，原生模式换成支持的模型 (mock 对模型名不做区分)
+            llm_for_mode = model.model_copy(update={"model_name": NATIVE_BENCH_MODEL}) if mode == "native" else model
+            chain = structured_chain(prompt, llm_for_mode, parser, chain_name, bypass=True, mode=mode)
+            chain = chain.with_config(instrument(chain_name))
+            failures = 0
+            for _ in range(iterations):
+                try:
+                    await chain.ainvoke(payload)
+                except Exception:
+                    failures += 1
+            stats = get_metrics().summary()[chain_name]
+            report[chain_name] = {
+                "prompt_tokens_per_call": stats["prompt_tokens"] / iterations,
+                "completion_tokens_per_call": stats["completion_tokens"] / iterations,
+                "latency_p50": stats["latency_p50"],
+                "failure_rate": failures / iterations,
+                "parse_failures": stats["parse_failures"],
+                "fallbacks": stats["fallbacks"],
+                "repairs": {tier: stats[f"repair_{tier}"] for tier in REPAIR_TIERS},
+            }
+    return report
+
+
+async def bench_story(steps):
+    from metrics import get_metrics
+    from story_graph import astream_story_opening, astream_story_step
+
+    started_at = time.perf_counter()
+    first_at = None
+    async for _, state in astream_story_opening():
+        first_at = first_at or time.perf_counter()
+    opening = {"ttft": first_at - started_at, "total": time.perf_counter() - started_at}
+    ttfts, totals, prompt_tokens = [], [], []
+    for _ in range(steps):
+        before = get_metrics().summary().get("story_step_chain", {}).get("prompt_tokens", 0)
+        started_at = time.perf_counter()
+        first_at = None
+        async for _, new_state in astream_story_step(state, state["options"][0] if state["options"] else ""):
+            first_at = first_at or time.perf_counter()
+        ttfts.append(first_at - started_at)
+        totals.append(time.perf_counter() - started_at)
+        prompt_tokens.append(get_metrics().summary()["story_step_chain"]["prompt_tokens"] - before)
+        state = new_state
+    return {
+        "opening": opening,
+        "ttft": summarize(ttfts),
+        "step_total": summarize(totals),
+        "prompt_tokens": {"first_step": prompt_tokens[0], "max": max(prompt_tokens), "last_step": prompt_tokens[-1]},
+        "summarized_segments": state["summarized"],
+    }
+
+
+def _variable_first(prompt):
+    """对照组：同样的内容合成一条消息，可变内容在前、角色和格式说明在后 (调整前的提示词布局)"""
+    from langchain_core.prompts import ChatPromptTemplate
+
+    system, human = (message.prompt.template for message in prompt.messages)
+    return ChatPromptTemplate.from_messages([("human", human + system)]).partial(**prompt.partial_variables)
+
+
+async def bench_prompt_cache(iterations):
+    import llm
+    import scene_change
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_openai import ChatOpenAI
+    from metrics import get_metrics, instrument
+    from runtime import get_http_clients
+    from structured import structured_chain
+
+    sys.path.insert(0, os.path.join(ROOT, "academy"))
+    import category_journal
+    import judge_journal
+
+    def step_payload(i):
+        return {"initial_state": STORY_PAYLOAD["initial_state"], "final_state": STORY_PAYLOAD["final_state"],
+                "summary": f"第 {i} 局的故事梗概", "recent": f"第 {i} 局最近的剧情", "choice": f"选项 {i}", "step": i}
+
+    cases = [
+        ("guiding_questions", llm.prompt, llm.llm, llm.parser,
+         lambda i: {"initial_state": f"{STORY_PAYLOAD['initial_state']} ({i})", "final_state": STORY_PAYLOAD["final_state"]}),
+        ("story_step", llm.story_step_prompt, llm.llm, llm.story_step_parser, step_payload),
+        ("category_journal", category_journal.prompt, category_journal.llm, category_journal.output_parser,
+         lambda i: {"journal": f"Journal of Finance {i}"}),
+        ("judge_journal", judge_journal.prompt, judge_journal.llm, judge_journal.output_parser,
+         lambda i: {"topic": "IBD", "journal": f"Internet Research {i}"}),
+        ("scene_change", scene_change.prompt, ChatOpenAI(model="gpt-4.1", temperature=0, **get_http_clients()), None,
+         lambda i: {"scenes": f"<!-- pair {i} -->\n{scene_change.scenes_scene_change}"}),
+    ]
+    report = {}
+    for name, prompt, model, parser, payload in cases:
+        for layout, layout_prompt in (("prefix_first", prompt), ("variable_first", _variable_first(prompt))):
+            chain_name = f"{name}[{layout}]"
+            if parser is None:
+                chain = layout_prompt | model | StrOutputParser()
+            else:
+                chain = structured_chain(layout_prompt, model, parser, chain_name, bypass=True)
+            chain = chain.with_config(instrument(chain_name))
+            for i in range(iterations):
+                await chain.ainvoke(payload(i))
+            stats = get_metrics().summary()[chain_name]
+            report[chain_name] = {
+                "prompt_tokens_per_call": stats["prompt_tokens"] / iterations,
+                "cached_ratio": stats["cached_ratio"],
+                "latency_p50": stats["latency_p50"],
+                "cost_usd": stats["cost_usd"],
+            }
+    return report
+
+
+async def bench_chapter(scene_count):
+    """章节模式：逐段串行生成与两轮并行生成整章的耗时，以及无改动 / 修改一个场景后重新构建时实际生成的段数"""
+    import shutil
+    import tempfile
+
+    import scene_change
+
+    workdir = tempfile.mkdtemp(prefix="bench_chapter_")
+    scenes_dir, output_dir = os.path.join(workdir, "scenes"), os.path.join(workdir, "output")
+    os.makedirs(scenes_dir)
+    for i in range(scene_count):
+        with open(os.path.join(scenes_dir, f"scene_{i:03d}.xml"), "w", encoding="utf-8") as f:
+            f.write(f"<time>第 {i} 幕</time>\n<location>场景 {i}</location>")
+    scenes = scene_change.load_chapter(scenes_dir)
+    chain = scene_change.scene_change_chain(bypass=True)
+
+    report = {}
+    try:
+        started_at = time.perf_counter()
+        for (_, before), (_, after) in zip(scenes, scenes[1:]):
+            await scene_change.generate_scene_change(scene_change.scenes_xml(before, after), chain)
+        report["serial"] = {"seconds": time.perf_counter() - started_at, "generated": len(scenes) - 1}
+        builds = [("full", None), ("unchanged", None), ("edit_one_scene", scene_count // 2)]
+        for name, edited in builds:
+            if edited is not None:
+                with open(os.path.join(scenes_dir, f"scene_{edited:03d}.xml"), "a", encoding="utf-8") as f:
+                    f.write("\n<background>修改后的场景</background>")
+            started_at = time.perf_counter()
+            stats = await scene_change.run_chapter(scenes_dir, output_dir=output_dir, concurrency=scene_count,
+                                                   bypass_cache=True)
+            report[name] = {"seconds": time.perf_counter() - started_at, "generated": stats["generated"],
+                            "skipped": stats["skipped"], "failed": stats["failed"]}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+SEMANTIC_WHO = ["主角", "少女", "老船长", "失忆的侦探", "流浪剑客", "机器人", "年轻的法师", "落魄贵族", "宇航员", "猎人"]
+SEMANTIC_WHERE = ["漂浮于云海之上的废弃图书馆", "深海潜艇的舱室", "雨夜的港口码头", "沙漠中的古城遗迹", "雪山上的修道院",
+                  "霓虹闪烁的地下城", "燃烧的森林", "时间停止的小镇", "巨龙的巢穴", "列车的最后一节车厢"]
+SEMANTIC_EVENT = ["醒来", "发现了一封没有署名的信", "被陌生人追赶", "听见了奇怪的歌声", "捡到一把生锈的钥匙",
+                  "失去了所有记忆", "收到了求救信号", "看见天空裂开一道缝", "遇到了另一个自己", "被困在循环之中"]
+SEMANTIC_GOAL = ["找回了失落的记忆", "揭开了隐藏多年的真相", "成为新的守护者", "与宿敌和解", "拯救了整个城市",
+                 "回到了原来的世界", "打破了诅咒", "找到了失散的家人", "登上了最高的王座", "选择留在这里生活"]
+
+
+def _semantic_state(rng, extra=""):
+    who, where, event, goal = (rng.choice(words) for words in (SEMANTIC_WHO, SEMANTIC_WHERE, SEMANTIC_EVENT, SEMANTIC_GOAL))
+    return {"initial_state": f"{who}在{where}中{event}{extra}", "final_state": f"{who}最终{goal}{extra}"}
+
+
+def _perturb(state, rng):
+    """玩家间常见的细微差异：改写一两个虚词、加标点"""
+    replacements = [("在", "于"), ("中", "里"), ("最终", "最后"), ("了", ""), ("的", "之")]
+    result = {}
+    for key, text in state.items():
+        for old, new in rng.sample(replacements, 2):
+            text = text.replace(old, new, 1)
+        result[key] = text + rng.choice(["", "。", "！"])
+    return result
+
+
+async def bench_semantic_cache(entries, iterations):
+    """语义缓存：entries 条的索引上的查询耗时和命中率 (近似输入 / 无关输入)，以及 guiding_questions_chain 在
+    近似输入占多数时，不同 diversity 下实际调用模型的比例和延迟"""
+    import random
+
+    import llm
+    from metrics import get_metrics
+    from semantic_cache import SemanticCache, _input_text, semantic_cached
+
+    rng = random.Random(0)
+    cache = SemanticCache(max_entries=entries, diversity=0.0, seed=0)
+    stored = []
+    started_at = time.perf_counter()
+    for i in range(entries):
+        # 编号保证每条都不同，组合空间 (一万种) 远小于条目数
+        state = _semantic_state(rng, extra=f"（第{i}号世界）")
+        vector = cache.embed(_input_text(state))
+        cache.store("index", vector, i)
+        if i % max(1, entries // 1000) == 0:
+            stored.append(state)
+    insert_seconds = time.perf_counter() - started_at
+
+    def lookups(states):
+        cache.hits = cache.misses = cache.diverted = 0
+        cache.lookup_seconds.clear()
+        for state in states:
+            cache.lookup("index", _input_text(state))
+        return cache.stats()
+
+    near = lookups([_perturb(state, rng) for state in stored])
+    unrelated = lookups([{key: f"完全不同的故事：{value[::-1]}" for key, value in _semantic_state(rng).items()}
+                     for _ in range(len(stored))])
+    report = {
+        "index": {"entries": entries, "insert_us": insert_seconds / entries * 1e6, "index_mb": near["index_bytes"] / 2 ** 20},
+        "near_duplicate": {key: near[key] for key in ("hit_rate", "lookup_ms_p50", "lookup_ms_p99")},
+        "unrelated": {key: unrelated[key] for key in ("hit_rate", "lookup_ms_p50", "lookup_ms_p99")},
+    }
+
+    # 端到端：50 个基础设定，每次请求随机取一个并做细微改写
+    bases = [_semantic_state(rng) for _ in range(50)]
+    payloads = [_perturb(rng.choice(bases), rng) for _ in range(iterations)]
+    chain = llm.get_chain("guiding_questions_chain")
+    for diversity in (None, 0.0, 0.3):
+        if diversity is None:
+            name, cached_chain = "no_cache", chain
+        else:
+            name = f"diversity={diversity}"
+            cached_chain = semantic_cached(chain, "guiding_questions_chain",
+                                           SemanticCache(max_entries=entries, diversity=diversity, seed=0))
+        calls_before = get_metrics().summary().get("guiding_questions_chain", {}).get("calls", 0)
+        latencies = [await _timed(cached_chain.ainvoke(payload)) for payload in payloads]
+        calls = get_metrics().summary()["guiding_questions_chain"]["calls"] - calls_before
+        report[f"guiding_questions[{name}]"] = {"model_call_ratio": calls / iterations, **summarize(latencies)}
+    return report
+
+
+async def bench_routing(iterations):
+    """同一条链分别在不对冲、固定等待后对冲、按 p95 对冲三种路由下串行调用 iterations 次"""
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+
+    from metrics import get_metrics
+    from router import Route, routed
+
+    prompt = ChatPromptTemplate.from_messages([("system", "为下面的剧情写一句话梗概"), ("human", "{segment}")])
+    variants = {
+        "no_hedge": Route(models=["gpt-3.5-turbo"], budget=60),
+        "hedge_fixed": Route(models=["gpt-3.5-turbo"], budget=60, hedge=True, min_samples=iterations + 1),
+        "hedge_p95": Route(models=["gpt-3.5-turbo"], budget=60, hedge=True),
+    }
+    report = {}
+    for name, route in variants.items():
+        chain_name = f"routing[{name}]"
+        chain = routed(chain_name, lambda llm: prompt | llm | StrOutputParser(), route=route)
+        latencies = [await _timed(chain.ainvoke({"segment": f"第 {i} 段剧情"})) for i in range(iterations)]
+        first_chunks = []
+        for i in range(max(1, iterations // 5)):
+            started_at = time.perf_counter()
+            async for _ in chain.astream({"segment": f"第 {i} 段流式剧情"}):
+                first_chunks.append(time.perf_counter() - started_at)
+                break
+        counters = get_metrics().summary().get(chain_name, {})
+        report[name] = {
+            "latency": summarize(latencies),
+            "stream_first_chunk": summarize(first_chunks),
+            "extra_request_ratio": counters.get("hedges", 0) / (iterations + len(first_chunks)),
+            "hedge_wins": counters.get("hedge_wins", 0),
+        }
+    return report
+
+
+def bench_token_budget(iterations):
+    """每条链按默认路由的第一个模型渲染提示词并计数；计数耗时分别为首次 (冷) 和此后 (system 前缀已缓存) 的均值"""
+    import llm
+    import token_budget
+    from router import get_route
+    from scene_change import prompt as scene_prompt, scenes_scene_change
+
+    payloads = {
+        "guiding_questions_chain": ("prompt", {"initial_state": STORY_PAYLOAD["initial_state"],
+                                               "final_state": STORY_PAYLOAD["final_state"]}),
+        "story_opening_chain": ("opening_prompt", {}),
+        "story_generation_chain": ("story_prompt", STORY_PAYLOAD),
+        "story_step_chain": ("story_step_prompt", {"initial_state": STORY_PAYLOAD["initial_state"],
+                                                   "final_state": STORY_PAYLOAD["final_state"], "summary": "",
+                                                   "recent": canned_content("剧本"), "choice": "选项 0", "step": 3}),
+    }
+    prompts = {name: (llm.get_component(component), payload) for name, (component, payload) in payloads.items()}
+    prompts["scene_change"] = (scene_prompt, {"scenes": scenes_scene_change})
+    report = {}
+    for name, (prompt, payload) in prompts.items():
+        model = get_route(name).models[0]
+        messages = prompt.format_messages(**payload)
+        token_budget._count.cache_clear()
+        started_at = time.perf_counter()
+        tokens = token_budget.count_messages(messages, model)
+        cold = time.perf_counter() - started_at
+        # 每次只有 human 消息不同：改动其中一个字符，模拟新的调用
+        warm = []
+        for i in range(iterations):
+            variant = [messages[0], type(messages[1])(content=messages[1].content + str(i))]
+            started_at = time.perf_counter()
+            token_budget.count_messages(variant, model)
+            warm.append(time.perf_counter() - started_at)
+        report[name] = {
+            "model": model,
+            "prompt_tokens": tokens,
+            "system_tokens": token_budget.count_tokens(messages[0].content, model),
+            "max_tokens": get_route(name).max_tokens(model),
+            "count_us_cold": cold * 1e6,
+            "count_us_warm": sum(warm) / len(warm) * 1e6,
+        }
+    report["encoding"] = {"tiktoken": all(token_budget.get_encoding(token_budget.encoding_name(model)) is not None
+                                          for model in {entry["model"] for entry in report.values()})}
+    return report
+
+
+STARTUP_SCRIPT = """
+import json, time
+started_at = time.perf_counter()
+import llm
+imported_at = time.perf_counter()
+llm.get_chain("story_opening_chain")
+built_at = time.perf_counter()
+for name in ["guiding_questions_chain", "state_generation_chain", "story_generation_chain", "story_step_chain"]:
+    llm.get_chain(name)
+print(json.dumps({"import": imported_at - started_at, "first_chain": built_at - imported_at,
+                  "other_chains": time.perf_counter() - built_at}))
+"""
+
+
+def bench_startup(iterations):
+    """每次都在新的子进程中测量，避免模块已被导入的缓存影响结果"""
+    samples = [json.loads(subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=ROOT, env=os.environ,
+                                         check=True, capture_output=True, text=True).stdout)
+               for _ in range(iterations)]
+    return {name: summarize([sample[name] for sample in samples]) for name in samples[0]}
+
+
+def _rounded(value, digits=4):
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, dict):
+        return {key: _rounded(item, digits) for key, item in value.items()}
+    return value
+
+
+def format_report(report):
+    lines = [f"# Benchmark ({report['started_at']})", ""]
+    for scenario, result in report["results"].items():
+        lines.append(f"## {scenario}")
+        for name, stats in result.items():
+            lines.append(f"- {name}: {json.dumps(_rounded(stats), ensure_ascii=False)}")
+        lines.append("")
+    lines.append(f"mock server: {json.dumps(report.get('mock_server', {}))}")
+    lines.append(f"http: {json.dumps(_rounded(report.get('http', {})))}")
+    return "\n".join(lines)
+
+
+async def run(args):
+    report = {"started_at": time.strftime("%Y-%m-%d %H:%M:%S"), "config": vars(args).copy(), "results": {}}
+    if "chains" in args.only:
+        report["results"]["chains"] = await bench_chains(args.iterations)
+    if "journal" in args.only:
+        report["results"]["journal"] = await bench_journal(args.concurrency)
+    if "scene" in args.only:
+        report["results"]["scene"] = {"scene_change": await bench_scene(args.iterations)}
+    if "parsers" in args.only:
+        report["results"]["parsers"] = bench_parsers(args.parser_iterations)
+    if "startup" in args.only:
+        report["results"]["startup"] = bench_startup(args.iterations)
+    if "structured" in args.only:
+        report["results"]["structured"] = await bench_structured(args.iterations)
+    if "story" in args.only:
+        report["results"]["story"] = await bench_story(args.story_steps)
+    if "prompt_cache" in args.only:
+        report["results"]["prompt_cache"] = await bench_prompt_cache(args.iterations)
+    if "chapter" in args.only:
+        report["results"]["chapter"] = await bench_chapter(args.chapter_scenes)
+    if "semantic_cache" in args.only:
+        report["results"]["semantic_cache"] = await bench_semantic_cache(args.semantic_entries, args.iterations * 20)
+    if "routing" in args.only:
+        report["results"]["routing"] = await bench_routing(args.iterations * 20)
+    if "token_budget" in args.only:
+        report["results"]["token_budget"] = bench_token_budget(args.parser_iterations)
+    return report
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="基于本地模拟服务的离线基准测试")
+    arg_parser.add_argument("--only", nargs="+", choices=SCENARIOS, default=SCENARIOS, help="只运行指定的测试项")
+    arg_parser.add_argument("--iterations", type=int, default=10, help="chains / scene 每项的调用次数")
+    arg_parser.add_argument("--parser-iterations", type=int, default=1000)
+    arg_parser.add_argument("--story-steps", type=int, default=20, help="story 测试连续推进的步数")
+    arg_parser.add_argument("--chapter-scenes", type=int, default=20, help="chapter 测试的场景数")
+    arg_parser.add_argument("--semantic-entries", type=int, default=100_000, help="semantic_cache 测试的索引条目数")
+    arg_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 20], help="journal 测试的并发数")
+    arg_parser.add_argument("--output", default=os.path.join(ROOT, "logs", "benchmark.json"))
+    add_mock_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    load_dotenv(find_dotenv())
+    os.chdir(ROOT)
+    mock = mock_from_args(args)
+    base_url, stop = start_in_thread(mock)
+    # 必须在导入 llm / academy 模块之前设置，保证所有 ChatOpenAI 都指向模拟服务且不命中缓存
+    os.environ.update({
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_KEY": "mock",
+        "LLM_CACHE_DISABLED": "1",
+        "METRICS_PATH": "",
+    })
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        stop()
+    report["mock_server"] = dict(mock.stats)
+    from metrics import get_metrics
+    report["http"] = get_metrics().connection_summary()
+    report["environment"] = {"python": platform.python_version(), "platform": platform.platform()}
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    print(format_report(report))
+    print(f"报告已写入 {args.output}")
@@ -0,0 +1,272 @@
+import asyncio
+import inspect
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+import openai
+
+from batch_runner import RateLimiter, _retry_after
+from metrics import percentile
+from runtime import BackgroundLoop, get_background_loop
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED_STATUSES = {DONE, FAILED, CANCELLED}
+
+
+class JobRejected(Exception):
+    """队列已满或该用户在途任务过多，提交被拒绝 (背压)"""
+
+
+class Job:
+    """一次生成任务。work() 返回协程或异步生成器；异步生成器的每个产出都会记为 partial，最后一个产出即结果"""
+
+    def __init__(self, user: str, work: Callable[[], Any], kind: str = ""):
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.kind = kind
+        self.work = work
+        self.status = QUEUED
+        self.partial: Any = None
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.first_output_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+
+class JobService:
+    """本地生成服务：Streamlit 会话提交任务后立即返回，由后台事件循环中的 worker 执行，界面轮询进度。
+
+    - concurrency: 全局同时执行的任务数上限 (即同时在途的 LLM 调用数)
+    - max_queue: 排队任务总数上限，超出时 submit 抛出 JobRejected
+    - max_jobs_per_user: 每个用户排队加执行中的任务数上限
+    - rpm: 全局每分钟启动的任务数上限，遇到 429 时与 BatchRunner 一样自适应降速并重试
+    - 各用户的队列轮流出队，单个用户提交再多任务也不会饿死其他用户
+    """
+
+    def __init__(self, concurrency: int = 8, max_queue: int = 500, max_jobs_per_user: int = 2,
+                 rpm: Optional[float] = None, max_rate_limit_retries: int = 3, retention: float = 600.0,
+                 loop: Optional[BackgroundLoop] = None):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.retention = retention
+        self.limiter = RateLimiter(rpm=rpm)
+        self._background = loop
+        self._jobs: Dict[str, Job] = {}
+        self._queues: "OrderedDict[str, Deque[Job]]" = OrderedDict()
+        self._running = 0
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._started = False
+        self.counts = {"submitted": 0, "rejected": 0, DONE: 0, FAILED: 0, CANCELLED: 0}
+        self._waits: Deque[float] = deque(maxlen=1000)
+        self._durations: Deque[float] = deque(maxlen=1000)
+
+    def start(self) -> "JobService":
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        self._background = self._background or get_background_loop()
+        self._background.run(self._start_workers())
+        return self
+
+    async def _start_workers(self):
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(), name=f"job-worker-{i}") for i in range(self.concurrency)]
+
+    # --- 提交与查询 (任意线程) ---
+
+    def submit(self, user: str, work: Callable[[], Any], kind: str = "") -> Job:
+        job = Job(user, work, kind)
+        with self._lock:
+            self._expire_finished()
+            queued = sum(len(q) for q in self._queues.values())
+            active = sum(1 for j in self._jobs.values() if j.user == user and not j.finished)
+            if queued >= self.max_queue or active >= self.max_jobs_per_user:
+                self.counts["rejected"] += 1
+                reason = "排队任务已满" if queued >= self.max_queue else "该用户进行中的任务过多"
+                raise JobRejected(f"{reason} (排队 {queued}/{self.max_queue})")
+            self._jobs[job.id] = job
+            self._queues.setdefault(user, deque()).append(job)
+            self.counts["submitted"] += 1
+        self._notify()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job_id: str) -> Optional[int]:
+        """排在该任务之前、还会先被执行的任务数；任务不在排队中时返回 None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != QUEUED:
+                return None
+            users = list(self._queues)
+            rank = users.index(job.user)
+            depth = self._queues[job.user].index(job)
+            # 轮转顺序中排在前面的用户本轮还会先出队一次
+            return depth + sum(min(len(self._queues[user]), depth + (1 if i < rank else 0))
+                               for i, user in enumerate(users) if user != job.user)
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return False
+            if job.status == QUEUED:
+                self._remove_queued(job)
+                self._finish(job, CANCELLED)
+                return True
+            task = job._task
+        if task is not None:
+            self._background.loop.call_soon_threadsafe(task.cancel)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = sum(len(q) for q in self._queues.values())
+            users = len(self._queues)
+            running = self._running
+            waits, durations = list(self._waits), list(self._durations)
+        return {
+            "queued": queued,
+            "running": running,
+            "waiting_users": users,
+            "concurrency": self.concurrency,
+            **self.counts,
+            "rate_limited": self.limiter.rate_limited,
+            "wait_p50": percentile(waits, 0.5),
+            "wait_p95": percentile(waits, 0.95),
+            "run_p50": percentile(durations, 0.5),
+            "run_p95": percentile(durations, 0.95),
+        }
+
+    # --- 内部实现 ---
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._background.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _remove_queued(self, job: Job):
+        user_queue = self._queues[job.user]
+        user_queue.remove(job)
+        if not user_queue:
+            del self._queues[job.user]
+
+    def _next_job(self) -> Optional[Job]:
+        # 取轮转顺序中第一个用户的队首任务，该用户若还有任务则排到轮转末尾
+        with self._lock:
+            if not self._queues:
+                return None
+            user, user_queue = self._queues.popitem(last=False)
+            job = user_queue.popleft()
+            if user_queue:
+                self._queues[user] = user_queue
+            job.status = RUNNING
+            job.started_at = time.time()
+            # 每个任务在自己的 asyncio 任务中执行，cancel() 只会取消这一个任务；在锁内创建，cancel() 总能看到它
+            job._task = asyncio.create_task(self._run(job), name=f"job-{job.id}")
+            self._running += 1
+            self._waits.append(job.started_at - job.created_at)
+            return job
+
+    def _finish(self, job: Job, status: str, error: Optional[BaseException] = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        self.counts[status] += 1
+
+    def _expire_finished(self):
+        deadline = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < deadline]:
+            del self._jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                # clear 与 wait 之间可能有新任务入队，再检查一次
+                if not self._queues:
+                    await self._wakeup.wait()
+                continue
+            try:
+                # 只等待任务结束，不把 worker 自身的取消传给它，也不让任务的取消终止 worker
+                await asyncio.wait([job._task])
+                job._task.result()
+            except asyncio.CancelledError:
+                with self._lock:
+                    self._finish(job, CANCELLED)
+                if not job._task.done():
+                    # worker 自身被取消 (事件循环关闭)，连同任务一起结束
+                    job._task.cancel()
+                    raise
+            except Exception as e:
+                logger.warning(f"任务 {job.id} ({job.kind}) 失败: {e!r}")
+                with self._lock:
+                    self._finish(job, FAILED, e)
+            else:
+                with self._lock:
+                    self._finish(job, DONE)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._durations.append(job.finished_at - job.started_at)
+
+    async def _run(self, job: Job):
+        for attempt in range(self.max_rate_limit_retries + 1):
+            await self.limiter.acquire()
+            try:
+                output = job.work()
+                if inspect.isasyncgen(output):
+                    async for item in output:
+                        job.first_output_at = job.first_output_at or time.time()
+                        job.partial = item
+                    job.result = job.partial
+                else:
+                    job.result = await output
+            except openai.RateLimitError as e:
+                if attempt == self.max_rate_limit_retries or job.partial is not None:
+                    raise
+                delay = self.limiter.on_rate_limited(_retry_after(e))
+                logger.warning(f"任务 {job.id} 触发限流 (429)，{delay:.1f}s 后重试")
+                continue
+            self.limiter.on_success()
+            return
+
+
+_service: Optional[JobService] = None
+_lock = threading.Lock()
+
+
+def get_job_service() -> JobService:
+    """进程级共享的生成服务，参数由 JOB_CONCURRENCY、JOB_MAX_QUEUE、JOB_MAX_PER_USER、JOB_RPM 配置"""
+    global _service
+    with _lock:
+        if _service is None:
+            rpm = os.getenv("JOB_RPM")
+            _service = JobService(
+                concurrency=int(os.getenv("JOB_CONCURRENCY", "8")),
+                max_queue=int(os.getenv("JOB_MAX_QUEUE", "500")),
+                max_jobs_per_user=int(os.getenv("JOB_MAX_PER_USER", "2")),
+                rpm=float(rpm) if rpm else None,
+            ).start()
+        return _service
@@ -1,17 +1,14 @@
-from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema import StrOutputParser
-from langchain.schema.runnable import RunnablePassthrough
-from langgraph.graph import StateGraph, END
-from typing import TypedDict, Annotated, Sequence, Iterator, List
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-from pydantic import BaseModel, Field
-from langchain.output_parsers import PydanticOutputParser
+import os
 import re
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from pydantic import BaseModel, Field
 
-# 加载环境变量
-load_dotenv()
+# langchain / langchain_openai 的导入、ChatOpenAI、解析器和提示模板都推迟到第一次使用时构建：
+# 导入本模块只定义数据模型和提示词文本，Streamlit 的冷启动不再为尚未用到的链付出代价。
+# 构建结果缓存在进程级的注册表中，所有会话、所有 rerun 共享同一组实例。
 
 # 定义LLM返回的结构化数据模型
 class QuestionWithOptions(BaseModel):
@@ -26,21 +23,30 @@ class GeneratedStates(BaseModel):
     initial_state: str = Field(description="冒险游戏开始时的初始状态描述")
     final_state: str = Field(description="冒险游戏可能达到的一个结束状态描述")
 
-# 接下来我们可以定义使用这些模型的LLM链
-
-# 1. 初始化 OpenAI LLM
-llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0.7) # 修改: 指定模型为 gpt-4o
+# 定义最终剧本的Pydantic模型
+class FinalStory(BaseModel):
+    story: str = Field(description="根据初始状态、结束状态和用户选择的五个情节片段串联起来的完整冒险剧本")
 
-# 2. 创建 PydanticOutputParser
-parser = PydanticOutputParser(pydantic_object=GuidedQuestions)
+# 交互式剧情引擎每一步的输出：本段剧情 + 下一个问题 (见 story_graph.py)
+class StoryStep(BaseModel):
+    segment: str = Field(description="承接前文和用户最新选择的下一段剧情，150到300字")
+    question: str = Field(description="本段剧情结束时向用户提出的下一个问题")
+    options: List[str] = Field(description="下一个问题的2到4个选项；剧情已经到达结束状态时返回空列表")
 
-# 3. 创建提示模板
-prompt_template = """
+# 开局一次请求同时生成初始/结束状态、开篇剧情和第一个问题 (见 story_graph.astream_story_opening)
+class StoryOpening(BaseModel):
+    initial_state: str = Field(description="冒险游戏开始时的初始状态描述")
+    final_state: str = Field(description="冒险游戏可能达到的一个结束状态描述")
+    segment: str = Field(description="从初始状态出发的开篇剧情，150到300字")
+    question: str = Field(description="开篇剧情结束时向用户提出的第一个问题")
+    options: List[str] = Field(description="第一个问题的2到4个选项")
+
+# 提示模板文本
+# 每个提示词分为 system 前缀 (角色、要求、输出格式，对所有调用都相同) 和 human 后缀 (本次调用的输入)，
+# 前缀中不出现任何变量，服务端的提示词缓存才能在不同玩家、不同调用之间复用 (见 prompt_layout.py)
+prompt_system_template = """
 你是一个游戏剧本创作助手。
-用户的目标是创作一个冒险游戏的剧本，该剧本需要联结两个已知的游戏状态。
-
-初始状态: {initial_state}
-结束状态: {final_state}
+用户的目标是创作一个冒险游戏的剧本，该剧本需要联结两个已知的游戏状态：初始状态和结束状态。
 
 请你生成5个引导性的问题，每个问题提供至少2个选项，帮助用户一步步构建这个剧本。
 确保这些问题和选项能够自然地引导用户从初始状态过渡到结束状态。
@@ -48,23 +54,12 @@ prompt_template = """
 {format_instructions}
 """
 
-prompt = ChatPromptTemplate.from_template(
-    template=prompt_template,
-    partial_variables={"format_instructions": parser.get_format_instructions()}
-)
-
-# 4. 创建并连接LLM调用链
-guiding_questions_chain = prompt | llm | parser
-
-# --- 新增：生成初始和结束状态的LLM链 ---
-
-# 1. 初始化 LLM (复用之前的llm实例)
-
-# 2. 创建 PydanticOutputParser for GeneratedStates
-states_parser = PydanticOutputParser(pydantic_object=GeneratedStates)
+prompt_template = """
+初始状态: {initial_state}
+结束状态: {final_state}
+"""
 
-# 3. 创建提示模板 for GeneratedStates
-states_prompt_template = """
+states_system_template = """
 你是一个富有想象力的游戏设定生成器。
 请为用户的无限流冒险游戏生成两个随机且有趣的的游戏状态：一个是初始状态，一个是潜在的结束状态。
 这两个状态应该能够激发有趣的故事情节。
@@ -74,30 +69,23 @@ states_prompt_template = """
 {format_instructions}
 """
 
-states_prompt = ChatPromptTemplate.from_template(
-    template=states_prompt_template,
-    partial_variables={"format_instructions": states_parser.get_format_instructions()}
-)
-
-# 4. 创建并连接LLM调用链 for GeneratedStates
-state_generation_chain = states_prompt | llm | states_parser
+states_prompt_template = """
+请生成一组新的初始状态和结束状态。
+"""
 
-# --- 新增：根据用户选择生成最终剧本的LLM链 ---
+story_system_template = """
+你是一位才华横溢的剧作家。
+请根据用户给出的初始状态、结束状态和用户选择的五个关键情节转折点，创作一个连贯、引人入胜的冒险游戏短篇剧本。
 
-# 1. 定义最终剧本的Pydantic模型
-class FinalStory(BaseModel):
-    story: str = Field(description="根据初始状态、结束状态和用户选择的五个情节片段串联起来的完整冒险剧本")
+请将这些元素巧妙地编织进一个完整的故事中，确保故事流畅，逻辑清晰，并能够从初始状态自然发展到结束状态。
+故事应该生动有趣，富有冒险色彩。
 
-# 2. 创建 PydanticOutputParser for FinalStory
-story_parser = PydanticOutputParser(pydantic_object=FinalStory)
+{format_instructions}
+"""
 
-# 3. 创建提示模板 for FinalStory
 # 用户选择的格式将会是: {"user_choice_0": "选项A", "user_choice_1": "选项B", ...}
 # 我们需要将这些选择在提示中清晰地列出来
 story_prompt_template = """
-你是一位才华横溢的剧作家。
-请根据以下信息创作一个连贯、引人入胜的冒险游戏短篇剧本：
-
 初始状态: 
 {initial_state}
 
@@ -110,21 +98,336 @@ story_prompt_template = """
 3. {user_choice_2}
 4. {user_choice_3}
 5. {user_choice_4}
+"""
 
-请将这些元素巧妙地编织进一个完整的故事中，确保故事流畅，逻辑清晰，并能够从初始状态自然发展到结束状态。
-故事应该生动有趣，富有冒险色彩。
+opening_system_template = """
+你是一个富有想象力的游戏设定生成器，同时也是一位才华横溢的剧作家，正在和用户一起一步步创作一个无限流冒险游戏剧本。
+请为一局新的游戏完成以下两步：
+
+1. 生成两个随机且有趣的游戏状态：一个是初始状态，一个是潜在的结束状态。状态描述应简洁且引人入胜，能够激发有趣的故事情节。
+2. 从初始状态出发写出开篇剧情，并在这段剧情结束时向用户提出第一个问题，给出2到4个走向明显不同的选项，逐步把故事引向结束状态。
 
 {format_instructions}
 """
 
-story_prompt = ChatPromptTemplate.from_template(
-    template=story_prompt_template,
-    partial_variables={"format_instructions": story_parser.get_format_instructions()}
-)
+opening_prompt_template = """
+请开始一局新的冒险。
+"""
+
+story_step_system_template = """
+你是一位才华横溢的剧作家，正在和用户一起一步步创作一个无限流冒险游戏剧本。
+用户每做出一个选择，你就续写一段剧情，并在这段剧情结束时提出下一个问题。
+
+续写时：自然地承接最近的剧情和用户的选择，保持人物和设定前后一致，逐步把故事引向结束状态。
+然后提出下一个问题，给出2到4个走向明显不同的选项。剧情已经自然地到达结束状态时，options 返回空列表。
+
+{format_instructions}
+"""
+
+# 同一局游戏内不变的初始/结束状态放在最前，本步才确定的内容放在最后
+story_step_prompt_template = """
+初始状态: {initial_state}
+结束状态: {final_state}
+
+此前的故事梗概:
+{summary}
+
+最近的剧情原文:
+{recent}
+
+用户刚刚的选择: {choice}
+
+请续写第 {step} 段剧情。
+"""
+
+story_summary_system_template = """
+请把用户给出的故事梗概和新增剧情合并成一份新的故事梗概。
+保留推动情节的关键事件、人物、地点、物品和用户做出的选择，省略描写和对话细节，直接输出梗概正文。
+"""
+
+story_summary_prompt_template = """
+原梗概:
+{summary}
+
+新增剧情:
+{segments}
+
+新梗概不超过 {max_chars} 字。
+"""
+
+
+# --- 组件注册表：名称 -> 构建函数，第一次 get_component 时构建并缓存 ---
+
+_BUILDERS: Dict[str, Callable[[], object]] = {}
+_components: Dict[str, object] = {}
+_registry_lock = threading.RLock()
+
+
+def _component(name: str):
+    def register(builder):
+        _BUILDERS[name] = builder
+        return builder
+    return register
+
+
+def get_component(name: str):
+    """按名称取得 llm / 解析器 / 提示模板 / 链，首次调用时构建，之后在整个进程内复用"""
+    with _registry_lock:
+        if name not in _components:
+            if name not in _BUILDERS:
+                raise KeyError(f"未知的组件: {name}")
+            _components[name] = _BUILDERS[name]()
+        return _components[name]
+
+
+def get_chain(name: str):
+    return get_component(name)
+
+
+def __getattr__(name: str):
+    # 兼容 `llm.story_parser`、`from llm import story_generation_chain` 等旧用法
+    if name in _BUILDERS:
+        return get_component(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _cache_creative() -> bool:
+    # 创作类调用默认不走响应缓存（相同输入也应得到新内容），设置 LLM_CACHE_CREATIVE=1 可开启
+    # 状态生成和开局的输入恒为空，缓存会让所有玩家拿到同一个设定，因此始终绕过缓存
+    # 输入非空的创作类链可以改用语义缓存 (SEMANTIC_CACHE_CHAINS，见 semantic_cache.py)：按输入相似度复用，并保留一定比例的新内容
+    return os.getenv("LLM_CACHE_CREATIVE") == "1"
+
+
+def _semantic_cached(chain, name: str):
+    # 未启用语义缓存的链不导入 semantic_cache (及 NumPy)，不增加冷启动耗时
+    if name not in {chain_name.strip() for chain_name in os.getenv("SEMANTIC_CACHE_CHAINS", "").split(",")}:
+        return chain
+    from semantic_cache import semantic_cached
+
+    return semantic_cached(chain, name)
+
+
+@_component("llm")
+def _build_llm():
+    from dotenv import load_dotenv
+    from langchain_openai import ChatOpenAI
+    from runtime import get_http_clients
+
+    # 加载环境变量
+    load_dotenv()
+    # 所有链共用这一个实例，HTTP 连接池则与进程内其他 ChatOpenAI 共享
+    return ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0.7, stream_usage=True, **get_http_clients())
+
+
+def _pydantic_parser(model):
+    from langchain.output_parsers import PydanticOutputParser
+
+    return PydanticOutputParser(pydantic_object=model)
+
+
+def _prompt(system_template: str, template: str, parser_name: str):
+    from prompt_layout import cacheable_prompt
+
+    return cacheable_prompt(system_template, template,
+                            {"format_instructions": get_component(parser_name).get_format_instructions()})
+
+
+_component("parser")(lambda: _pydantic_parser(GuidedQuestions))
+_component("states_parser")(lambda: _pydantic_parser(GeneratedStates))
+_component("story_parser")(lambda: _pydantic_parser(FinalStory))
+_component("story_step_parser")(lambda: _pydantic_parser(StoryStep))
+_component("opening_parser")(lambda: _pydantic_parser(StoryOpening))
+
+
+@_component("story_step_repair_parser")
+def _build_story_step_repair_parser():
+    from output_repair import repairing
+
+    return repairing(get_component("story_step_parser"), "story_step_chain")
+
+
+@_component("story_opening_repair_parser")
+def _build_story_opening_repair_parser():
+    from output_repair import repairing
+
+    return repairing(get_component("opening_parser"), "story_opening_chain")
+
+_component("prompt")(lambda: _prompt(prompt_system_template, prompt_template, "parser"))
+_component("states_prompt")(lambda: _prompt(states_system_template, states_prompt_template, "states_parser"))
+_component("story_prompt")(lambda: _prompt(story_system_template, story_prompt_template, "story_parser"))
+_component("story_step_prompt")(lambda: _prompt(story_step_system_template, story_step_prompt_template,
+                                                "story_step_parser"))
+_component("opening_prompt")(lambda: _prompt(opening_system_template, opening_prompt_template, "opening_parser"))
+
+
+# 各条链优先使用模型原生的结构化输出，失败时回退到“格式说明 + 解析器”的原路径 (见 structured.py)
+# 模型、级联、对冲和时限由 router.py 按链名配置；以下质量检查不通过时换级联中的下一个模型
+
+def _complete_questions(result: GuidedQuestions) -> bool:
+    return len(result.questions) == 5 and all(len(question.options) >= 2 for question in result.questions)
+
+
+def _complete_states(result: GeneratedStates) -> bool:
+    return bool(result.initial_state.strip() and result.final_state.strip())
+
+
+def _complete_story(result: FinalStory) -> bool:
+    return bool(result.story.strip())
+
+
+# state_generation_chain、guiding_questions_chain、story_generation_chain 是“先生成状态、回答 5 个问题、再一次生成整篇剧本”
+# 流程的链，app 已改为由 story_opening_chain 开局、story_step_chain 逐步推进 (见 story_graph.py)，不再调用它们。
+# 保留给 benchmark.py 的各项测试和以 `from llm import ...` 调用的脚本，app 侧不要再引入新的用法
+
+@_component("guiding_questions_chain")
+def _build_guiding_questions_chain():
+    from metrics import instrument
+    from router import routed
+    from structured import structured_chain
+
+    chain = routed("guiding_questions_chain", lambda llm: structured_chain(
+        get_component("prompt"), llm, get_component("parser"), "guiding_questions_chain",
+        bypass=not _cache_creative()), check=_complete_questions,
+        prompt=get_component("prompt"))
+    return _semantic_cached(chain, "guiding_questions_chain").with_config(instrument("guiding_questions_chain"))
+
+
+@_component("state_generation_chain")
+def _build_state_generation_chain():
+    from metrics import instrument
+    from router import routed
+    from structured import structured_chain
+
+    chain = routed("state_generation_chain", lambda llm: structured_chain(
+        get_component("states_prompt"), llm, get_component("states_parser"), "state_generation_chain",
+        bypass=True), check=_complete_states,
+        prompt=get_component("states_prompt"))
+    # 输入恒为空，不使用语义缓存 (所有玩家会拿到同一个设定)
+    return chain.with_config(instrument("state_generation_chain"))
+
+
+@_component("story_generation_chain")
+def _build_story_generation_chain():
+    from metrics import instrument
+    from router import routed
+    from structured import structured_chain
+
+    chain = routed("story_generation_chain", lambda llm: structured_chain(
+        get_component("story_prompt"), llm, get_component("story_parser"), "story_generation_chain",
+        bypass=not _cache_creative()), check=_complete_story,
+        prompt=get_component("story_prompt"))
+    return _semantic_cached(chain, "story_generation_chain").with_config(instrument("story_generation_chain"))
+
+
+@_component("story_step_chain")
+def _build_story_step_chain():
+    # 流式输出，边生成边展示本段剧情；最终结果由 story_step_repair_parser 校验
+    from metrics import instrument
+    from router import routed
+    from structured import structured_stream_chain
+
+    chain = routed("story_step_chain", lambda llm: structured_stream_chain(
+        get_component("story_step_prompt"), llm, get_component("story_step_parser"), "story_step_chain"),
+        prompt=get_component("story_step_prompt"), trim=("summary", "recent"))
+    return chain.with_config(instrument("story_step_chain"))
 
-# 4. 创建并连接LLM调用链 for FinalStory
-# 注意：这里的llm实例是复用的
-story_generation_chain = story_prompt | llm | story_parser
+
+@_component("story_opening_chain")
+def _build_story_opening_chain():
+    # 一次调用写出初始/结束状态、开篇和第一个问题，取代“先生成状态、再写开篇”两次串行调用；
+    # 字段按这个顺序输出，状态先于开篇生成，开篇照常流式展示。输入恒为空，不走任何缓存
+    from metrics import instrument
+    from router import routed
+    from structured import structured_stream_chain
+
+    chain = routed("story_opening_chain", lambda llm: structured_stream_chain(
+        get_component("opening_prompt"), llm, get_component("opening_parser"), "story_opening_chain"),
+        prompt=get_component("opening_prompt"))
+    return chain.with_config(instrument("story_opening_chain"))
+
+
+@_component("story_summary_chain")
+def _build_story_summary_chain():
+    from langchain_core.output_parsers import StrOutputParser
+    from metrics import instrument
+    from prompt_layout import cacheable_prompt
+    from router import get_route, routed
+
+    # 梗概只需要忠实压缩，不需要创造性 (路由中的温度为 0.2)；输出长度与 story_graph 要求的梗概字数一致
+    prompt = cacheable_prompt(story_summary_system_template, story_summary_prompt_template)
+    route = get_route("story_summary_chain")
+    if not (route.output_chars or route.max_output_tokens):
+        route = route.model_copy(update={"output_chars": int(os.getenv("STORY_SUMMARY_CHARS", "400"))})
+    chain = routed("story_summary_chain", lambda llm: prompt | llm | StrOutputParser(), route=route, prompt=prompt,
+                   trim=("summary",))
+    return chain.with_config(instrument("story_summary_chain"))
+
+
+@_component("story_graph")
+def _build_story_graph():
+    from story_graph import build_story_graph
+
+    return build_story_graph()
+
+
+def _generate_opening():
+    from runtime import run_async
+    from story_graph import generate_opening
+
+    return run_async(generate_opening())
+
+
+class SetupPool:
+    """预生成的开局缓冲池。
+
+    后台线程持续调用 generate (默认 story_graph.generate_opening：初始/结束状态 + 开篇 + 第一个问题，与 app 相同)，
+    把池子补满到 size 个；take() 立即取出一份开局，玩家开始新冒险时不需要等待任何调用；
+    池为空时返回 None，由调用方回退到实时生成。
+    """
+
+    def __init__(self, size: int = 3, retry_interval: float = 5.0, generate: Optional[Callable[[], object]] = None):
+        self.size = size
+        self.generate = generate or _generate_opening
+        self.retry_interval = retry_interval
+        self._setups: queue.Queue = queue.Queue(maxsize=size)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self) -> "SetupPool":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refill_forever, name="setup-pool", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def take(self):
+        try:
+            setup = self._setups.get_nowait()
+            self.hits += 1
+        except queue.Empty:
+            setup = None
+            self.misses += 1
+        self._wakeup.set()
+        return setup
+
+    def _refill_forever(self):
+        while not self._stopped.is_set():
+            if self._setups.full():
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                self._setups.put_nowait(self.generate())
+            except queue.Full:
+                pass
+            except Exception:
+                time.sleep(self.retry_interval)
 
 
 # 示例用法 (这部分代码后续会整合到streamlit应用中)
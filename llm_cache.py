@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableLambda
+from pydantic import BaseModel
+
+# 默认缓存文件放在项目根目录的 .cache 下，可通过环境变量覆盖
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "llm_cache.sqlite3")
+
+
+# cached_llm 每次调用期间的标记，解析器调用 skip_cache() 后本次结果照常返回但不写入缓存
+_skip_cache: ContextVar[Optional[dict]] = ContextVar("skip_cache", default=None)
+
+
+def skip_cache():
+    """在 cached_llm 内部调用：本次结果不写入缓存 (例如输出被截断、只做了部分修复)"""
+    flag = _skip_cache.get()
+    if flag is not None:
+        flag["skip"] = True
+
+
+def make_cache_key(prompt_text: str, model: str, temperature: Optional[float], schema: str) -> str:
+    """渲染后的提示词 + 模型名 + 温度 + 输出结构 的哈希"""
+    payload = json.dumps([prompt_text, model, temperature, schema], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """基于 SQLite 的 LLM 响应缓存，支持 TTL 和按最近访问时间的 LRU 淘汰。
+
+    统计条目数需要扫描整个表，因此每 evict_every 次写入才检查一次容量，条目数最多短暂超出 max_entries 这么多条；
+    不在内存中维护计数，是因为多个进程可能共用同一个缓存文件。
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl: Optional[float] = None, max_entries: int = 100_000,
+                 evict_every: int = 100):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        overflow = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """进程级共享的缓存实例，路径/TTL/容量可通过环境变量配置"""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            ttl = os.getenv("LLM_CACHE_TTL")
+            _response_cache = ResponseCache(
+                path=os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+                ttl=float(ttl) if ttl else None,
+                max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000")),
+            )
+        return _response_cache
+
+
+def _schema_of(parser) -> str:
+    model = getattr(parser, "pydantic_object", None)
+    if model is not None:
+        return json.dumps(model.model_json_schema(), sort_keys=True, ensure_ascii=False)
+    try:
+        return parser.get_format_instructions()
+    except (AttributeError, NotImplementedError):
+        return type(parser).__name__
+
+
+def _dump(value: Any) -> str:
+    if isinstance(value, BaseModel):
+        return value.model_dump_json()
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _load(parser, raw: str) -> Any:
+    model = getattr(parser, "pydantic_object", None)
+    if model is not None:
+        return model.model_validate_json(raw)
+    return json.loads(raw)
+
+
+def cached_llm(llm, parser, cache: Optional[ResponseCache] = None, bypass: bool = False,
+               native: bool = False, name: str = "output") -> Runnable:
+    """把 llm | parser 包装成带缓存的 Runnable，用法: prompt | cached_llm(llm, parser)
+
+    只缓存解析成功的结果，解析失败会照常抛出异常，重试时重新请求；解析器调用了 skip_cache() 的结果也不缓存。
+    bypass=True（或设置环境变量 LLM_CACHE_DISABLED=1）时直接调用，适用于每次都需要新内容的创作类调用。
+    native=True 时改用模型原生的结构化输出 (见 structured.py)，结果类型与 parser 相同。
+    """
+    if native:
+        from structured import native_output
+
+        chain = native_output(llm, parser, name)
+    else:
+        chain = llm | parser
+    if bypass or os.getenv("LLM_CACHE_DISABLED") == "1":
+        return chain
+
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+    temperature = getattr(llm, "temperature", None)
+    schema = ("native:" if native else "") + _schema_of(parser)
+
+    def _key(prompt_value) -> str:
+        text = prompt_value.to_string() if isinstance(prompt_value, PromptValue) else str(prompt_value)
+        return make_cache_key(text, model, temperature, schema)
+
+    def _invoke(prompt_value, config):
+        response_cache = cache or get_response_cache()
+        key = _key(prompt_value)
+        raw = response_cache.get(key)
+        if raw is not None:
+            return _load(parser, raw)
+        flag = {}
+        token = _skip_cache.set(flag)
+        try:
+            result = chain.invoke(prompt_value, config)
+        finally:
+            _skip_cache.reset(token)
+        if not flag:
+            response_cache.set(key, _dump(result))
+        return result
+
+    async def _ainvoke(prompt_value, config):
+        # SQLite 的读写 (以及每 evict_every 次写入一次的淘汰扫描) 会阻塞，放到线程池中执行，
+        # 不占用共享的后台事件循环，其他会话的流式输出和对冲计时不受影响
+        response_cache = cache or await asyncio.to_thread(get_response_cache)
+        key = _key(prompt_value)
+        raw = await asyncio.to_thread(response_cache.get, key)
+        if raw is not None:
+            return _load(parser, raw)
+        flag = {}
+        token = _skip_cache.set(flag)
+        try:
+            result = await chain.ainvoke(prompt_value, config)
+        finally:
+            _skip_cache.reset(token)
+        if not flag:
+            await asyncio.to_thread(response_cache.set, key, _dump(result))
+        return result
+
+    return RunnableLambda(_invoke, afunc=_ainvoke, name="cached_llm")
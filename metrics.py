@@ -0,0 +1,314 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.exceptions import OutputParserException
+from langchain_core.outputs import LLMResult
+
+# 每百万 token 的美元价格 (输入, 输出)，用于估算成本
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4.1": (2.0, 8.0),
+    "gpt-4.1-mini": (0.4, 1.6),
+    "gpt-4.1-nano": (0.1, 0.4),
+}
+
+# 命中服务端提示词缓存的输入 token 的价格 (每百万 token)，未列出的模型不打折
+CACHED_INPUT_PRICES = {
+    "gpt-4o-mini": 0.075,
+    "gpt-4o": 1.25,
+    "gpt-4.1": 0.5,
+    "gpt-4.1-mini": 0.1,
+    "gpt-4.1-nano": 0.025,
+}
+
+# 解析失败后的修复层级 (见 output_repair.py)
+REPAIR_TIERS = ("local", "partial", "llm", "failed")
+
+# 模型路由的计数 (见 router.py)：发出的对冲请求、对冲请求先返回的次数、级联升级次数、超出时限次数
+ROUTING_COUNTERS = ("hedges", "hedge_wins", "escalations", "budget_exceeded")
+
+# 发送前的 token 预算 (见 token_budget.py)：输入超出预算后裁剪成功 / 被拒绝的次数
+TOKEN_BUDGET_COUNTERS = ("trimmed", "rejected")
+
+# 进行中的调用超过此数量时，清理开始于 STALE_RUN_SECONDS 秒之前、已不会结束的调用
+STALE_RUNS_CHECK = 1000
+STALE_RUN_SECONDS = 3600
+
+DEFAULT_METRICS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "metrics.jsonl")
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    # 带日期后缀的模型名 (如 gpt-4o-mini-2024-07-18) 按最长前缀匹配
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model and model.startswith(name):
+            input_price, output_price = MODEL_PRICES[name]
+            cached_price = CACHED_INPUT_PRICES.get(name, input_price)
+            return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+                    + completion_tokens * output_price) / 1_000_000
+    return 0.0
+
+
+class MetricsRecorder:
+    """收集每次 LLM 调用的指标，写入 JSONL 并提供按 chain 汇总的统计"""
+
+    def __init__(self, path: Optional[str] = DEFAULT_METRICS_PATH, max_records: int = 100_000):
+        self.path = path
+        self.records: deque = deque(maxlen=max_records)
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.connections: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def record(self, record: Dict[str, Any]):
+        with self._lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def count(self, chain: str, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[chain][name] += amount
+
+    def count_retry(self, chain: str):
+        self.count(chain, "retries")
+
+    def count_connection(self, name: str, amount: int = 1):
+        with self._lock:
+            self.connections[name] += amount
+
+    def connection_summary(self) -> Dict[str, Any]:
+        """共享连接池的 HTTP 请求数、新建连接数和连接复用率"""
+        with self._lock:
+            requests = self.connections.get("requests", 0)
+            opened = self.connections.get("connections_opened", 0)
+        return {
+            "requests": requests,
+            "connections_opened": opened,
+            "reuse_rate": max(requests - opened, 0) / requests if requests else None,
+        }
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """按 chain 汇总：调用数、错误/重试/解析失败/结构化输出兜底/各级修复次数、延迟与首 token 延迟分位数、token 吞吐和成本"""
+        with self._lock:
+            records = list(self.records)
+            counters = {chain: dict(values) for chain, values in self.counters.items()}
+        grouped: Dict[str, List[dict]] = defaultdict(list)
+        for record in records:
+            grouped[record["chain"]].append(record)
+        summary = {}
+        for chain in sorted(set(grouped) | set(counters)):
+            calls = grouped.get(chain, [])
+            latencies = [r["latency"] for r in calls if r.get("latency") is not None]
+            ttfts = [r["ttft"] for r in calls if r.get("ttft") is not None]
+            prompt_tokens = sum(r.get("prompt_tokens") or 0 for r in calls)
+            cached_tokens = sum(r.get("cached_tokens") or 0 for r in calls)
+            completion_tokens = sum(r.get("completion_tokens") or 0 for r in calls)
+            busy = sum(latencies)
+            summary[chain] = {
+                "calls": len(calls),
+                "errors": sum(1 for r in calls if r.get("error")),
+                "retries": counters.get(chain, {}).get("retries", 0),
+                "parse_failures": counters.get(chain, {}).get("parse_failures", 0),
+                "fallbacks": counters.get(chain, {}).get("fallbacks", 0),
+                **{name: counters.get(chain, {}).get(name, 0) for name in ROUTING_COUNTERS + TOKEN_BUDGET_COUNTERS},
+                **{f"repair_{tier}": counters.get(chain, {}).get(f"repair_{tier}", 0) for tier in REPAIR_TIERS},
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p95": percentile(latencies, 0.95),
+                "latency_p99": percentile(latencies, 0.99),
+                "ttft_p50": percentile(ttfts, 0.5),
+                "ttft_p95": percentile(ttfts, 0.95),
+                "prompt_tokens": prompt_tokens,
+                "cached_tokens": cached_tokens,
+                "cached_ratio": cached_tokens / prompt_tokens if prompt_tokens else None,
+                "completion_tokens": completion_tokens,
+                "completion_tokens_per_sec": completion_tokens / busy if busy else None,
+                "cost_usd": round(sum(r.get("cost_usd") or 0 for r in calls), 6),
+            }
+        return summary
+
+    def format_summary(self) -> str:
+        lines = []
+        for chain, stats in self.summary().items():
+            def fmt(value, digits=2):
+                return "-" if value is None else f"{value:.{digits}f}"
+            lines.append(
+                f"{chain}: calls={stats['calls']} errors={stats['errors']} retries={stats['retries']} "
+                f"parse_failures={stats['parse_failures']} fallbacks={stats['fallbacks']} "
+                f"hedges(sent/won)={stats['hedges']}/{stats['hedge_wins']} "
+                f"escalations={stats['escalations']} budget_exceeded={stats['budget_exceeded']} "
+                f"trimmed/rejected={stats['trimmed']}/{stats['rejected']} "
+                f"repairs(local/partial/llm/failed)={'/'.join(str(stats[f'repair_{tier}']) for tier in REPAIR_TIERS)} "
+                f"latency p50/p95/p99={fmt(stats['latency_p50'])}/{fmt(stats['latency_p95'])}/{fmt(stats['latency_p99'])}s "
+                f"ttft p50={fmt(stats['ttft_p50'])}s "
+                f"tokens={stats['prompt_tokens']}+{stats['completion_tokens']} cached={fmt(stats['cached_ratio'], 2)} "
+                f"tokens/s={fmt(stats['completion_tokens_per_sec'], 1)} cost=${stats['cost_usd']:.4f}"
+            )
+        connections = self.connection_summary()
+        if connections["requests"]:
+            lines.append(
+                f"http: requests={connections['requests']} connections_opened={connections['connections_opened']} "
+                f"reuse_rate={connections['reuse_rate']:.1%}"
+            )
+        return "\n".join(lines)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """LangChain 回调：记录每次模型调用的 token、首 token 延迟、总延迟、错误，以及输出解析失败"""
+
+    run_inline = True
+
+    def __init__(self, recorder: MetricsRecorder):
+        self.recorder = recorder
+        self._runs: Dict[UUID, Dict[str, Any]] = {}
+        # run_id -> (链名, 开始时间)
+        self._chains: Dict[UUID, Tuple[str, float]] = {}
+        self._counted_errors: deque = deque(maxlen=1000)
+        # 回调可能来自多个线程 (同步调用在线程池中执行)，进行中的调用表由此锁保护
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chain_of(metadata: Optional[dict]) -> str:
+        return (metadata or {}).get("chain", "unknown")
+
+    @staticmethod
+    def _prune(runs: dict, started_at):
+        """被取消的调用 (如对冲请求中落败的一方) 不一定触发结束或出错回调，进行中的调用过多时清理过期的"""
+        if len(runs) >= STALE_RUNS_CHECK:
+            stale_before = time.perf_counter() - STALE_RUN_SECONDS
+            for stale in [key for key, run in runs.items() if started_at(run) < stale_before]:
+                del runs[stale]
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs):
+        with self._lock:
+            self._prune(self._chains, lambda chain: chain[1])
+            self._chains[run_id] = (self._chain_of(metadata), time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs):
+        with self._lock:
+            self._chains.pop(run_id, None)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        # 取消 (CancelledError) 也经由此回调，同样移除
+        with self._lock:
+            chain, _ = self._chains.pop(run_id, ("unknown", None))
+            # 解析异常会沿调用链逐层上抛，只在第一次看到时计数
+            if not isinstance(error, OutputParserException) or id(error) in self._counted_errors:
+                return
+            self._counted_errors.append(id(error))
+        self.recorder.count(chain, "parse_failures")
+
+    def _start(self, run_id: UUID, metadata: Optional[dict], kwargs: dict):
+        params = kwargs.get("invocation_params") or {}
+        with self._lock:
+            self._prune(self._runs, lambda run: run["started_at"])
+            self._runs[run_id] = {
+                "chain": self._chain_of(metadata),
+                "model": params.get("model_name") or params.get("model"),
+                "started_at": time.perf_counter(),
+                "first_token_at": None,
+            }
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs):
+        self._start(run_id, metadata, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs):
+        self._start(run_id, metadata, kwargs)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is not None and run["first_token_at"] is None:
+                run["first_token_at"] = time.perf_counter()
+
+    def _finish(self, run_id: UUID, **fields):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        now = time.perf_counter()
+        self.recorder.record({
+            "timestamp": time.time(),
+            "chain": run["chain"],
+            "model": run["model"],
+            "latency": now - run["started_at"],
+            "ttft": run["first_token_at"] - run["started_at"] if run["first_token_at"] else None,
+            **fields,
+        })
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        if prompt_tokens is None:
+            # 流式调用没有 llm_output，从消息的 usage_metadata 中读取
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                    if metadata:
+                        prompt_tokens = (prompt_tokens or 0) + metadata.get("input_tokens", 0)
+                        completion_tokens = (completion_tokens or 0) + metadata.get("output_tokens", 0)
+                        cached_tokens += (metadata.get("input_token_details") or {}).get("cache_read") or 0
+        with self._lock:
+            model = (response.llm_output or {}).get("model_name") or (self._runs.get(run_id) or {}).get("model")
+        self._finish(
+            run_id,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens,
+            cost_usd=estimate_cost(model, prompt_tokens or 0, completion_tokens or 0, cached_tokens),
+            error=None,
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        self._finish(run_id, prompt_tokens=None, completion_tokens=None, cached_tokens=None, cost_usd=0.0,
+                     error=repr(error))
+
+
+_recorder: Optional[MetricsRecorder] = None
+_handler: Optional[MetricsCallbackHandler] = None
+_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRecorder:
+    """进程级共享的指标收集器，METRICS_PATH 为空字符串时不写文件"""
+    global _recorder, _handler
+    with _lock:
+        if _recorder is None:
+            _recorder = MetricsRecorder(path=os.getenv("METRICS_PATH", DEFAULT_METRICS_PATH) or None)
+            _handler = MetricsCallbackHandler(_recorder)
+        return _recorder
+
+
+def get_metrics_handler() -> MetricsCallbackHandler:
+    get_metrics()
+    return _handler
+
+
+def instrument(chain_name: str) -> dict:
+    """chain.with_config(instrument("名称"))：为 chain 及其子调用挂上指标回调并标注名称"""
+    return {
+        "run_name": chain_name,
+        "metadata": {"chain": chain_name},
+        "callbacks": [get_metrics_handler()],
+    }
@@ -0,0 +1,503 @@
+"""本地模拟的 OpenAI 兼容服务，用于在没有网络/密钥时调试和测试。
+
+支持的接口：
+- POST /v1/chat/completions
+- POST /v1/files, GET /v1/files/{id}, GET /v1/files/{id}/content
+- POST /v1/batches, GET /v1/batches/{id}
+
+返回内容根据提示词中的格式说明自动生成：PydanticOutputParser 的 JSON schema、
+StructuredOutputParser 的字段列表，否则返回一段 <script> 包裹的文本。
+请求带 response_format (json_schema) 或强制的 tools 调用时，按其中的 schema 生成结构化回复。
+
+可模拟延迟分布、流式输出速率、错误/429 注入以及文本 JSON 的格式损坏 (截断、未转义引号、多余逗号)，
+随机数使用固定种子，结果可复现。
+
+还模拟了服务端的提示词前缀缓存：与 OpenAI 的规则一致，输入至少 1024 token 时按 128 token 递增匹配此前请求中
+出现过的最长前缀 (tools / response_format 在前，随后依次是各条消息)，命中部分记入 usage.prompt_tokens_details.cached_tokens；
+配合 --prefill-rate，未命中的输入 token 按该速率额外增加首 token 延迟。
+
+用法:
+    python mock_openai.py --port 8765 --latency lognormal --latency-mean 0.8 --rate-limit-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=mock python academy/category_journal.py --mode batch
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from aiohttp import web
+
+_SCHEMA_PATTERN = re.compile(r"Here is the output schema:\s*```\s*(\{.*?\})\s*```", re.S)
+_STRUCTURED_FIELD_PATTERN = re.compile(r'^\s*"(\w+)": (\w+(?:\[\w+\])?)\s*//', re.M)
+_PACKED_ITEM_PATTERN = re.compile(r"^\[(\d+)\] (.+)$", re.M)
+
+
+def _sample_from_schema(schema: Dict[str, Any], defs: Dict[str, Any], name: str = "value") -> Any:
+    if "$ref" in schema:
+        return _sample_from_schema(defs[schema["$ref"].split("/")[-1]], defs, name)
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {key: _sample_from_schema(value, defs, key) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_sample_from_schema(schema.get("items", {}), defs, name) for _ in range(5 if name == "questions" else 2)]
+    if kind == "boolean":
+        return True
+    if kind in ("integer", "number"):
+        return 1
+    return f"模拟的 {schema.get('description') or name}"
+
+
+def canned_content(prompt: str) -> str:
+    """根据提示词中的格式说明生成一个能被对应解析器解析的回复"""
+    match = _SCHEMA_PATTERN.search(prompt)
+    if match:
+        schema = json.loads(match.group(1))
+        sample = _sample_from_schema(schema, schema.get("$defs", {}))
+        return "```json\n" + json.dumps(sample, ensure_ascii=False) + "\n```"
+    fields = _STRUCTURED_FIELD_PATTERN.findall(prompt)
+    if fields:
+        sample = {}
+        for key, kind in fields:
+            if kind == "boolean":
+                sample[key] = True
+            elif kind in ("integer", "number", "float"):
+                sample[key] = 1
+            elif kind.startswith("List"):
+                sample[key] = ["mock"]
+            else:
+                sample[key] = f"mock {key}"
+        if "JSON array" in prompt:
+            # 打包请求：为提示词中每个 "[id] 名称" 条目返回一个对象
+            items = _PACKED_ITEM_PATTERN.findall(prompt)
+            return "```json\n" + json.dumps(
+                [{**sample, "id": int(index), "title": title} for index, title in items], ensure_ascii=False
+            ) + "\n```"
+        return "```json\n" + json.dumps(sample, ensure_ascii=False) + "\n```"
+    return "<script>\n这是模拟服务生成的剧本内容。\n</script>"
+
+
+def structured_response(body: Dict[str, Any]) -> Optional[Tuple[Optional[str], Optional[Dict[str, Any]]]]:
+    """原生结构化输出：返回 (content, tool_call)；请求未要求结构化输出时返回 None"""
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"]["schema"]
+        return json.dumps(_sample_from_schema(schema, schema.get("$defs", {})), ensure_ascii=False), None
+    tools = body.get("tools") or []
+    choice = body.get("tool_choice")
+    if not tools or choice in (None, "none", "auto"):
+        return None
+    name = choice["function"]["name"] if isinstance(choice, dict) else tools[0]["function"]["name"]
+    function = next((tool["function"] for tool in tools if tool["function"]["name"] == name), tools[0]["function"])
+    schema = function.get("parameters", {})
+    arguments = json.dumps(_sample_from_schema(schema, schema.get("$defs", {})), ensure_ascii=False)
+    return None, {"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                  "function": {"name": function["name"], "arguments": arguments}}
+
+
+def corrupt_json(content: str, rng: random.Random) -> str:
+    """模拟模型输出的常见格式问题：截断、字符串中未转义的引号、末尾多余的逗号"""
+    kind = rng.choice(["truncate", "quote", "trailing_comma"])
+    if kind == "truncate":
+        return content[:max(1, int(len(content) * 0.85))]
+    if kind == "quote":
+        match = re.search(r'": "', content)
+        if match:
+            return content[:match.end()] + '他说"快跑"，' + content[match.end():]
+    return re.sub(r"(\S)(\s*[}\]]\s*(?:```)?\s*)$", r"\1,\2", content, count=1)
+
+
+def _prompt_of(body: Dict[str, Any]) -> str:
+    parts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        parts.append(content or "")
+    return "\n".join(parts)
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _prefix_text(body: Dict[str, Any]) -> str:
+    """请求中参与前缀缓存的内容，顺序与服务端处理的顺序一致"""
+    schema = body.get("tools") or body.get("response_format")
+    parts = [json.dumps(schema, ensure_ascii=False, separators=(",", ":"))] if schema else []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        parts.append(f"<|{message.get('role')}|>{content or ''}")
+    return "".join(parts)
+
+
+class PrefixCache:
+    """按 block_tokens 为粒度记录见过的前缀哈希，lookup 返回最长的已缓存前缀 token 数 (与 _count_tokens 同一口径)"""
+
+    def __init__(self, min_tokens: int = 1024, block_tokens: int = 128, max_entries: int = 100_000):
+        self.min_tokens = min_tokens
+        self.block_tokens = block_tokens
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+
+    def lookup(self, text: str) -> int:
+        cached = 0
+        for tokens in range(self.min_tokens, len(text) // 4 + 1, self.block_tokens):
+            key = hash(text[:tokens * 4])
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                cached = tokens
+            else:
+                self._seen[key] = None
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+        return cached
+
+
+def chat_completion(body: Dict[str, Any], content: Optional[str] = None,
+                    tool_call: Optional[Dict[str, Any]] = None, cached_tokens: int = 0) -> Dict[str, Any]:
+    prompt = _prompt_of(body)
+    if content is None and tool_call is None:
+        content = canned_content(prompt)
+    # 与真实服务一样，结构化输出的 schema / 工具定义也计入输入 token
+    schema = body.get("response_format") or body.get("tools")
+    prompt_tokens = _count_tokens(prompt) + (_count_tokens(json.dumps(schema, ensure_ascii=False, separators=(",", ":"))) if schema else 0)
+    completion_tokens = _count_tokens(content or tool_call["function"]["arguments"])
+    message = {"role": "assistant", "content": content}
+    if tool_call is not None:
+        message["tool_calls"] = [tool_call]
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": message,
+            "finish_reason": "tool_calls" if tool_call is not None else "stop",
+            "logprobs": None,
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)},
+        },
+    }
+
+
+class LatencyModel:
+    """请求延迟分布 (秒)：fixed 固定值；uniform 为 [mean-spread, mean+spread]；lognormal 以 mean 为中位数、sigma 为对数标准差"""
+
+    def __init__(self, kind: str = "fixed", mean: float = 0.0, spread: float = 0.0, sigma: float = 0.5):
+        self.kind = kind
+        self.mean = mean
+        self.spread = spread
+        self.sigma = sigma
+
+    def sample(self, rng: random.Random) -> float:
+        if self.mean <= 0:
+            return 0.0
+        if self.kind == "uniform":
+            return max(0.0, rng.uniform(self.mean - self.spread, self.mean + self.spread))
+        if self.kind == "lognormal":
+            return rng.lognormvariate(math.log(self.mean), self.sigma)
+        return self.mean
+
+    def describe(self) -> dict:
+        return {"kind": self.kind, "mean": self.mean, "spread": self.spread, "sigma": self.sigma}
+
+
+class MockOpenAI:
+    """- latency: 首个 token (非流式时为整个回复) 的延迟分布
+    - chunk_rate / chunk_size: 流式输出时每秒发送的 chunk 数和每个 chunk 的字符数
+    - error_rate / rate_limit_rate: 随机返回 500 / 429 的概率
+    - malformed_rate: 非结构化输出模式下，把回复中的 JSON 随机损坏的概率
+    - prefix_cache: 提示词前缀缓存，None 表示不模拟
+    - prefill_rate: 每秒预填充的输入 token 数，未命中前缀缓存的部分按此增加首 token 延迟，0 表示不模拟
+    - slow_rate / slow_latency: 以 slow_rate 的概率额外等待 slow_latency 秒，模拟偶发的长尾请求
+    - responder: 自定义回复函数 (提示词 -> 回复文本)，默认 canned_content
+    """
+
+    def __init__(self, batch_delay: float = 1.0, latency: Optional[LatencyModel] = None,
+                 chunk_rate: float = 50.0, chunk_size: int = 4, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, malformed_rate: float = 0.0, seed: int = 0,
+                 responder: Optional[Callable[[str], str]] = None, prefix_cache: Optional[PrefixCache] = None,
+                 prefill_rate: float = 0.0, slow_rate: float = 0.0, slow_latency: float = 0.0):
+        self.batch_delay = batch_delay
+        self.latency = latency or LatencyModel()
+        self.chunk_rate = chunk_rate
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.responder = responder or canned_content
+        self.prefix_cache = prefix_cache
+        self.prefill_rate = prefill_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.stats: Counter = Counter()
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=512 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        app.router.add_post("/v1/files", self.handle_upload_file)
+        app.router.add_get("/v1/files/{file_id}", self.handle_retrieve_file)
+        app.router.add_get("/v1/files/{file_id}/content", self.handle_file_content)
+        app.router.add_post("/v1/batches", self.handle_create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.handle_retrieve_batch)
+        return app
+
+    async def handle_chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": "0.1"},
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"error": {"message": "Internal error (mock)", "type": "server_error"}}, status=500)
+
+        delay = self.latency.sample(self.rng)
+        completion = self._complete(body)
+        if self.prefill_rate > 0:
+            usage = completion["usage"]
+            delay += (usage["prompt_tokens"] - usage["prompt_tokens_details"]["cached_tokens"]) / self.prefill_rate
+        if self.slow_rate and self.rng.random() < self.slow_rate:
+            self.stats["slow"] += 1
+            delay += self.slow_latency
+        if not body.get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response(completion)
+        await asyncio.sleep(delay)
+        return await self._stream(request, body, completion)
+
+    def _complete(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        cached_tokens = self.prefix_cache.lookup(_prefix_text(body)) if self.prefix_cache else 0
+        structured = structured_response(body)
+        if structured is not None:
+            self.stats["structured"] += 1
+            completion = chat_completion(body, *structured, cached_tokens=cached_tokens)
+        else:
+            content = self.responder(_prompt_of(body))
+            if self.malformed_rate and "{" in content and self.rng.random() < self.malformed_rate:
+                self.stats["malformed"] += 1
+                content = corrupt_json(content, self.rng)
+            completion = chat_completion(body, content, cached_tokens=cached_tokens)
+        self.stats["prompt_tokens"] += completion["usage"]["prompt_tokens"]
+        self.stats["cached_tokens"] += completion["usage"]["prompt_tokens_details"]["cached_tokens"]
+        return completion
+
+    async def _stream(self, request: web.Request, body: Dict[str, Any], completion: Dict[str, Any]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        message = completion["choices"][0]["message"]
+        tool_call = (message.get("tool_calls") or [None])[0]
+        content = message["content"] if tool_call is None else tool_call["function"]["arguments"]
+        base = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"], "model": completion["model"]}
+
+        async def send(payload):
+            await response.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        def delta(piece):
+            if tool_call is None:
+                return {"content": piece}
+            return {"tool_calls": [{"index": 0, "function": {"arguments": piece}}]}
+
+        first = {"role": "assistant", "content": "" if tool_call is None else None}
+        if tool_call is not None:
+            first["tool_calls"] = [{"index": 0, "id": tool_call["id"], "type": "function",
+                                    "function": {"name": tool_call["function"]["name"], "arguments": ""}}]
+        await send({**base, "choices": [{"index": 0, "delta": first, "finish_reason": None}]})
+        interval = 1 / self.chunk_rate if self.chunk_rate > 0 else 0
+        for start in range(0, len(content), self.chunk_size):
+            await send({**base, "choices": [{"index": 0, "delta": delta(content[start:start + self.chunk_size]), "finish_reason": None}]})
+            if interval:
+                await asyncio.sleep(interval)
+        finish_reason = completion["choices"][0]["finish_reason"]
+        await send({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send({**base, "choices": [], "usage": completion["usage"]})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _store_file(self, filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = {
+            "meta": {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed",
+            },
+            "content": content,
+        }
+        return self.files[file_id]["meta"]
+
+    async def handle_upload_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        meta = self._store_file(upload.filename, form.get("purpose", "batch"), upload.file.read())
+        return web.json_response(meta)
+
+    async def handle_retrieve_file(self, request: web.Request) -> web.Response:
+        file = self.files.get(request.match_info["file_id"])
+        if file is None:
+            raise web.HTTPNotFound()
+        return web.json_response(file["meta"])
+
+    async def handle_file_content(self, request: web.Request) -> web.Response:
+        file = self.files.get(request.match_info["file_id"])
+        if file is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=file["content"], content_type="application/jsonl")
+
+    async def handle_create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body["input_file_id"] not in self.files:
+            raise web.HTTPNotFound()
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "metadata": body.get("metadata"),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        asyncio.get_running_loop().create_task(self._process_batch(batch_id))
+        return web.json_response(self.batches[batch_id])
+
+    async def handle_retrieve_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            raise web.HTTPNotFound()
+        return web.json_response(batch)
+
+    async def _process_batch(self, batch_id: str):
+        batch = self.batches[batch_id]
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        batch["status"] = "in_progress"
+        batch["in_progress_at"] = int(time.time())
+        await asyncio.sleep(self.batch_delay)
+        outputs, errors = [], []
+        for line in lines:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            batch["request_counts"]["total"] += 1
+            try:
+                response = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self._complete(entry["body"])}
+                outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": entry["custom_id"], "response": response, "error": None})
+                batch["request_counts"]["completed"] += 1
+            except Exception as e:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": entry.get("custom_id"), "response": None,
+                               "error": {"code": "mock_error", "message": str(e)}})
+                batch["request_counts"]["failed"] += 1
+        if outputs:
+            content = "".join(json.dumps(o, ensure_ascii=False) + "\n" for o in outputs).encode("utf-8")
+            batch["output_file_id"] = self._store_file("batch_output.jsonl", "batch_output", content)["id"]
+        if errors:
+            content = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in errors).encode("utf-8")
+            batch["error_file_id"] = self._store_file("batch_errors.jsonl", "batch_output", content)["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+
+def start_in_thread(mock: MockOpenAI, host: str = "127.0.0.1", port: int = 0) -> Tuple[str, Callable[[], None]]:
+    """在后台线程中启动模拟服务，返回 (base_url, stop)。port=0 时自动选择空闲端口"""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    state = {}
+
+    async def start():
+        runner = web.AppRunner(mock.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        state["runner"] = runner
+        state["port"] = runner.addresses[0][1]
+        started.set()
+
+    thread = threading.Thread(target=loop.run_forever, name="mock-openai", daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(start(), loop)
+    started.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(state["runner"].cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return f"http://{host}:{state['port']}/v1", stop
+
+
+def add_mock_arguments(arg_parser: argparse.ArgumentParser):
+    arg_parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="fixed", help="延迟分布")
+    arg_parser.add_argument("--latency-mean", type=float, default=0.0, help="延迟的均值/中位数 (秒)")
+    arg_parser.add_argument("--latency-spread", type=float, default=0.0, help="uniform 分布的半宽 (秒)")
+    arg_parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal 分布的对数标准差")
+    arg_parser.add_argument("--chunk-rate", type=float, default=50.0, help="流式输出每秒的 chunk 数")
+    arg_parser.add_argument("--chunk-size", type=int, default=4, help="流式输出每个 chunk 的字符数")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的概率")
+    arg_parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回 429 的概率")
+    arg_parser.add_argument("--malformed-rate", type=float, default=0.0, help="文本回复中的 JSON 被损坏的概率")
+    arg_parser.add_argument("--prefix-cache-min-tokens", type=int, default=1024,
+                            help="输入达到该 token 数才参与前缀缓存 (OpenAI 为 1024)，0 表示不模拟前缀缓存")
+    arg_parser.add_argument("--prefill-rate", type=float, default=0.0,
+                            help="每秒预填充的输入 token 数，未命中缓存的部分按此增加首 token 延迟，0 表示不模拟")
+    arg_parser.add_argument("--slow-rate", type=float, default=0.0, help="请求额外变慢的概率，模拟长尾延迟")
+    arg_parser.add_argument("--slow-latency", type=float, default=5.0, help="变慢的请求额外等待的秒数")
+    arg_parser.add_argument("--seed", type=int, default=0)
+
+
+def mock_from_args(args: argparse.Namespace, **kwargs) -> MockOpenAI:
+    return MockOpenAI(
+        latency=LatencyModel(args.latency, args.latency_mean, args.latency_spread, args.latency_sigma),
+        chunk_rate=args.chunk_rate,
+        chunk_size=args.chunk_size,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+        prefix_cache=PrefixCache(min_tokens=args.prefix_cache_min_tokens) if args.prefix_cache_min_tokens > 0 else None,
+        prefill_rate=args.prefill_rate,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容服务")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--batch-delay", type=float, default=1.0, help="批处理任务的模拟处理时长 (秒)")
+    add_mock_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    web.run_app(mock_from_args(args, batch_delay=args.batch_delay).app(), host=args.host, port=args.port)
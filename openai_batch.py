@@ -0,0 +1,109 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# 终态：到达后不再轮询
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchRequestError(Exception):
+    """批处理中单个请求失败"""
+
+
+def write_batch_requests(path: str, prompts: Iterable[Tuple[str, Union[str, List[dict]]]], model: str,
+                         temperature: Optional[float] = None, **body) -> int:
+    """把 (custom_id, 提示词) 写成 /v1/chat/completions 批处理请求文件，返回请求数。
+
+    提示词可以是字符串 (作为一条 user 消息)，也可以是完整的 messages 列表 (例如 system 前缀 + user 后缀)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, prompt in prompts:
+            messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+            request_body = {"model": model, "messages": messages, **body}
+            if temperature is not None:
+                request_body["temperature"] = temperature
+            f.write(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": request_body,
+            }, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+async def submit_batch(client: openai.AsyncOpenAI, requests_path: str, metadata: Optional[dict] = None) -> str:
+    with open(requests_path, "rb") as f:
+        uploaded = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata=metadata,
+    )
+    logger.info(f"已提交批处理任务: {batch.id}")
+    return batch.id
+
+
+async def wait_for_batch(client: openai.AsyncOpenAI, batch_id: str, poll_interval: float = 30.0):
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        progress = f"{counts.completed}/{counts.total}" if counts else "-"
+        logger.info(f"批处理任务 {batch_id} 状态: {batch.status}，进度: {progress}")
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        await asyncio.sleep(poll_interval)
+
+
+async def download_batch_results(client: openai.AsyncOpenAI, batch) -> Dict[str, Union[str, BatchRequestError]]:
+    """下载结果文件，返回 custom_id -> 回复文本 (失败时为 BatchRequestError)"""
+    results: Dict[str, Union[str, BatchRequestError]] = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await client.files.content(file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            if entry.get("error") or response.get("status_code") != 200:
+                results[entry["custom_id"]] = BatchRequestError(entry.get("error") or response.get("body"))
+                continue
+            results[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+
+async def run_batch(requests_path: str, client: Optional[openai.AsyncOpenAI] = None,
+                    poll_interval: float = 30.0) -> Dict[str, Union[str, BatchRequestError]]:
+    """提交请求文件并等待完成，返回 custom_id -> 回复文本。
+
+    batch id 记录在 <requests_path>.batch_id 中，进程中断后重新执行会继续轮询同一个任务，而不会重复提交。
+    """
+    client = client or openai.AsyncOpenAI()
+    state_path = requests_path + ".batch_id"
+    batch_id = None
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            batch_id = f.read().strip() or None
+    if batch_id:
+        logger.info(f"继续等待已提交的批处理任务: {batch_id}")
+    else:
+        batch_id = await submit_batch(client, requests_path)
+        with open(state_path, "w") as f:
+            f.write(batch_id)
+
+    batch = await wait_for_batch(client, batch_id, poll_interval)
+    os.remove(state_path)
+    if batch.status != "completed":
+        raise RuntimeError(f"批处理任务 {batch_id} 未完成，状态: {batch.status}")
+    return await download_batch_results(client, batch)
@@ -0,0 +1,202 @@
+"""解析失败时的逐级修复，避免为一次格式错误重新生成整段输出：
+
+1. local: 本地修复 JSON (未转义的引号/换行、多余的逗号、markdown 代码块)
+2. partial: 输出被截断时补全括号保留已完整生成的字段 (被截断的最后一个值丢弃)，或逐字段提取完整的字符串值；
+   这一级的结果可能缺少内容，不写入响应缓存
+3. llm: 最后才用小模型做一次 "修正这段 JSON" 的调用 (REPAIR_MODEL，默认 gpt-4o-mini，设为空字符串则不启用)
+
+每级修复成功或最终失败都会记入对应 chain 的 repair_local / repair_partial / repair_llm / repair_failed 指标。
+
+PackedOutputParser 用于打包调用 (一次处理多个条目) 的 JSON 数组输出，只做前两级：缺失的条目由调用方重新排队。
+"""
+import json
+import os
+import typing
+from typing import Any, List, Optional
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.utils.json import parse_json_markdown
+from langchain_core.outputs import Generation
+from pydantic import PrivateAttr
+
+from llm_cache import skip_cache
+from metrics import get_metrics
+from partial_json import extract_string_fields, is_truncated, repair_json
+
+REPAIR_TEMPLATE = """The text below was supposed to be a single JSON object but it could not be parsed ({error}).
+Return the same content as valid JSON. Keep every value exactly as written; do not summarize, translate or shorten anything.
+
+<text>
+{text}
+</text>
+"""
+
+
+def _repair_model() -> str:
+    return os.getenv("REPAIR_MODEL", "gpt-4o-mini")
+
+
+class RepairingOutputParser(BaseOutputParser):
+    """包装 PydanticOutputParser / StructuredOutputParser：先按原解析器解析，失败后逐级修复"""
+
+    inner: BaseOutputParser
+    chain_name: str
+    fix_model: Optional[str] = None
+    _fix_chain: Any = PrivateAttr(default=None)
+
+    @property
+    def _type(self) -> str:
+        return "repairing"
+
+    @property
+    def OutputType(self):
+        return self.inner.OutputType
+
+    # 与被包装的解析器保持相同的输出结构，供缓存和原生结构化输出使用
+    @property
+    def pydantic_object(self):
+        return getattr(self.inner, "pydantic_object", None)
+
+    @property
+    def response_schemas(self):
+        return getattr(self.inner, "response_schemas", None)
+
+    def get_format_instructions(self) -> str:
+        return self.inner.get_format_instructions()
+
+    def _count(self, tier: str):
+        get_metrics().count(self.chain_name, f"repair_{tier}")
+
+    def _string_fields(self) -> List[str]:
+        if self.pydantic_object is not None:
+            return [name for name, field in self.pydantic_object.model_fields.items() if field.annotation is str]
+        return [schema.name for schema in self.response_schemas or [] if schema.type == "string"]
+
+    def _parse_complete(self, text: str) -> Any:
+        # 原解析器会补全被截断的 JSON 照常解析，把半个值 (如 "Comput") 当作完整结果；截断的输出交给修复流程
+        if is_truncated(text):
+            raise OutputParserException("输出的 JSON 被截断", llm_output=text)
+        return self.inner.parse(text)
+
+    def _repair_locally(self, text: str) -> Any:
+        try:
+            data, truncated = repair_json(text)
+            result = self.inner.parse(json.dumps(data, ensure_ascii=False))
+            self._count("partial" if truncated else "local")
+            if truncated:
+                skip_cache()
+            return result
+        except (ValueError, OutputParserException):
+            pass
+        fields = extract_string_fields(text, self._string_fields())
+        if fields:
+            try:
+                result = self.inner.parse(json.dumps(fields, ensure_ascii=False))
+                self._count("partial")
+                skip_cache()
+                return result
+            except OutputParserException:
+                pass
+        return None
+
+    def _get_fix_chain(self):
+        if self._fix_chain is None:
+            from langchain_core.prompts import ChatPromptTemplate
+            from langchain_openai import ChatOpenAI
+
+            from metrics import instrument
+            from runtime import get_http_clients
+            from structured import native_output
+
+            llm = ChatOpenAI(model=self.fix_model, temperature=0, **get_http_clients())
+            chain = ChatPromptTemplate.from_template(REPAIR_TEMPLATE) | native_output(llm, self.inner, self.chain_name)
+            self._fix_chain = chain.with_config(instrument(f"{self.chain_name}.repair"))
+        return self._fix_chain
+
+    def _fix_input(self, text: str, error: OutputParserException) -> dict:
+        return {"text": text, "error": str(error).splitlines()[0][:300]}
+
+    def parse(self, text: str) -> Any:
+        try:
+            return self._parse_complete(text)
+        except OutputParserException as error:
+            result = self._repair_locally(text)
+            if result is not None:
+                return result
+            if not self.fix_model:
+                self._count("failed")
+                raise
+            try:
+                result = self._get_fix_chain().invoke(self._fix_input(text, error))
+            except Exception:
+                self._count("failed")
+                raise error
+            self._count("llm")
+            return result
+
+    async def aparse(self, text: str) -> Any:
+        try:
+            return self._parse_complete(text)
+        except OutputParserException as error:
+            result = self._repair_locally(text)
+            if result is not None:
+                return result
+            if not self.fix_model:
+                self._count("failed")
+                raise
+            try:
+                result = await self._get_fix_chain().ainvoke(self._fix_input(text, error))
+            except Exception:
+                self._count("failed")
+                raise error
+            self._count("llm")
+            return result
+
+    async def aparse_result(self, result: typing.List[Generation], *, partial: bool = False) -> Any:
+        return await self.aparse(result[0].text)
+
+
+def repairing(parser: BaseOutputParser, chain_name: str, fix_model: Optional[str] = None) -> RepairingOutputParser:
+    """parser 的带修复版本；fix_model 为 None 时使用 REPAIR_MODEL"""
+    if isinstance(parser, RepairingOutputParser):
+        return parser
+    return RepairingOutputParser(inner=parser, chain_name=chain_name,
+                                 fix_model=_repair_model() if fix_model is None else fix_model)
+
+
+class PackedOutputParser(BaseOutputParser):
+    """打包调用的输出 -> 记录 (字典) 列表。输出可以是 JSON 数组、包含数组的对象或单个对象。
+
+    输出被截断时最后一条记录通常不完整 (如 {"id": 1, "category": "Comp"})，整条丢弃，本次结果也不写入响应缓存；
+    格式损坏且无法本地修复时抛出 OutputParserException。
+    """
+
+    chain_name: str
+
+    @property
+    def _type(self) -> str:
+        return "packed"
+
+    def parse(self, text: str) -> List[dict]:
+        # parse_json_markdown 会补全被截断的 JSON，因此先检查是否截断
+        truncated = is_truncated(text)
+        try:
+            if truncated:
+                raise ValueError("输出的 JSON 被截断")
+            records = parse_json_markdown(text)
+        except ValueError:
+            try:
+                records, truncated = repair_json(text)
+            except ValueError as e:
+                get_metrics().count(self.chain_name, "repair_failed")
+                raise OutputParserException(f"无法解析打包输出: {e}", llm_output=text) from e
+            get_metrics().count(self.chain_name, "repair_partial" if truncated else "repair_local")
+        if isinstance(records, dict):
+            records = next((value for value in records.values() if isinstance(value, list)), [records])
+        if not isinstance(records, list):
+            raise OutputParserException("打包输出不是 JSON 数组", llm_output=text)
+        if truncated:
+            records = records[:-1]
+            skip_cache()
+        return [record for record in records if isinstance(record, dict)]
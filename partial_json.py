@@ -0,0 +1,159 @@
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def extract_partial_json_string(text: str, key: str) -> Optional[str]:
+    """从可能尚未完整的 JSON 文本中提取字符串字段 key 当前已生成的部分。
+
+    字段值尚未开始时返回 None；末尾不完整的转义序列会被暂时忽略，等待后续 token。
+    """
+    value, _ = _scan_string(text, key)
+    return value
+
+
+def _scan_string(text: str, key: str) -> Tuple[Optional[str], bool]:
+    """字符串字段 key 的值 (已生成的部分) 以及它是否已经以引号结束"""
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), text)
+    if not match:
+        return None, False
+    chars = []
+    i = match.end()
+    while i < len(text):
+        ch = text[i]
+        if ch == '"':
+            return "".join(chars), True
+        if ch != '\\':
+            chars.append(ch)
+            i += 1
+            continue
+        if i + 1 >= len(text):
+            break
+        esc = text[i + 1]
+        if esc == 'u':
+            hex_digits = text[i + 2:i + 6]
+            if len(hex_digits) < 4:
+                break
+            try:
+                chars.append(chr(int(hex_digits, 16)))
+            except ValueError:
+                chars.append(hex_digits)
+            i += 6
+            continue
+        chars.append(_JSON_ESCAPES.get(esc, esc))
+        i += 2
+    return "".join(chars), False
+
+
+def strip_markdown(text: str) -> str:
+    """去掉 ```json 代码块标记 (结尾的标记可能因截断而缺失) 以及 JSON 之前的说明文字"""
+    fence = text.find("```")
+    if fence != -1:
+        text = text[fence + 3:]
+        if text[:4].lower() == "json":
+            text = text[4:]
+        end = text.find("```")
+        if end != -1:
+            text = text[:end]
+    starts = [position for position in (text.find("{"), text.find("[")) if position != -1]
+    return text[min(starts):].strip() if starts else text.strip()
+
+
+def _closes_string(text: str, i: int) -> bool:
+    """text[i] 是字符串内的引号：之后紧跟 JSON 结构字符时视为字符串结束，否则是内容中未转义的引号"""
+    rest = text[i + 1:].lstrip()
+    if not rest or rest[0] in "}]:":
+        return True
+    if rest[0] != ",":
+        return False
+    after = rest[1:].lstrip()
+    return not after or after[0] in '"{[]}-0123456789' or re.match(r"(true|false|null)\s*[,}\]]", after) is not None
+
+
+def _scan(text: str) -> Tuple[List[str], List[str], int]:
+    """逐字符修正 JSON 文本 (转义字符串内的引号和换行、去掉多余的逗号)，到最外层结束为止。
+
+    返回修正后的片段、尚未闭合的括号对应的闭括号、以及末尾未闭合的字符串在片段中的起点 (没有时为 -1)。
+    """
+    out: List[str] = []
+    closers: List[str] = []
+    in_string = False
+    string_start = 0
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                out.append(text[i:i + 2])
+                i += 2
+                continue
+            if ch == '"':
+                if _closes_string(text, i):
+                    in_string = False
+                    out.append(ch)
+                else:
+                    out.append('\\"')
+            elif ch in "\n\r\t":
+                out.append({"\n": "\\n", "\r": "\\r", "\t": "\\t"}[ch])
+            else:
+                out.append(ch)
+            i += 1
+            continue
+        if ch == '"':
+            in_string = True
+            string_start = len(out)
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            while out and (out[-1].isspace() or out[-1] == ","):
+                out.pop()
+            if closers:
+                closers.pop()
+            out.append(ch)
+            if not closers:
+                break
+            i += 1
+            continue
+        out.append(ch)
+        i += 1
+    return out, closers, string_start if in_string else -1
+
+
+def is_truncated(text: str) -> bool:
+    """模型输出的 JSON 是否在中途被截断 (字符串或括号未闭合)"""
+    _, closers, string_start = _scan(strip_markdown(text))
+    return bool(closers) or string_start >= 0
+
+
+def repair_json(text: str) -> Tuple[Any, bool]:
+    """本地修复模型输出的 JSON，返回 (解析结果, 是否经过截断补全)，无法修复时抛出 ValueError。
+
+    处理：markdown 代码块、字符串中未转义的引号和换行、对象/数组末尾多余的逗号、
+    输出被截断 (补全未闭合的括号，丢弃悬空的键和被截断的字符串)。
+    被截断的字符串值 (如 "category": "Comput") 整个丢弃而不是补上引号，以免把半个值当作完整结果；
+    需要流式显示已生成部分时使用 extract_partial_json_string。
+    """
+    out, closers, string_start = _scan(strip_markdown(text))
+    truncated = bool(closers) or string_start >= 0
+    # 丢弃被截断的字符串 (值或键)，其前面悬空的键和逗号在下面去掉
+    repaired = "".join(out[:string_start] if string_start >= 0 else out)
+    if closers:
+        repaired = re.sub(r',?\s*"(?:[^"\\]|\\.)*"\s*:\s*$', "", repaired)
+        if closers[-1] == "}":
+            repaired = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*$', r"\1", repaired)
+        repaired = re.sub(r",\s*$", "", repaired.rstrip()) + "".join(reversed(closers))
+    try:
+        return json.loads(repaired, strict=False), truncated
+    except json.JSONDecodeError as e:
+        raise ValueError(f"无法修复的 JSON: {e}") from e
+
+
+def extract_string_fields(text: str, keys: List[str]) -> dict:
+    """逐个字段提取字符串值 (容忍结构损坏)，找不到或被截断 (没有结束引号) 的字段不出现在结果中"""
+    fields = {}
+    for key in keys:
+        value, closed = _scan_string(text, key)
+        if closed:
+            fields[key] = value
+    return fields
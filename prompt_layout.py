@@ -0,0 +1,29 @@
+"""提示词布局：可缓存的静态前缀 + 可变后缀。
+
+OpenAI 等服务会缓存请求开头的最长公共前缀 (输入至少 1024 token，按 128 token 递增匹配)，
+命中的输入 token 按折扣计费，预填充也更快。前缀里只要混进一个每次都变的值，之后的内容就全部无法复用，
+因此每条链的提示词都拆成两条消息：
+- system: 角色、要求、约束和输出格式说明，只能包含构建时就确定的内容 (partial 变量)
+- human: 每次调用才确定的内容，越稳定的越靠前 (例如同一局游戏的初始/结束状态在前，本步的选择在后)
+
+原生结构化输出时 schema 放在 tools / response_format 中，同样位于消息之前，属于前缀的一部分。
+"""
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import convert_to_openai_messages
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+
+
+def cacheable_prompt(prefix: str, suffix: str, partial_variables: Optional[Dict[str, Any]] = None) -> ChatPromptTemplate:
+    """prefix 作为 system 消息，suffix 作为 human 消息；prefix 中出现非 partial 的变量时抛出 ValueError"""
+    partial_variables = partial_variables or {}
+    dynamic = set(PromptTemplate.from_template(prefix).input_variables) - set(partial_variables)
+    if dynamic:
+        raise ValueError(f"静态前缀中不能包含每次调用才确定的变量: {sorted(dynamic)}")
+    prompt = ChatPromptTemplate.from_messages([("system", prefix), ("human", suffix)])
+    return prompt.partial(**partial_variables) if partial_variables else prompt
+
+
+def openai_messages(prompt: ChatPromptTemplate, **variables) -> List[dict]:
+    """渲染成 /v1/chat/completions 的 messages 列表，用于批处理请求文件"""
+    return convert_to_openai_messages(prompt.format_messages(**variables))
@@ -0,0 +1,177 @@
+"""批处理结果的列式存储：每次运行写入 <root>/run=<运行 id>/part-NNNNN.parquet，按 Hive 风格分区。
+
+- ParquetRunWriter: 结果逐条 append，攒够 row_group_size 行或距上次写出超过 flush_seconds 秒时，
+  把缓冲的行写成该运行目录下的一个新文件 (先写以 "." 开头的临时文件再改名，读取时忽略临时文件)；
+  每个文件写完即可查询，进程中途崩溃时只丢失尚未写出的缓冲行
+- run_summary: 按列扫描多个运行 (只读取用到的列，逐批聚合)，统计每次运行的行数、失败率、类别分布、
+  平均延迟、token 和缓存命中率，不需要把结果整体载入内存
+
+用法:
+    with ParquetRunWriter("data/results/category_journal", schema, run_id="20250101T120000-online") as writer:
+        writer.append({...})
+
+    python results_store.py data/results/category_journal --runs 20250101T120000-online --top 10
+"""
+import argparse
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PART_NAME = "part-{:05d}.parquet"
+# 分区字段固定为字符串，避免纯数字的运行 id 被推断为整数
+RUN_PARTITIONING = ds.partitioning(pa.schema([("run", pa.string())]), flavor="hive")
+
+
+def new_run_id(label: str = "") -> str:
+    run_id = time.strftime("%Y%m%dT%H%M%S")
+    return f"{run_id}-{label}" if label else run_id
+
+
+class ParquetRunWriter:
+    """单次运行的 Parquet 写入器，root 下已有同名运行时在运行 id 后追加序号"""
+
+    def __init__(self, root: str, schema: pa.Schema, run_id: Optional[str] = None, row_group_size: int = 100,
+                 flush_seconds: float = 30.0):
+        self.root = root
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.flush_seconds = flush_seconds
+        run_id = run_id or new_run_id()
+        self.run_id = run_id
+        suffix = 1
+        while os.path.exists(os.path.join(root, f"run={self.run_id}")):
+            suffix += 1
+            self.run_id = f"{run_id}-{suffix}"
+        self.directory = os.path.join(root, f"run={self.run_id}")
+        self._rows: List[dict] = []
+        self._flushed_at = time.monotonic()
+        self.rows = 0
+        self.row_groups = 0
+
+    def append(self, row: Dict[str, Any]):
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size or time.monotonic() - self._flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def extend(self, rows: Iterable[Dict[str, Any]]):
+        for row in rows:
+            self.append(row)
+
+    def flush(self):
+        """缓冲的行写成一个新的 part 文件 (一个 row group)"""
+        self._flushed_at = time.monotonic()
+        if not self._rows:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        name = PART_NAME.format(self.row_groups)
+        temporary = os.path.join(self.directory, "." + name)
+        pq.write_table(pa.Table.from_pylist(self._rows, schema=self.schema), temporary, compression="zstd")
+        os.replace(temporary, os.path.join(self.directory, name))
+        self.rows += len(self._rows)
+        self.row_groups += 1
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self) -> "ParquetRunWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_runs(root: str, runs: Optional[List[str]] = None) -> ds.Dataset:
+    """root 下所有 (或指定的) 运行组成的数据集，run 列来自分区目录名"""
+    dataset = ds.dataset(root, format="parquet", partitioning=RUN_PARTITIONING)
+    if runs:
+        return dataset.filter(pc.field("run").isin(runs))
+    return dataset
+
+
+def list_runs(root: str) -> List[str]:
+    if not os.path.isdir(root):
+        return []
+    runs = [name for name in os.listdir(root) if name.startswith("run=")]
+    return sorted(name[len("run="):] for name in runs
+                  if any(part.startswith("part-") for part in os.listdir(os.path.join(root, name))))
+
+
+def run_summary(root: str, runs: Optional[List[str]] = None, group_by: str = "category", status: str = "status",
+                top: int = 20, batch_size: int = 65_536) -> dict:
+    """逐批扫描 run / group_by / status 以及延迟、token、缓存命中列 (存在时)，按运行和整体汇总"""
+    dataset = open_runs(root, runs)
+    names = set(dataset.schema.names)
+    numeric = [column for column in ("latency_s", "prompt_tokens", "completion_tokens") if column in names]
+    columns = ["run", group_by, status] + numeric + (["cache_hit"] if "cache_hit" in names else [])
+    per_run: Dict[str, dict] = defaultdict(lambda: {"rows": 0, "failed": 0, "cache_hits": 0, "calls": 0,
+                                                    **{column: 0.0 for column in numeric}})
+    categories: Dict[str, Counter] = defaultdict(Counter)
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        table = pa.Table.from_batches([batch])
+        for run in pc.unique(table["run"]).to_pylist():
+            part = table.filter(pc.equal(table["run"], run))
+            stats = per_run[run]
+            stats["rows"] += part.num_rows
+            failed = pc.not_equal(part[status], "ok")
+            stats["failed"] += pc.sum(failed).as_py() or 0
+            ok = part.filter(pc.invert(failed))
+            for entry in pc.value_counts(ok[group_by]).to_pylist():
+                categories[run][entry["values"] or ""] += entry["counts"]
+            for column in numeric:
+                stats[column] += pc.sum(part[column]).as_py() or 0
+            if "latency_s" in numeric:
+                stats["calls"] += pc.count(part["latency_s"]).as_py()
+            if "cache_hit" in columns:
+                stats["cache_hits"] += pc.sum(part["cache_hit"]).as_py() or 0
+
+    def summarize(stats: dict, counter: Counter) -> dict:
+        rows = stats["rows"]
+        succeeded = rows - stats["failed"]
+        summary = {
+            "rows": rows,
+            "failure_rate": stats["failed"] / rows if rows else None,
+            f"{group_by}_distribution": {name: count / succeeded for name, count in counter.most_common(top)}
+            if succeeded else {},
+            f"{group_by}_count": len(counter),
+        }
+        if "latency_s" in numeric:
+            summary["mean_latency_s"] = stats["latency_s"] / stats["calls"] if stats["calls"] else None
+            if "cache_hit" in columns:
+                summary["cache_hit_rate"] = stats["cache_hits"] / stats["calls"] if stats["calls"] else None
+        for column in ("prompt_tokens", "completion_tokens"):
+            if column in numeric:
+                summary[column] = int(stats[column])
+        return summary
+
+    total_stats = {"rows": 0, "failed": 0, "cache_hits": 0, "calls": 0, **{column: 0.0 for column in numeric}}
+    total_categories: Counter = Counter()
+    for run, stats in per_run.items():
+        for key in total_stats:
+            total_stats[key] += stats[key]
+        total_categories.update(categories[run])
+    return {
+        "runs": {run: summarize(per_run[run], categories[run]) for run in sorted(per_run)},
+        "total": summarize(total_stats, total_categories),
+    }
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="汇总按运行分区的 Parquet 批处理结果")
+    arg_parser.add_argument("root", nargs="?", default="data/results/category_journal", help="结果目录")
+    arg_parser.add_argument("--runs", nargs="+", default=None, help="只统计指定的运行 id，默认全部")
+    arg_parser.add_argument("--group-by", default="category", help="统计分布的列")
+    arg_parser.add_argument("--top", type=int, default=20, help="分布中列出的类别数")
+    arg_parser.add_argument("--list", action="store_true", help="只列出已有的运行 id")
+    args = arg_parser.parse_args()
+    if args.list:
+        print("\n".join(list_runs(args.root)))
+    else:
+        print(json.dumps(run_summary(args.root, args.runs, args.group_by, top=args.top), indent=4, ensure_ascii=False))
@@ -0,0 +1,306 @@
+"""模型路由：按链选择模型、便宜模型优先的级联、对冲请求和每步的硬性时限。
+
+- 每条链一个 Route：models 为级联顺序 (便宜的在前)。前一个模型的输出解析失败或没有通过质量检查时，
+  才换下一个模型重新生成；最后一个模型的结果 (或异常) 原样返回
+- hedge=True 时，请求在该链该模型近期延迟的 p95 之后仍未返回，就再发一个相同的请求，
+  取先返回的结果并取消另一个；样本不足时使用 hedge_delay，非流式调用再加上按 max_tokens 估计的生成时间。
+  流式调用按首个 chunk 的到达时间对冲。输出很长的非流式链默认不对冲：对冲几乎每次都会触发，只是成倍增加费用
+- budget 为整次调用 (含级联和对冲) 的时限 (秒)，超出时抛出 LatencyBudgetExceeded；流式调用同样计入整个输出过程
+- output_chars / max_output_tokens 决定 max_tokens (见 token_budget.py)；传入 prompt 时每次调用前先统计渲染后提示词的
+  token 数，超出预算时裁剪 trim 中的输入字段或抛出 PromptTooLong (级联中还有下一个模型时换下一个模型)
+
+默认路由保持各链原来的模型和温度，可用环境变量 LLM_ROUTES (JSON，按链名覆盖 DEFAULT_ROUTES 中的字段) 调整，例如
+    LLM_ROUTES='{"state_generation_chain": {"models": ["gpt-4o-mini", "gpt-4.1"]}, "story_step_chain": {"budget": 20}}'
+
+用法:
+    chain = routed("guiding_questions_chain", lambda llm: structured_chain(prompt, llm, parser, name), check=...)
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from pydantic import BaseModel, ValidationError
+
+from metrics import get_metrics, percentile
+from token_budget import PromptBudget, PromptTooLong, completion_tokens
+
+
+class Route(BaseModel):
+    models: List[str]
+    temperature: float = 0.7
+    budget: float = 60.0
+    hedge: bool = False
+    # 近期延迟样本不足 min_samples 时使用的对冲等待时间 (秒)，非流式调用另加 max_tokens / HEDGE_TOKENS_PER_SECOND
+    hedge_delay: float = 2.0
+    min_samples: int = 20
+    # 要求的输出长度 (字)，换算为 max_tokens；max_output_tokens 直接指定，优先于 output_chars
+    output_chars: Optional[int] = None
+    max_output_tokens: Optional[int] = None
+    # 输入 token 上限 (默认只受上下文窗口限制)
+    max_input_tokens: Optional[int] = None
+
+    def max_tokens(self, model: str) -> Optional[int]:
+        if self.max_output_tokens:
+            return self.max_output_tokens
+        if self.output_chars:
+            return completion_tokens(self.output_chars, model)
+        return None
+
+
+# 样本不足时估计非流式调用生成时间所用的输出速度 (token/秒)，取偏低的值，宁可晚些对冲
+HEDGE_TOKENS_PER_SECOND = 50
+
+DEFAULT_ROUTES: Dict[str, Route] = {
+    # 交互式剧情：玩家在等待，限制每步的时长；流式链和输出较短的链开启对冲
+    # 输出很长的非流式链不对冲：生成本身就要很久，对冲只会把每次调用变成两次
+    # output_chars 按输出结构估计 (含 JSON 字段和选项)，story_summary_chain 的长度由 STORY_SUMMARY_CHARS 决定
+    "story_opening_chain": Route(models=["gpt-3.5-turbo"], budget=30, hedge=True, output_chars=800),
+    "story_step_chain": Route(models=["gpt-3.5-turbo"], budget=30, hedge=True, output_chars=600),
+    "story_summary_chain": Route(models=["gpt-3.5-turbo"], temperature=0.2, budget=30, hedge=True),
+    # app 已不再使用的整篇剧本流程 (只用于 benchmark 和脚本，见 llm.py)
+    "state_generation_chain": Route(models=["gpt-3.5-turbo"], budget=30, hedge=True, output_chars=400),
+    "guiding_questions_chain": Route(models=["gpt-3.5-turbo"], budget=30, output_chars=800),
+    "story_generation_chain": Route(models=["gpt-3.5-turbo"], budget=90, output_chars=2000),
+    # 离线批处理：不对冲 (BatchRunner 负责重试和限流)，只限制单次调用的时长
+    "scene_change": Route(models=["gpt-4.1"], temperature=0, budget=180, output_chars=1000),
+    "category_journal": Route(models=["gpt-4o-mini"], temperature=0.5, budget=60, max_output_tokens=200),
+    "judge_journal": Route(models=["gpt-4o-mini"], temperature=0.5, budget=60, max_output_tokens=300),
+    # 打包模式一次处理多个条目，max_output_tokens 未指定时按包大小计算
+    "category_journal_packed": Route(models=["gpt-4o-mini"], temperature=0.5, budget=180),
+    "judge_journal_packed": Route(models=["gpt-4o-mini"], temperature=0.5, budget=180),
+}
+
+
+class LatencyBudgetExceeded(TimeoutError):
+    pass
+
+
+def get_route(name: str) -> Route:
+    overrides = json.loads(os.getenv("LLM_ROUTES") or "{}")
+    base = DEFAULT_ROUTES.get(name, Route(models=["gpt-3.5-turbo"]))
+    return base.model_copy(update=overrides.get(name, {})) if name in overrides else base
+
+
+_llms: Dict[tuple, Any] = {}
+_llms_lock = threading.Lock()
+
+
+def get_llm(model: str, temperature: float, max_tokens: Optional[int] = None):
+    """按 (模型, 温度, max_tokens) 共享的 ChatOpenAI 实例，HTTP 连接池与进程内其他实例共享"""
+    key = (model, temperature, max_tokens)
+    with _llms_lock:
+        if key not in _llms:
+            from langchain_openai import ChatOpenAI
+            from runtime import get_http_clients
+
+            _llms[key] = ChatOpenAI(model_name=model, temperature=temperature, max_tokens=max_tokens,
+                                    stream_usage=True, **get_http_clients())
+        return _llms[key]
+
+
+class LatencyTracker:
+    """每个模型最近 max_samples 次调用的延迟，用于计算对冲等待时间"""
+
+    def __init__(self, max_samples: int = 200):
+        self.samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=max_samples))
+
+    def add(self, model: str, seconds: float):
+        self.samples[model].append(seconds)
+
+    def hedge_delay(self, model: str, route: Route, max_tokens: Optional[int] = None) -> float:
+        """近期延迟的 p95；样本不足时为 route.hedge_delay 加上生成 max_tokens 所需的估计时间 (流式调用不传)"""
+        samples = list(self.samples[model])
+        if len(samples) >= route.min_samples:
+            return percentile(samples, 0.95)
+        return route.hedge_delay + (max_tokens or 0) / HEDGE_TOKENS_PER_SECOND
+
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class RoutedChain(Runnable):
+    """按 Route 执行的链；build(llm) 为给定模型构建原来的链 (每个模型只构建一次)，prompt 为其中的提示模板"""
+
+    def __init__(self, name: str, build: Callable[[Any], Runnable], route: Route,
+                 check: Optional[Callable[[Any], bool]] = None, prompt=None, trim: Sequence[str] = ()):
+        self.name = name
+        self.build = build
+        self.route = route
+        self.check = check
+        self.prompt = prompt
+        self.trim = trim
+        self.latency = LatencyTracker()
+        self._chains: Dict[str, Runnable] = {}
+        self._stragglers = set()
+
+    def _chain(self, model: str) -> Runnable:
+        if model not in self._chains:
+            max_tokens = self.route.max_tokens(model)
+            chain = self.build(get_llm(model, self.route.temperature, max_tokens))
+            if self.prompt is not None:
+                budget = PromptBudget(self.prompt, model, max_tokens, self.route.max_input_tokens, self.trim, self.name)
+                chain = RunnableLambda(budget.fit, name="prompt_budget") | chain
+            self._chains[model] = chain
+        return self._chains[model]
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> Any:
+        # 同步调用 (如脚本中的 invoke) 交给共享的后台事件循环执行，对冲和时限照常生效
+        from runtime import run_async
+
+        return run_async(self.ainvoke(input, config, **kwargs))
+
+    def _exceeded(self) -> LatencyBudgetExceeded:
+        get_metrics().count(self.name, "budget_exceeded")
+        return LatencyBudgetExceeded(f"{self.name} 超出时限 {self.route.budget}s")
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> Any:
+        try:
+            return await asyncio.wait_for(self._cascade(input, config), self.route.budget)
+        except asyncio.TimeoutError:
+            raise self._exceeded() from None
+
+    async def _cascade(self, input, config):
+        models = self.route.models
+        for position, model in enumerate(models):
+            last = position == len(models) - 1
+            try:
+                result = await self._hedged(model, input, config)
+            except (OutputParserException, ValidationError, PromptTooLong):
+                if last:
+                    raise
+                get_metrics().count(self.name, "escalations")
+                continue
+            if last or self.check is None or self.check(result):
+                return result
+            get_metrics().count(self.name, "escalations")
+
+    def _time_primary(self, model: str, task: asyncio.Future, started_at: float, stream=None):
+        """对冲请求先返回时，主请求在后台继续到完成 (最长到时限) 再记录它自身的延迟。
+        只记录获胜一方的延迟相当于取两者中较快的一个，p95 会越来越低、对冲越来越频繁"""
+        async def wait():
+            try:
+                await asyncio.wait_for(task, max(self.route.budget - (time.perf_counter() - started_at), 0))
+            except asyncio.TimeoutError:
+                pass
+            except Exception:
+                return
+            finally:
+                if stream is not None:
+                    await stream.aclose()
+            self.latency.add(model, time.perf_counter() - started_at)
+
+        straggler = asyncio.ensure_future(wait())
+        self._stragglers.add(straggler)
+        straggler.add_done_callback(self._stragglers.discard)
+
+    async def _hedged(self, model, input, config):
+        chain = self._chain(model)
+        started_at = time.perf_counter()
+        if not self.route.hedge:
+            result = await chain.ainvoke(input, config)
+            self.latency.add(model, time.perf_counter() - started_at)
+            return result
+        primary = asyncio.ensure_future(chain.ainvoke(input, config))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.latency.hedge_delay(
+                model, self.route, self.route.max_tokens(model)))
+            if not done:
+                get_metrics().count(self.name, "hedges")
+                tasks.add(asyncio.ensure_future(chain.ainvoke(input, config)))
+            # 取第一个成功的结果；都失败时抛出最先失败的那个异常
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is primary:
+                            self.latency.add(model, time.perf_counter() - started_at)
+                        else:
+                            get_metrics().count(self.name, "hedge_wins")
+                            if primary in tasks:
+                                tasks.discard(primary)
+                                self._time_primary(model, primary, started_at)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            await _cancel(tasks)
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> AsyncIterator[Any]:
+        """流式调用只使用路由中的第一个模型 (输出已经交给用户，无法再级联)；按首个 chunk 对冲，整个输出过程受时限约束"""
+        deadline = time.monotonic() + self.route.budget
+        model = self.route.models[0]
+        chain = self._chain(model)
+
+        def remaining():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise self._exceeded()
+            return left
+
+        started_at = time.perf_counter()
+        streams = [chain.astream(input, config)]
+        primary = asyncio.ensure_future(streams[0].__anext__())
+        pending = {primary: streams[0]}
+        try:
+            delay = self.latency.hedge_delay(model, self.route) if self.route.hedge else remaining()
+            done, _ = await asyncio.wait(pending, timeout=min(delay, remaining()))
+            if not done and self.route.hedge:
+                get_metrics().count(self.name, "hedges")
+                streams.append(chain.astream(input, config))
+                pending[asyncio.ensure_future(streams[1].__anext__())] = streams[1]
+            # 与 ainvoke 相同：取第一个成功产出首个 chunk 的流；都失败时抛出最先失败的那个异常
+            first = winner = error = None
+            while first is None and pending:
+                done, _ = await asyncio.wait(pending, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    stream = pending.pop(future)
+                    exception = future.exception()
+                    if exception is None or isinstance(exception, StopAsyncIteration):
+                        first, winner = first or future, winner or stream
+                    else:
+                        error = error or exception
+            if first is None:
+                raise error
+            if first is primary:
+                self.latency.add(model, time.perf_counter() - started_at)
+            else:
+                get_metrics().count(self.name, "hedge_wins")
+                if primary in pending:
+                    # 主请求的流交给后台计时并关闭，不再由这里关闭
+                    self._time_primary(model, primary, started_at, pending.pop(primary))
+                    streams.remove(streams[0])
+            await _cancel(list(pending))
+            pending = {}
+            try:
+                chunk = first.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(winner.__anext__(), remaining())
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    raise self._exceeded() from None
+                yield chunk
+        finally:
+            await _cancel(list(pending))
+            for stream in streams:
+                await stream.aclose()
+
+
+def routed(name: str, build: Callable[[Any], Runnable], check: Optional[Callable[[Any], bool]] = None,
+           route: Optional[Route] = None, prompt=None, trim: Sequence[str] = ()) -> RoutedChain:
+    return RoutedChain(name, build, route or get_route(name), check, prompt, trim)
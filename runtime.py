@@ -0,0 +1,173 @@
+import asyncio
+import os
+import queue
+import threading
+import weakref
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+import httpx
+
+T = TypeVar("T")
+
+# 与 openai SDK 的默认超时保持一致：总超时 600 秒，建立连接 5 秒
+DEFAULT_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+
+def _http2_enabled() -> bool:
+    # HTTP/2 需要可选依赖 h2，没有安装时退回 HTTP/1.1 keep-alive
+    if os.getenv("HTTP2", "1") == "0":
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),
+    )
+
+
+def _count_connection(name: str):
+    # 延迟导入：Streamlit 页面启动时只需要事件循环，不必加载 langchain_core
+    from metrics import get_metrics
+
+    get_metrics().count_connection(name)
+
+
+def _trace(event_name: str, info: dict):
+    # 只有新建连接时才会出现 connect_tcp 事件，复用连接池中的连接则不会
+    if event_name == "connection.connect_tcp.complete":
+        _count_connection("connections_opened")
+
+
+async def _atrace(event_name: str, info: dict):
+    _trace(event_name, info)
+
+
+class CountingTransport(httpx.HTTPTransport):
+    """同步连接池：统计请求数和新建连接数"""
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        _count_connection("requests")
+        request.extensions["trace"] = _trace
+        return super().handle_request(request)
+
+
+class LoopLocalTransport(httpx.AsyncBaseTransport):
+    """异步连接池：每个事件循环各自持有一个 AsyncHTTPTransport。
+
+    异步连接绑定在创建它的事件循环上，按循环区分后，同一个 AsyncClient 既可以在后台事件循环中长期复用，
+    也可以被命令行脚本各自 asyncio.run 的事件循环安全地使用。
+    """
+
+    def __init__(self, **transport_kwargs):
+        self._transport_kwargs = transport_kwargs
+        self._transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport]" = weakref.WeakKeyDictionary()
+
+    def _transport(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        transport = self._transports.get(loop)
+        if transport is None:
+            transport = self._transports[loop] = httpx.AsyncHTTPTransport(**self._transport_kwargs)
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        _count_connection("requests")
+        request.extensions["trace"] = _atrace
+        return await self._transport().handle_async_request(request)
+
+    async def aclose(self):
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_http_client: Optional[httpx.Client] = None
+_http_async_client: Optional[httpx.AsyncClient] = None
+_background_loop: Optional["BackgroundLoop"] = None
+_lock = threading.Lock()
+
+
+def get_http_clients() -> dict:
+    """进程级共享的 httpx 客户端 (keep-alive 连接池，可用时启用 HTTP/2)。
+
+    用法: ChatOpenAI(..., **get_http_clients())。连接池大小由 HTTP_MAX_CONNECTIONS、HTTP_MAX_KEEPALIVE、
+    HTTP_KEEPALIVE_EXPIRY 配置，HTTP2=0 可强制使用 HTTP/1.1。
+    """
+    global _http_client, _http_async_client
+    with _lock:
+        if _http_client is None:
+            options = {"limits": _pool_limits(), "http2": _http2_enabled()}
+            _http_client = httpx.Client(transport=CountingTransport(**options), timeout=DEFAULT_TIMEOUT)
+            _http_async_client = httpx.AsyncClient(transport=LoopLocalTransport(**options), timeout=DEFAULT_TIMEOUT)
+        return {"http_client": _http_client, "http_async_client": _http_async_client}
+
+
+class BackgroundLoop:
+    """在后台线程中常驻的事件循环。
+
+    Streamlit 脚本线程通过 run() / iterate() 把协程和异步生成器提交到这里执行，
+    不再每次点击都 asyncio.run 新建、销毁事件循环，连接池中的连接得以跨请求、跨会话复用。
+    """
+
+    def __init__(self, name: str = "llm-event-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def _run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def iterate(self, agen: AsyncIterator[T]) -> Iterator[T]:
+        """在后台循环中消费异步生成器，在调用方线程中逐个产出结果 (调用方可以直接更新界面)"""
+        items: "queue.Queue" = queue.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((item, None))
+            except Exception as e:
+                items.put((finished, e))
+            else:
+                items.put((finished, None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                item, error = items.get()
+                if item is finished:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def get_background_loop() -> BackgroundLoop:
+    global _background_loop
+    with _lock:
+        if _background_loop is None:
+            _background_loop = BackgroundLoop()
+        return _background_loop
+
+
+def run_async(coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+    return get_background_loop().run(coro, timeout)
+
+
+def iterate_async(agen: AsyncIterator[T]) -> Iterator[T]:
+    return get_background_loop().iterate(agen)
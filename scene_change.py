@@ -1,22 +1,349 @@
 from dotenv import load_dotenv, find_dotenv
+import argparse
 import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
 
 load_dotenv(find_dotenv())
 
-from langchain_openai import ChatOpenAI
+from langchain_core.output_parsers import StrOutputParser
 
-with open('prompts/scene_change.xml', 'r') as f:
-    prompt_scene_change = f.read()
+from batch_runner import BatchRunner
+from llm_cache import cached_llm
+from metrics import get_metrics, instrument
+from prompt_layout import cacheable_prompt
+from router import get_route, routed
+from token_budget import count_messages
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "index.json"
+
+# 背景 (角色、要求、约束) 对所有场景切换都相同，作为可缓存的 system 前缀；两个场景的数据作为 human 消息
+with open('prompts/scene_change_background.xml', 'r') as f:
+    background_scene_change = f.read()
+
+with open('prompts/scene_change_scenes.xml', 'r') as f:
+    scenes_scene_change = f.read()
+
+prompt = cacheable_prompt(background_scene_change, "{scenes}")
+
+
+def scene_change_chain(bypass=False):
+    # 模型、温度、单次调用的时限和输出长度 (约 1000 字) 见 router.py 中的 "scene_change" 路由；
+    # 场景不能截断，提示词超出上下文窗口时直接拒绝
+    chain = routed("scene_change", lambda llm: prompt | cached_llm(llm, StrOutputParser(), bypass=bypass),
+                   prompt=prompt)
+    return chain.with_config(instrument("scene_change"))
+
+
+async def generate_scene_change(scenes, chain=None):
+    return await (chain or scene_change_chain()).ainvoke({"scenes": scenes})
+
+
+# --- 批量模式：从目录或清单中逐个读取场景对，并发生成，每对输出一个文件并维护索引 ---
+
+def scenes_xml(scene_before, scene_after):
+    """把两个场景的内容套进与 scene_change_scenes.xml 相同的 <scenes> 结构"""
+    return (f"<scenes>\n    <scene_before>\n{scene_before.strip()}\n    </scene_before>\n"
+            f"    <scene_after>\n{scene_after.strip()}\n    </scene_after>\n</scenes>\n")
+
+
+def _read(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _iter_directory(path):
+    # 目录中每个 .xml 文件是一个 <scenes> 文档，文件名 (不含扩展名) 即场景对 id
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".xml"):
+            yield os.path.splitext(name)[0], _read(os.path.join(path, name))
+
+
+def _iter_jsonl(path):
+    # 每行 {"id", "scene_before", "scene_after"}，或 {"id", "path"} 指向一个 <scenes> 文档 (相对清单所在目录)
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            pair_id = str(entry.get("id") or number)
+            if "path" in entry:
+                yield pair_id, _read(os.path.join(base, entry["path"]))
+            else:
+                yield pair_id, scenes_xml(entry["scene_before"], entry["scene_after"])
+
+
+def _iter_xml(path):
+    # 任意根元素下的多个 <scenes id="..."> 元素；iterparse 逐个读取，处理完即释放，清单再大也不会整体载入内存
+    number = 0
+    for _, element in ET.iterparse(path, events=("end",)):
+        if element.tag != "scenes":
+            continue
+        number += 1
+        pair_id = element.get("id") or str(number)
+        element.attrib.pop("id", None)
+        yield pair_id, ET.tostring(element, encoding="unicode")
+        element.clear()
+
+
+def iter_scene_pairs(source):
+    """按输入顺序产出 (场景对 id, <scenes> 文本)：source 可以是目录、.jsonl 清单或 .xml 清单"""
+    if os.path.isdir(source):
+        return _iter_directory(source)
+    if source.endswith(".jsonl"):
+        return _iter_jsonl(source)
+    return _iter_xml(source)
+
+
+def pair_hash(scenes):
+    """输入指纹：背景、场景、模型和温度任一变化都会重新生成"""
+    route = get_route("scene_change")
+    payload = json.dumps([background_scene_change, scenes, route.models, route.temperature], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _file_name(pair_id):
+    return re.sub(r"[^\w.-]+", "_", pair_id) + ".xml"
+
+
+class SceneIndex:
+    """output_dir/index.json：场景对 id -> {hash, output, chars, updated_at} 或 {error}，每完成一项就原子地写回"""
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, INDEX_NAME)
+        self.entries = json.loads(_read(self.path)) if os.path.exists(self.path) else {}
+
+    def unchanged(self, pair_id, digest, output_dir):
+        entry = self.entries.get(pair_id) or {}
+        return entry.get("hash") == digest and os.path.exists(os.path.join(output_dir, entry.get("output", "")))
+
+    def update(self, pair_id, **entry):
+        self.entries[pair_id] = {**entry, "updated_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.save()
+
+    def save(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=4, ensure_ascii=False)
+        os.replace(temporary, self.path)
+
+
+async def _generate_pairs(pairs, chain, index, output_dir, stats, concurrency=5, rpm=None, tpm=None, force=False):
+    """并发生成 pairs 中 (场景对 id, <scenes> 文本) 的衔接剧本，每完成一项写出文件并更新索引"""
+
+    # 先筛出需要生成的场景对，开始前即可估算 token、成本和耗时
+    pending = []
+    for pair_id, scenes in pairs:
+        digest = pair_hash(scenes)
+        if not force and index.unchanged(pair_id, digest, output_dir):
+            stats["skipped"] += 1
+            continue
+        pending.append((pair_id, scenes, digest))
+
+    async def worker(pair):
+        return await generate_scene_change(pair[1], chain)
+
+    route = get_route("scene_change")
+    model = route.models[0]
+    runner = BatchRunner(
+        worker,
+        concurrency=concurrency,
+        rpm=rpm,
+        tpm=tpm,
+        estimate_tokens=lambda pair: count_messages(prompt.format_messages(scenes=pair[1]), model),
+        model=model,
+        max_tokens=route.max_tokens(model) or 0,
+        desc="生成场景衔接",
+    )
+    async for _, (pair_id, _, digest), result, error in runner.iter_completed(pending):
+        if error is not None:
+            logger.error(f"生成失败: {pair_id}，错误: {error!r}")
+            index.update(pair_id, error=repr(error))
+            stats["failed"] += 1
+            continue
+        output = _file_name(pair_id)
+        with open(os.path.join(output_dir, output), "w", encoding="utf-8") as f:
+            f.write(result)
+        index.update(pair_id, hash=digest, output=output, chars=len(result))
+        stats["generated"] += 1
+
+
+async def run_batch(source, output_dir="export/scene_changes", concurrency=5, rpm=None, tpm=None,
+                    force=False, bypass_cache=False):
+    """批量生成场景衔接，返回统计；输入未变且输出文件仍在的场景对直接跳过 (force=True 时全部重新生成)"""
+    os.makedirs(output_dir, exist_ok=True)
+    index = SceneIndex(output_dir)
+    stats = {"pairs": 0, "skipped": 0, "duplicates": 0, "generated": 0, "failed": 0}
+    seen = set()
+
+    def unique_pairs():
+        for pair_id, scenes in iter_scene_pairs(source):
+            stats["pairs"] += 1
+            if pair_id in seen:
+                logger.warning(f"场景对 id 重复，只处理第一次出现的: {pair_id}")
+                stats["duplicates"] += 1
+                continue
+            seen.add(pair_id)
+            yield pair_id, scenes
+
+    await _generate_pairs(unique_pairs(), scene_change_chain(bypass=bypass_cache), index, output_dir, stats,
+                          concurrency=concurrency, rpm=rpm, tpm=tpm, force=force)
+    return stats
+
+
+# --- 章节模式：按顺序排列的 N 个场景生成 N-1 段衔接，并拼接成整章 ---
+#
+# 第 i 段衔接 (场景 i -> 场景 i+1) 与相邻两段共享场景，为了连贯需要参考相邻衔接的内容，但逐段串行生成太慢。
+# 因此分两轮：第一轮并行生成偶数段 (0, 2, 4, ...)，它们互不相邻；第二轮并行生成奇数段，
+# 提示词中附上前一段结尾和后一段开头的片段 (而不是全文)。
+# 衔接 id 由两端场景的 id 组成，插入或删除场景只影响两侧的衔接；修改一个场景时，
+# 直接包含它的两段会重新生成，其中偶数段的输出变了，与之相邻的奇数段也随之重新生成，其余全部跳过。
+
+CHAPTER_NAME = "chapter.xml"
+CONTEXT_CHARS = 300
+
+
+def _iter_chapter_directory(path):
+    # 目录中每个 .xml 文件是一个场景 (<scene_before> 中的内容)，按文件名排序，文件名即场景 id
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".xml") and name != CHAPTER_NAME:
+            yield os.path.splitext(name)[0], _read(os.path.join(path, name))
+
+
+def _iter_chapter_jsonl(path):
+    # 每行 {"id", "scene"}
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                entry = json.loads(line)
+                yield str(entry.get("id") or number), entry["scene"]
+
+
+def _iter_chapter_xml(path):
+    # 任意根元素下按顺序排列的多个 <scene id="..."> 元素，取其内部内容
+    number = 0
+    for _, element in ET.iterparse(path, events=("end",)):
+        if element.tag != "scene":
+            continue
+        number += 1
+        inner = (element.text or "") + "".join(ET.tostring(child, encoding="unicode") for child in element)
+        yield element.get("id") or str(number), inner
+        element.clear()
+
+
+def load_chapter(source):
+    """按顺序返回 [(场景 id, 场景内容)]：source 可以是目录、.jsonl 清单或 .xml 清单"""
+    if os.path.isdir(source):
+        scenes = list(_iter_chapter_directory(source))
+    elif source.endswith(".jsonl"):
+        scenes = list(_iter_chapter_jsonl(source))
+    else:
+        scenes = list(_iter_chapter_xml(source))
+    ids = [scene_id for scene_id, _ in scenes]
+    duplicates = sorted({scene_id for scene_id in ids if ids.count(scene_id) > 1})
+    if duplicates:
+        raise ValueError(f"章节中的场景 id 重复: {duplicates}")
+    return scenes
+
+
+def _script_text(output):
+    return re.sub(r"</?script>", "", output).strip()
+
+
+def _context_xml(previous, following, chars):
+    """相邻衔接的片段：前一段的结尾、后一段的开头，各取 chars 个字符"""
+    parts = []
+    if previous:
+        parts.append(f"    <previous_transition_ending>{_script_text(previous)[-chars:]}</previous_transition_ending>\n")
+    if following:
+        parts.append(f"    <next_transition_opening>{_script_text(following)[:chars]}</next_transition_opening>\n")
+    if not parts:
+        return ""
+    return ("<context>\n    <note>以下是同一章节中相邻衔接剧本的片段，仅用于保持连贯：本剧本的开头要接上前一段的结尾，"
+            "结尾要能引出后一段的开头，不要重复其中的内容。</note>\n" + "".join(parts) + "</context>\n")
+
+
+async def run_chapter(source, output_dir="export/chapter", concurrency=5, rpm=None, tpm=None,
+                      force=False, bypass_cache=False, context_chars=CONTEXT_CHARS):
+    """为一章中相邻的场景生成全部衔接并拼接成 output_dir/chapter.xml，返回统计；输入和相邻片段都未变的衔接直接跳过"""
+    scenes = load_chapter(source)
+    os.makedirs(output_dir, exist_ok=True)
+    index = SceneIndex(output_dir)
+    chain = scene_change_chain(bypass=bypass_cache)
+    transitions = [(f"{before_id}__{after_id}", scenes_xml(before, after))
+                   for (before_id, before), (after_id, after) in zip(scenes, scenes[1:])]
+    stats = {"scenes": len(scenes), "transitions": len(transitions), "skipped": 0, "generated": 0, "failed": 0}
+    options = {"concurrency": concurrency, "rpm": rpm, "tpm": tpm, "force": force}
+
+    def output_of(position):
+        if not 0 <= position < len(transitions):
+            return None
+        entry = index.entries.get(transitions[position][0]) or {}
+        return _read(os.path.join(output_dir, entry["output"])) if "hash" in entry else None
+
+    await _generate_pairs(transitions[0::2], chain, index, output_dir, stats, **options)
+    odd = [(transition_id, scenes_text + _context_xml(output_of(position - 1), output_of(position + 1), context_chars))
+           for position, (transition_id, scenes_text) in enumerate(transitions) if position % 2 == 1]
+    await _generate_pairs(odd, chain, index, output_dir, stats, **options)
+
+    # 删除场景后不再存在的衔接
+    current = {transition_id for transition_id, _ in transitions}
+    for transition_id in [transition_id for transition_id in index.entries if transition_id not in current]:
+        entry = index.entries.pop(transition_id)
+        if "output" in entry and os.path.exists(os.path.join(output_dir, entry["output"])):
+            os.remove(os.path.join(output_dir, entry["output"]))
+    index.save()
+
+    chapter = [f'<transition id="{transition_id}">\n{output_of(position) or "<!-- 生成失败 -->"}\n</transition>'
+               for position, (transition_id, _) in enumerate(transitions)]
+    with open(os.path.join(output_dir, CHAPTER_NAME), "w", encoding="utf-8") as f:
+        f.write("<chapter>\n" + "\n".join(chapter) + "\n</chapter>\n")
+    return stats
 
 
 async def main():
-    llm = ChatOpenAI(model="gpt-4.1", temperature=0)
-    result = await llm.ainvoke(prompt_scene_change)
+    result = await generate_scene_change(scenes_scene_change)
     print(result)
-    
+
     with open('export/scene_change.xml', 'w') as f:
-        f.write(result.content)
+        f.write(result)
+    print(f"调用指标汇总:\n{get_metrics().format_summary()}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="生成场景衔接剧本；不带 --input / --chapter 时处理 prompts/scene_change_scenes.xml")
+    arg_parser.add_argument("--input", default=None,
+                            help="批量模式的输入：<scenes> 文档所在目录，或 .jsonl / .xml 清单")
+    arg_parser.add_argument("--chapter", default=None,
+                            help="章节模式的输入：按顺序排列的场景，可以是目录 (按文件名排序)、.jsonl 或 .xml 清单")
+    arg_parser.add_argument("--output-dir", default=None,
+                            help="输出目录，批量模式默认 export/scene_changes，章节模式默认 export/chapter")
+    arg_parser.add_argument("--context-chars", type=int, default=CONTEXT_CHARS, help="章节模式中附带的相邻衔接片段长度")
+    arg_parser.add_argument("--concurrency", type=int, default=5, help="同时在途的请求数")
+    arg_parser.add_argument("--rpm", type=float, default=None, help="每分钟请求数上限")
+    arg_parser.add_argument("--tpm", type=float, default=None, help="每分钟 token 数上限")
+    arg_parser.add_argument("--force", action="store_true", help="忽略 index.json，全部重新生成")
+    arg_parser.add_argument("--no-cache", action="store_true", help="不使用 LLM 响应缓存")
+    args = arg_parser.parse_args()
+
+    if args.input is None and args.chapter is None:
+        asyncio.run(main())
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+        options = {"concurrency": args.concurrency, "rpm": args.rpm, "tpm": args.tpm, "force": args.force,
+                   "bypass_cache": args.no_cache}
+        if args.chapter is not None:
+            stats = asyncio.run(run_chapter(args.chapter, output_dir=args.output_dir or "export/chapter",
+                                            context_chars=args.context_chars, **options))
+        else:
+            stats = asyncio.run(run_batch(args.input, output_dir=args.output_dir or "export/scene_changes", **options))
+        logger.info(f"生成结束: {stats}")
+        logger.info(f"调用指标汇总:\n{get_metrics().format_summary()}")
@@ -0,0 +1,218 @@
+"""创作类调用的本地语义缓存 (可选，默认关闭)。
+
+相同的提示词必须得到新内容，所以精确匹配的响应缓存对创作类调用默认关闭 (见 llm.py 的 _cache_creative)；
+但不同玩家的输入常常只差几个字，每次都重新生成很浪费。这里按输入文本的相似度复用以往的结果：
+- 嵌入在本地计算：字符 1~3-gram 哈希到固定维度并按 L2 归一化 (NumPy 向量化实现)，不需要网络
+- 每条链一个索引：向量存放在预分配的 float32 数组中，查询是一次矩阵-向量乘法，满了之后淘汰最久未被使用的条目
+- 余弦相似度不低于 threshold 的条目都算命中，从中随机返回一条，而不总是最相似的那条
+- diversity 为命中后仍然重新生成的概率，新结果也会加入索引；同一输入附近逐渐积累多个版本，
+  避免“无限”的游戏总是给出同样的内容
+- 输入为空的调用 (如 story_opening_chain) 不查也不写缓存：空输入彼此完全相同，缓存会让所有玩家拿到同一个设定
+
+用法:
+    chain = semantic_cached(chain, "guiding_questions_chain")   # 未启用时原样返回 chain
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.runnables import Runnable, RunnableLambda
+
+# 字符 n-gram 哈希所用的乘数 (FNV 素数的低 32 位)
+_PRIME = np.uint64(16777619)
+_MASK = np.uint64(0xFFFFFFFF)
+
+
+def hashing_vector(text: str, dim: int = 256, ngrams=(1, 2, 3)) -> np.ndarray:
+    """文本的哈希向量：字符 n-gram 映射到 dim 个桶，用哈希的最高位决定正负号以抵消碰撞，返回 L2 归一化的 float32 向量"""
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    vector = np.zeros(dim, dtype=np.float32)
+    for n in ngrams:
+        if len(codes) < n:
+            break
+        hashes = np.full(len(codes) - n + 1, n, dtype=np.uint64)
+        for offset in range(n):
+            hashes = ((hashes * _PRIME) ^ codes[offset:len(codes) - n + 1 + offset]) & _MASK
+        signs = np.where(hashes >> np.uint64(31) & np.uint64(1), -1.0, 1.0).astype(np.float32)
+        vector += np.bincount((hashes % np.uint64(dim)).astype(np.int64), weights=signs, minlength=dim).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        # 空文本用固定的单位向量表示 (semantic_cached 不会为空输入查询)
+        vector[0] = 1.0
+        return vector
+    return vector / norm
+
+
+class SemanticIndex:
+    """单条链的向量索引：最多 max_entries 条，满了之后新条目覆盖最久未被使用的槽位"""
+
+    def __init__(self, dim: int = 256, max_entries: int = 10_000):
+        self.dim = dim
+        self.max_entries = max_entries
+        self.vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self.used_at = np.zeros(max_entries, dtype=np.float64)
+        self.values: List[Any] = [None] * max_entries
+        self.size = 0
+
+    def search(self, vector: np.ndarray, threshold: float) -> np.ndarray:
+        """相似度不低于 threshold 的槽位"""
+        if self.size == 0:
+            return np.empty(0, dtype=np.int64)
+        similarities = self.vectors[:self.size] @ vector
+        return np.flatnonzero(similarities >= threshold)
+
+    def get(self, slot: int) -> Any:
+        self.used_at[slot] = time.monotonic()
+        return self.values[slot]
+
+    def add(self, vector: np.ndarray, value: Any) -> int:
+        if self.size < self.max_entries:
+            slot = self.size
+            self.size += 1
+        else:
+            slot = int(np.argmin(self.used_at))
+        self.vectors[slot] = vector
+        self.values[slot] = value
+        self.used_at[slot] = time.monotonic()
+        return slot
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.used_at.nbytes
+
+
+class SemanticCache:
+    """按链区分的语义缓存，线程安全；统计命中率和查询耗时"""
+
+    def __init__(self, dim: int = 256, max_entries: int = 10_000, threshold: float = 0.8, diversity: float = 0.2,
+                 seed: Optional[int] = None):
+        self.dim = dim
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.diversity = diversity
+        self.indexes: Dict[str, SemanticIndex] = {}
+        self.hits = 0
+        self.misses = 0
+        self.diverted = 0
+        self.lookup_seconds: deque = deque(maxlen=10_000)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> np.ndarray:
+        return hashing_vector(text, self.dim)
+
+    def lookup(self, name: str, text: str):
+        """返回 (是否命中, 缓存的结果, 输入向量)；未命中时把向量交给 store，避免重复计算"""
+        started_at = time.perf_counter()
+        vector = self.embed(text)
+        with self._lock:
+            index = self.indexes.get(name)
+            slots = index.search(vector, self.threshold) if index else []
+            self.lookup_seconds.append(time.perf_counter() - started_at)
+            if len(slots) == 0:
+                self.misses += 1
+                return False, None, vector
+            if self._rng.random() < self.diversity:
+                self.diverted += 1
+                return False, None, vector
+            self.hits += 1
+            return True, index.get(int(self._rng.choice(slots))), vector
+
+    def store(self, name: str, vector: np.ndarray, value: Any):
+        with self._lock:
+            if name not in self.indexes:
+                self.indexes[name] = SemanticIndex(self.dim, self.max_entries)
+            self.indexes[name].add(vector, value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.diverted
+            latencies = sorted(self.lookup_seconds)
+            entries = {name: index.size for name, index in self.indexes.items()}
+            nbytes = sum(index.nbytes for index in self.indexes.values())
+
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else None
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "diverted": self.diverted,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "lookup_ms_p50": percentile(0.5),
+            "lookup_ms_p99": percentile(0.99),
+            "entries": entries,
+            "index_bytes": nbytes,
+        }
+
+
+def _input_text(value: Any) -> str:
+    # 只用每次调用才确定的输入值 (不含提示词和字段名)，否则相同的说明文字会让所有输入都显得很相似
+    if isinstance(value, dict):
+        return "\n".join(str(value[key]) for key in sorted(value))
+    return str(value)
+
+
+def semantic_cached(chain: Runnable, name: str, cache: Optional[SemanticCache] = None) -> Runnable:
+    """为 chain 加上语义缓存；cache 为空且该链不在 SEMANTIC_CACHE_CHAINS 中时原样返回"""
+    if cache is None:
+        if name not in semantic_cache_chains():
+            return chain
+        cache = get_semantic_cache()
+
+    def _count(hit: bool):
+        from metrics import get_metrics
+
+        get_metrics().count(name, "semantic_hits" if hit else "semantic_misses")
+
+    def _invoke(value, config):
+        text = _input_text(value)
+        if not text.strip():
+            return chain.invoke(value, config)
+        hit, cached, vector = cache.lookup(name, text)
+        _count(hit)
+        if hit:
+            return cached
+        result = chain.invoke(value, config)
+        cache.store(name, vector, result)
+        return result
+
+    async def _ainvoke(value, config):
+        text = _input_text(value)
+        if not text.strip():
+            return await chain.ainvoke(value, config)
+        hit, cached, vector = cache.lookup(name, text)
+        _count(hit)
+        if hit:
+            return cached
+        result = await chain.ainvoke(value, config)
+        cache.store(name, vector, result)
+        return result
+
+    return RunnableLambda(_invoke, afunc=_ainvoke, name="semantic_cached")
+
+
+def semantic_cache_chains() -> set:
+    return {name.strip() for name in os.getenv("SEMANTIC_CACHE_CHAINS", "").split(",") if name.strip()}
+
+
+_semantic_cache: Optional[SemanticCache] = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache:
+    """进程级共享的语义缓存，维度/容量/阈值/多样性由 SEMANTIC_CACHE_* 环境变量配置"""
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache(
+                dim=int(os.getenv("SEMANTIC_CACHE_DIM", "256")),
+                max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000")),
+                threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.8")),
+                diversity=float(os.getenv("SEMANTIC_CACHE_DIVERSITY", "0.2")),
+            )
+        return _semantic_cache
@@ -0,0 +1,198 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+import ormsgpack
+
+from story_graph import StoryState, new_story
+
+# 与响应缓存放在同一个目录下，可通过环境变量覆盖
+DEFAULT_SESSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "sessions.sqlite3")
+
+
+class SessionStore:
+    """交互式剧情的持久化：每推进一步追加一行 msgpack 编码的增量，服务重启或断线后按 id 恢复。
+
+    - sessions 表记录每次冒险的初始/结束状态和进度，steps 表每步一行，只保存这一步新增的剧情、选择和问题；
+      滚动梗概只在被 fold 更新的那一步才写入
+    - fork 把某次冒险的前 N 步复制到一个新的会话中，从那里做出不同的选择
+    - 超过 max_sessions 时按最近更新时间淘汰最旧的会话；设置 ttl 后过期的会话也会被清理
+    """
+
+    def __init__(self, path: str = DEFAULT_SESSION_PATH, max_sessions: int = 10_000, ttl: Optional[float] = None):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, user TEXT NOT NULL, initial_state TEXT NOT NULL, final_state TEXT NOT NULL, "
+            "parent_id TEXT, steps INTEGER NOT NULL DEFAULT 0, finished INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS steps ("
+            "session_id TEXT NOT NULL REFERENCES sessions (id) ON DELETE CASCADE, step INTEGER NOT NULL, "
+            "summarized INTEGER NOT NULL, payload BLOB NOT NULL, PRIMARY KEY (session_id, step))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_user_updated_at ON sessions (user, updated_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def create(self, user: str, initial_state: str, final_state: str, parent_id: Optional[str] = None) -> str:
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (id, user, initial_state, final_state, parent_id, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, user, initial_state, final_state, parent_id, now, now),
+            )
+            self._evict(now)
+        return session_id
+
+    def save_step(self, session_id: str, state: StoryState) -> int:
+        """保存 state 的最后一步 (第 len(segments) 步)，重复保存同一步会覆盖"""
+        step = len(state["segments"])
+        summarized = state.get("summarized", 0)
+        payload = {
+            "segment": state["segments"][-1],
+            "choice": state["choices"][-1] if step > 1 else None,
+            "question": state.get("question", ""),
+            "options": state.get("options", []),
+        }
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summarized FROM steps WHERE session_id = ? AND step < ? ORDER BY step DESC LIMIT 1",
+                (session_id, step),
+            ).fetchone()
+            if summarized != (row[0] if row else 0):
+                payload["summary"] = state.get("summary", "")
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps (session_id, step, summarized, payload) VALUES (?, ?, ?, ?)",
+                (session_id, step, summarized, ormsgpack.packb(payload)),
+            )
+            # 覆盖较早的一步时 (例如重试)，其后的步骤已不再成立
+            self._conn.execute("DELETE FROM steps WHERE session_id = ? AND step > ?", (session_id, step))
+            self._conn.execute("UPDATE sessions SET steps = ?, updated_at = ? WHERE id = ?",
+                               (step, time.time(), session_id))
+            self._conn.execute("COMMIT")
+        return step
+
+    def mark_finished(self, session_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE sessions SET finished = 1, updated_at = ? WHERE id = ?", (time.time(), session_id))
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """会话的元信息 (不含剧情)，不存在或已过期时返回 None"""
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM sessions WHERE id = ?", (session_id,))
+            row = cursor.fetchone()
+            columns = [column[0] for column in cursor.description]
+        if row is None:
+            return None
+        info = dict(zip(columns, row))
+        if self.ttl is not None and info["updated_at"] < time.time() - self.ttl:
+            return None
+        info["finished"] = bool(info["finished"])
+        return info
+
+    def load(self, session_id: str, steps: Optional[int] = None) -> Optional[StoryState]:
+        """按步回放增量，还原前 steps 步 (默认全部) 之后的 StoryState"""
+        info = self.get(session_id)
+        if info is None:
+            return None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT summarized, payload FROM steps WHERE session_id = ? AND step <= ? ORDER BY step",
+                (session_id, info["steps"] if steps is None else steps),
+            ).fetchall()
+            self._conn.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id))
+        state = new_story(info["initial_state"], info["final_state"])
+        for summarized, payload in rows:
+            delta = ormsgpack.unpackb(payload)
+            state["segments"].append(delta["segment"])
+            if delta["choice"] is not None:
+                state["choices"].append(delta["choice"])
+            state["question"] = delta["question"]
+            state["options"] = delta["options"]
+            if "summary" in delta:
+                state["summary"] = delta["summary"]
+            state["summarized"] = summarized
+        return state
+
+    def fork(self, session_id: str, steps: int, user: Optional[str] = None) -> str:
+        """以某次冒险的前 steps 步为起点创建新的会话，原会话不受影响"""
+        info = self.get(session_id)
+        if info is None:
+            raise KeyError(f"未知的会话: {session_id}")
+        steps = min(steps, info["steps"])
+        fork_id = self.create(user or info["user"], info["initial_state"], info["final_state"], parent_id=session_id)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT INTO steps (session_id, step, summarized, payload) "
+                "SELECT ?, step, summarized, payload FROM steps WHERE session_id = ? AND step <= ?",
+                (fork_id, session_id, steps),
+            )
+            self._conn.execute("UPDATE sessions SET steps = ? WHERE id = ?", (steps, fork_id))
+            self._conn.execute("COMMIT")
+        return fork_id
+
+    def list_sessions(self, user: str, limit: int = 20) -> List[dict]:
+        """该用户最近更新的会话 (不含剧情)"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT id, initial_state, final_state, parent_id, steps, finished, created_at, updated_at "
+                "FROM sessions WHERE user = ? ORDER BY updated_at DESC LIMIT ?",
+                (user, limit),
+            )
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        return [{**dict(zip(columns, row)), "finished": bool(row[5])} for row in rows]
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _evict(self, now: float):
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+        overflow = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY updated_at ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions, = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+            steps, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM steps").fetchone()
+        return {"sessions": sessions, "steps": steps, "payload_bytes": size}
+
+
+_session_store: Optional[SessionStore] = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """进程级共享的会话存储，路径/容量/有效期由 SESSION_PATH、SESSION_MAX、SESSION_TTL 配置"""
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            ttl = os.getenv("SESSION_TTL")
+            _session_store = SessionStore(
+                path=os.getenv("SESSION_PATH", DEFAULT_SESSION_PATH),
+                max_sessions=int(os.getenv("SESSION_MAX", "10000")),
+                ttl=float(ttl) if ttl else None,
+            )
+        return _session_store
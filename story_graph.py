@@ -0,0 +1,187 @@
+"""交互式分支剧情引擎 (LangGraph)：用户每做出一个选择，就立即续写下一段剧情并提出下一个问题。
+
+最终剧本就是已生成各段剧情的拼接，不再在最后一次性生成整篇故事。每一步的提示词只包含：
+- 滚动更新的故事梗概 (summary，已并入其中的段落数记为 summarized)
+- 最近 STORY_RECENT_SEGMENTS 段 (默认 2) 剧情原文
+
+较早的段落超出这个窗口时，由 fold 节点与 write 节点并行地把它们并入梗概，不增加这一步的等待时间；
+因此无论故事进行多少步，提示词长度都保持有界。
+
+开局由 story_opening_chain 一次调用同时写出初始/结束状态、开篇和第一个问题，不再先生成状态、再单独写开篇。
+
+用法:
+    async for text, state in astream_story_opening():                 # 开局
+        ...
+    async for text, new_state in astream_story_step(state, "选项 A"):  # 之后每个选择
+        ...
+    state = new_story(initial_state, final_state)                     # 已有状态时也可以由 story_step_chain 写开篇
+    async for text, new_state in astream_story_step(state):
+        ...
+"""
+import operator
+import os
+from typing import Annotated, AsyncIterator, List, Optional, Tuple, TypedDict
+
+from llm import StoryOpening, StoryStep, get_chain, get_component
+from partial_json import extract_partial_json_string
+
+
+class StoryState(TypedDict, total=False):
+    initial_state: str
+    final_state: str
+    segments: Annotated[List[str], operator.add]
+    choices: Annotated[List[str], operator.add]
+    summary: str
+    summarized: int
+    question: str
+    options: List[str]
+    # 本步的输入：用户刚做出的选择，开篇时为空
+    choice: str
+
+
+def _recent_segments() -> int:
+    return int(os.getenv("STORY_RECENT_SEGMENTS", "2"))
+
+
+def _summary_chars() -> int:
+    return int(os.getenv("STORY_SUMMARY_CHARS", "400"))
+
+
+def new_story(initial_state: str, final_state: str) -> StoryState:
+    return {
+        "initial_state": initial_state,
+        "final_state": final_state,
+        "segments": [],
+        "choices": [],
+        "summary": "",
+        "summarized": 0,
+        "question": "",
+        "options": [],
+    }
+
+
+def story_text(state: StoryState) -> str:
+    return "\n\n".join(state.get("segments", []))
+
+
+def story_finished(state: StoryState) -> bool:
+    """已经写过至少一段、且最后一步没有再给出选项，说明剧情到达了结束状态"""
+    return bool(state.get("segments")) and not state.get("options")
+
+
+def _step_payload(state: StoryState) -> dict:
+    segments = state.get("segments", [])
+    summarized = state.get("summarized", 0)
+    return {
+        "initial_state": state["initial_state"],
+        "final_state": state["final_state"],
+        "summary": state.get("summary") or "（故事刚刚开始）",
+        "recent": "\n\n".join(segments[summarized:]) or "（无）",
+        "choice": state.get("choice") or "（开篇，尚未做出选择）",
+        "step": len(segments) + 1,
+    }
+
+
+async def _astream_structured(chain_name: str, payload: dict, parser_name: str):
+    """流式调用结构化链：不断产出 (已生成的 segment 文本, None)，结束时产出 (None, 解析后的结果)"""
+    buffer = ""
+    last_segment = ""
+    async for chunk in get_chain(chain_name).astream(payload):
+        buffer += chunk
+        segment = extract_partial_json_string(buffer, "segment")
+        if segment and segment != last_segment:
+            last_segment = segment
+            yield segment, None
+    yield None, await get_component(parser_name).aparse(buffer)
+
+
+async def write(state: StoryState) -> dict:
+    """续写一段剧情并提出下一个问题；生成过程中通过 custom 流逐步推送已生成的剧情文本"""
+    from langgraph.config import get_stream_writer
+
+    writer = get_stream_writer()
+    step: Optional[StoryStep] = None
+    async for segment, step in _astream_structured("story_step_chain", _step_payload(state),
+                                                   "story_step_repair_parser"):
+        if segment is not None:
+            writer({"segment": segment})
+    return {
+        "segments": [step.segment],
+        "choices": [state["choice"]] if state.get("choice") else [],
+        "question": step.question,
+        "options": step.options,
+    }
+
+
+async def fold(state: StoryState) -> dict:
+    """把最近窗口之外的段落并入梗概；与 write 并行执行，write 本步仍使用旧梗概和完整的最近段落"""
+    segments = state["segments"]
+    end = len(segments) - _recent_segments()
+    summary = await get_chain("story_summary_chain").ainvoke({
+        "summary": state.get("summary") or "（无）",
+        "segments": "\n\n".join(segments[state.get("summarized", 0):end]),
+        "max_chars": _summary_chars(),
+    })
+    return {"summary": summary.strip(), "summarized": end}
+
+
+def _route(state: StoryState) -> List[str]:
+    unsummarized = len(state.get("segments", [])) - state.get("summarized", 0)
+    return ["write", "fold"] if unsummarized > _recent_segments() else ["write"]
+
+
+def build_story_graph():
+    # 与 llm.py 中的链一样推迟导入，页面启动时不加载 langgraph
+    from langgraph.graph import END, START, StateGraph
+
+    graph = StateGraph(StoryState)
+    graph.add_node("write", write)
+    graph.add_node("fold", fold)
+    graph.add_conditional_edges(START, _route, ["write", "fold"])
+    graph.add_edge("write", END)
+    graph.add_edge("fold", END)
+    return graph.compile()
+
+
+async def astream_story_step(state: StoryState, choice: str = "") -> AsyncIterator[Tuple[str, Optional[StoryState]]]:
+    """推进一步剧情。
+
+    生成过程中不断产出 (本段已生成的文本, None)；结束时产出 (本段完整文本, 新的 StoryState)。
+    传入的 state 不会被修改。
+    """
+    final_state: Optional[StoryState] = None
+    async for mode, chunk in get_component("story_graph").astream({**state, "choice": choice},
+                                                                  stream_mode=["custom", "values"]):
+        if mode == "custom":
+            yield chunk["segment"], None
+        else:
+            final_state = chunk
+    final_state.pop("choice", None)
+    yield final_state["segments"][-1], final_state
+
+
+async def astream_story_opening() -> AsyncIterator[Tuple[str, Optional[StoryState]]]:
+    """开局：一次调用生成初始/结束状态、开篇和第一个问题。
+
+    产出格式与 astream_story_step 相同，结束时的 StoryState 已包含开篇这一段。
+    """
+    opening: Optional[StoryOpening] = None
+    async for segment, opening in _astream_structured("story_opening_chain", {}, "story_opening_repair_parser"):
+        if segment is not None:
+            yield segment, None
+    if not (opening.initial_state.strip() and opening.final_state.strip() and opening.segment.strip()
+            and len(opening.options) >= 2):
+        from langchain_core.exceptions import OutputParserException
+
+        raise OutputParserException("未能生成完整的开局 (初始/结束状态、开篇和选项)")
+    state = new_story(opening.initial_state, opening.final_state)
+    state.update(segments=[opening.segment], question=opening.question, options=opening.options)
+    yield opening.segment, state
+
+
+async def generate_opening() -> StoryState:
+    """非流式地生成一份开局，供 SetupPool 预生成"""
+    state: Optional[StoryState] = None
+    async for _, state in astream_story_opening():
+        pass
+    return state
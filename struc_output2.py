@@ -3,9 +3,11 @@ from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 
 from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 
+from prompt_layout import cacheable_prompt
+from structured import structured_chain
+
 llm = ChatOpenAI(
     model_name="gpt-4o-mini",
     temperature=0.5,
@@ -22,23 +24,21 @@ format_instructions = output_parser.get_format_instructions()
 
 print(format_instructions)
 
-prompt_template = """
+system_template = """
 <format_instructions>
 {format_instructions}
-{format_instructions}
 </format_instructions>
+"""
 
+prompt_template = """
 <question>
 {question}
 </question>
 """
 
-prompt = PromptTemplate.from_template(
-    prompt_template,
-    partial_variables={'format_instructions': format_instructions}
-)
+prompt = cacheable_prompt(system_template, prompt_template, {'format_instructions': format_instructions})
 
-chain = prompt | llm | output_parser
+chain = structured_chain(prompt, llm, output_parser, "city")
 
 result = chain.invoke({"question": "What is the capital of France?"})
 
@@ -0,0 +1,133 @@
+"""原生结构化输出：用模型的 JSON schema (response_format, strict) 约束输出格式，
+不再把冗长的格式说明塞进提示词、事后再从 markdown 中解析 JSON。
+
+只在支持严格结构化输出的模型上启用 (STRICT_OUTPUT_MODELS)，其余模型 (如默认的 gpt-3.5-turbo) 直接使用
+原来的“格式说明 + 解析器”路径。原生调用因输出格式出错 (请求被拒绝、拒答、解析或校验失败) 时改走旧路径；
+限流、超时、连接错误照常抛出，交给调用方的退避重试，不会在限流时再多发一次请求。
+STRUCTURED_OUTPUT=parser 可整体切回旧路径。
+"""
+import os
+from typing import AsyncIterator, Iterator, Optional
+
+import openai
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessageChunk
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable, RunnableGenerator, RunnableLambda
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_openai.chat_models.base import OpenAIRefusalError
+from pydantic import ValidationError
+
+from llm_cache import ResponseCache, cached_llm
+from output_repair import repairing
+
+# 支持严格结构化输出 (response_format=json_schema, strict) 的模型前缀
+STRICT_OUTPUT_MODELS = ("gpt-4o", "gpt-4.1", "o1", "o3", "o4")
+
+# 只有这些异常说明原生输出格式有问题，值得改走格式说明路径
+FORMAT_ERRORS = (openai.BadRequestError, OpenAIRefusalError, OutputParserException, ValidationError)
+
+# ResponseSchema.type -> JSON schema
+_RESPONSE_SCHEMA_TYPES = {
+    "string": {"type": "string"},
+    "boolean": {"type": "boolean"},
+    "integer": {"type": "integer"},
+    "number": {"type": "number"},
+    "float": {"type": "number"},
+    "List[string]": {"type": "array", "items": {"type": "string"}},
+}
+
+
+def structured_output_mode() -> str:
+    return os.getenv("STRUCTURED_OUTPUT", "native")
+
+
+def supports_native(llm) -> bool:
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or ""
+    return model.startswith(STRICT_OUTPUT_MODELS)
+
+
+def output_schema(parser, name: str = "output"):
+    """解析器对应的输出结构：PydanticOutputParser 返回模型类，StructuredOutputParser 返回 JSON schema 字典"""
+    model = getattr(parser, "pydantic_object", None)
+    if model is not None:
+        return model
+    fields = parser.response_schemas
+    return {
+        "title": name,
+        "description": f"The {name} result",
+        "type": "object",
+        "properties": {
+            field.name: {**_RESPONSE_SCHEMA_TYPES.get(field.type, {"type": "string"}), "description": field.description}
+            for field in fields
+        },
+        "required": [field.name for field in fields],
+        "additionalProperties": False,
+    }
+
+
+def native_output(llm, parser, name: str = "output") -> Runnable:
+    """提示词 -> 与 parser 相同类型的结果 (Pydantic 对象或 dict)，由模型原生保证输出符合结构"""
+    return llm.with_structured_output(output_schema(parser, name), method="json_schema", strict=True)
+
+
+def _json_text(chunk: AIMessageChunk) -> str:
+    return chunk.content if isinstance(chunk.content, str) else ""
+
+
+def native_stream(llm, parser, name: str = "output") -> Runnable:
+    """流式版本：逐段产出符合结构的 JSON 原文，可配合增量解析器边生成边展示"""
+    tool = convert_to_openai_tool(output_schema(parser, name), strict=True)["function"]
+    bound = llm.bind(response_format={"type": "json_schema", "json_schema": {
+        "name": tool["name"], "schema": tool["parameters"], "strict": True}})
+
+    def transform(chunks: Iterator[AIMessageChunk]) -> Iterator[str]:
+        for chunk in chunks:
+            text = _json_text(chunk)
+            if text:
+                yield text
+
+    async def atransform(chunks: AsyncIterator[AIMessageChunk]) -> AsyncIterator[str]:
+        async for chunk in chunks:
+            text = _json_text(chunk)
+            if text:
+                yield text
+
+    return bound | RunnableGenerator(transform, atransform, name="native_json_text")
+
+
+def _count_fallback(chain_name: str) -> Runnable:
+    def count(value):
+        from metrics import get_metrics
+
+        get_metrics().count(chain_name, "fallbacks")
+        return value
+
+    return RunnableLambda(count, name="count_fallback")
+
+
+def structured_chain(prompt: BasePromptTemplate, llm, parser, chain_name: str, cache: Optional[ResponseCache] = None,
+                     bypass: bool = False, mode: Optional[str] = None) -> Runnable:
+    """prompt | llm | parser 的结构化输出版本。
+
+    prompt 中的 {format_instructions} 在原生模式下置空；兜底路径与原来一致 (格式说明 + 解析器，解析失败时逐级修复，
+    见 output_repair.py)，兜底次数记为该 chain 的 fallbacks 指标。两条路径的响应缓存互不混用。
+    """
+    parser_chain = prompt | cached_llm(llm, repairing(parser, chain_name), cache=cache, bypass=bypass)
+    if (mode or structured_output_mode()) != "native" or not supports_native(llm):
+        return parser_chain
+    native_chain = prompt.partial(format_instructions="") | cached_llm(
+        llm, parser, cache=cache, bypass=bypass, native=True, name=chain_name)
+    return native_chain.with_fallbacks([_count_fallback(chain_name) | parser_chain], exceptions_to_handle=FORMAT_ERRORS)
+
+
+def structured_stream_chain(prompt: BasePromptTemplate, llm, parser, chain_name: str,
+                            mode: Optional[str] = None) -> Runnable:
+    """流式链：产出 JSON 原文片段，最终结果仍需调用方用 parser 校验"""
+    from langchain_core.output_parsers import StrOutputParser
+
+    parser_chain = prompt | llm | StrOutputParser()
+    if (mode or structured_output_mode()) != "native" or not supports_native(llm):
+        return parser_chain
+    native_chain = prompt.partial(format_instructions="") | native_stream(llm, parser, chain_name)
+    return native_chain.with_fallbacks([_count_fallback(chain_name) | parser_chain], exceptions_to_handle=FORMAT_ERRORS)
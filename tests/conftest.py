@@ -0,0 +1,11 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "academy")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# 测试不访问网络：避免导入 llm 等模块时因缺少密钥报错
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("METRICS_PATH", "")
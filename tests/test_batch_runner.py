@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+
+from batch_runner import BatchRunner, RateLimiter, TokenBucket
+
+
+def test_token_bucket_waits_for_refill():
+    async def main():
+        bucket = TokenBucket(rate_per_minute=600, capacity=2)
+        started_at = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - started_at
+
+    # 前两个令牌立即可用，第三个要等 0.1s 补充
+    assert 0.08 <= asyncio.run(main()) < 0.5
+
+
+def test_token_bucket_caps_oversized_requests():
+    async def main():
+        bucket = TokenBucket(rate_per_minute=60, capacity=10)
+        await asyncio.wait_for(bucket.acquire(1000), 1)
+
+    asyncio.run(main())
+
+
+def test_token_bucket_scale_is_bounded():
+    bucket = TokenBucket(rate_per_minute=100)
+    for _ in range(10):
+        bucket.scale(0.5)
+    assert bucket.rate == pytest.approx(5)
+    for _ in range(100):
+        bucket.scale(1.1)
+    assert bucket.rate == 100
+
+
+def test_rate_limiter_backs_off_and_recovers():
+    limiter = RateLimiter(rpm=100, tpm=1000, backoff_base=2, backoff_max=10, recover_after=2)
+    assert 2 <= limiter.on_rate_limited() <= 2.4
+    assert 4 <= limiter.on_rate_limited() <= 4.8
+    assert limiter.requests.rate == 25 and limiter.tokens.rate == 250
+    assert limiter.on_rate_limited(retry_after=1) <= 1.2
+    limiter.on_success()
+    limiter.on_success()
+    assert limiter.requests.rate == pytest.approx(12.5 * 1.1)
+
+
+def test_run_keeps_input_order():
+    async def worker(item):
+        await asyncio.sleep(0.01 * (5 - item))
+        return item * 2
+
+    assert asyncio.run(BatchRunner(worker, concurrency=3).run(range(5))) == [0, 2, 4, 6, 8]
+
+
+def test_run_uses_on_error_fallback():
+    async def worker(item):
+        if item == 1:
+            raise ValueError("bad")
+        return item
+
+    results = asyncio.run(BatchRunner(worker, concurrency=2).run([0, 1, 2], on_error=lambda item, error: -1))
+    assert results == [0, -1, 2]
+
+
+def test_input_iterator_error_is_raised_instead_of_hanging():
+    async def worker(item):
+        return item
+
+    def items():
+        yield 0
+        yield 1
+        raise RuntimeError("broken input")
+
+    async def main():
+        seen = []
+        with pytest.raises(RuntimeError, match="broken input"):
+            async for _, item, _, _ in BatchRunner(worker, concurrency=2).iter_completed(items()):
+                seen.append(item)
+        return seen
+
+    assert sorted(asyncio.run(asyncio.wait_for(main(), 5))) == [0, 1]
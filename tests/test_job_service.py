@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from job_service import CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobRejected, JobService
+from runtime import BackgroundLoop
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "超时"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def make_service():
+    services = []
+
+    def make(**kwargs):
+        service = JobService(loop=BackgroundLoop(name="test-job-loop"), **kwargs).start()
+        services.append(service)
+        return service
+
+    yield make
+    for service in services:
+        async def shutdown():
+            for worker in service._workers:
+                worker.cancel()
+            await asyncio.gather(*service._workers, return_exceptions=True)
+
+        service._background.run(shutdown())
+        service._background.stop()
+
+
+def blocker(gate: threading.Event, started=None, name=None):
+    async def work():
+        if started is not None:
+            started.append(name)
+        while not gate.is_set():
+            await asyncio.sleep(0.005)
+        return name
+    return work
+
+
+def test_coroutine_and_generator_jobs(make_service):
+    service = make_service(concurrency=2)
+
+    async def answer():
+        return 42
+
+    async def steps():
+        for i in range(3):
+            yield i
+
+    job = service.submit("u", answer)
+    stream = service.submit("u", steps)
+    wait_until(lambda: job.finished and stream.finished)
+    assert (job.status, job.result) == (DONE, 42)
+    assert (stream.status, stream.result, stream.partial) == (DONE, 2, 2)
+    assert stream.first_output_at is not None
+
+
+def test_failed_job_keeps_the_error(make_service):
+    service = make_service(concurrency=1)
+
+    async def boom():
+        raise ValueError("bad")
+
+    job = service.submit("u", boom)
+    wait_until(lambda: job.finished)
+    assert job.status == FAILED and isinstance(job.error, ValueError)
+    assert service.stats()[FAILED] == 1
+
+
+def test_users_take_turns_and_position(make_service):
+    service = make_service(concurrency=1, max_jobs_per_user=3)
+    gate, started = threading.Event(), []
+    first = service.submit("a", blocker(gate, started, "a0"))
+    wait_until(lambda: first.status == RUNNING)
+    a1 = service.submit("a", blocker(gate, started, "a1"))
+    a2 = service.submit("a", blocker(gate, started, "a2"))
+    b1 = service.submit("b", blocker(gate, started, "b1"))
+    assert [service.position(job.id) for job in (a1, b1, a2)] == [0, 1, 2]
+    assert service.position(first.id) is None
+    gate.set()
+    wait_until(lambda: all(job.finished for job in (a1, a2, b1)))
+    assert started == ["a0", "a1", "b1", "a2"]
+
+
+def test_backpressure(make_service):
+    service = make_service(concurrency=1, max_queue=2, max_jobs_per_user=2)
+    gate = threading.Event()
+    running = service.submit("a", blocker(gate))
+    wait_until(lambda: running.status == RUNNING)
+    service.submit("a", blocker(gate))
+    with pytest.raises(JobRejected):
+        service.submit("a", blocker(gate))
+    service.submit("b", blocker(gate))
+    with pytest.raises(JobRejected):
+        service.submit("c", blocker(gate))
+    assert service.stats()["rejected"] == 2
+    gate.set()
+
+
+def test_cancel_queued_and_running_jobs(make_service):
+    service = make_service(concurrency=1)
+    gate = threading.Event()
+    running = service.submit("a", blocker(gate))
+    wait_until(lambda: running.status == RUNNING)
+    queued = service.submit("b", blocker(gate, name="b"))
+    assert service.cancel(queued.id)
+    assert queued.status == CANCELLED and service.position(queued.id) is None
+
+    nxt = service.submit("c", blocker(gate, name="c"))
+    assert nxt.status == QUEUED
+    assert service.cancel(running.id)
+    wait_until(lambda: running.finished)
+    assert running.status == CANCELLED
+    # worker 继续执行下一个任务，不受取消影响
+    gate.set()
+    wait_until(lambda: nxt.finished)
+    assert (nxt.status, nxt.result) == (DONE, "c")
+    assert not service.cancel(nxt.id)
+
+
+def test_late_cancel_does_not_hit_the_next_job(make_service):
+    service = make_service(concurrency=1)
+    gate = threading.Event()
+    first = service.submit("a", blocker(gate, name="a"))
+    wait_until(lambda: first.status == RUNNING)
+    # cancel() 在锁内读到任务后释放锁，任务在取消生效前就结束了
+    task = first._task
+    gate.set()
+    wait_until(lambda: first.finished)
+    gate.clear()
+    following = service.submit("b", blocker(gate, name="b"))
+    wait_until(lambda: following.status == RUNNING)
+    service._background.loop.call_soon_threadsafe(task.cancel)
+    time.sleep(0.05)
+    gate.set()
+    wait_until(lambda: following.finished)
+    assert (following.status, first.status) == (DONE, DONE)
+    assert not service.cancel(first.id)
@@ -0,0 +1,51 @@
+import json
+
+from journal_index import JournalIndex, normalize_issn, normalize_title
+
+
+def test_normalize_title_and_issn():
+    assert normalize_title("The Journal of Finance & Economics.") == "journal of finance and economics"
+    assert normalize_title(None) == ""
+    assert normalize_issn("0022-1082") == "00221082"
+    assert normalize_issn("1234-567x") == "1234567X"
+    assert normalize_issn("N/A") is None
+
+
+def make_index():
+    index = JournalIndex()
+    index.add("Journal of Finance", ["0022-1082"], {"category": "Finance"})
+    index.add("Internet Research", ["1066-2243", None], {"category": "Information Systems"})
+    return index
+
+
+def test_lookup_by_issn_title_and_fuzzy_title():
+    index = make_index()
+    assert index.lookup("Something else", ["00221082"]) == {"category": "Finance"}
+    assert index.lookup("the internet research")["category"] == "Information Systems"
+    assert index.lookup("Journal of Financee")["category"] == "Finance"
+    assert index.lookup("Journal of Marketing") is None
+    stats = index.stats()
+    assert stats["hits"] == {"issn": 1, "title": 1, "fuzzy": 1}
+    assert stats["lookups"] == 4 and stats["hit_rate"] == 0.75
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "index.json")
+    make_index().save(path)
+    loaded = JournalIndex.load(path)
+    assert len(loaded) == 2
+    assert loaded.lookup("", ["1066-2243"])["category"] == "Information Systems"
+
+
+def test_build_uses_source_issns_and_skips_invalid_records(tmp_path):
+    table = tmp_path / "table.json"
+    table.write_text(json.dumps([
+        {"title": "Journal of Finance", "print issn": "0022-1082", "online issn": None},
+        {"title": "Internet Research", "print issn": "1066-2243", "online issn": None},
+    ]))
+    output = tmp_path / "output.json"
+    output.write_text(json.dumps([{"category": "Finance", "issn": "9999-9999"}, {}]))
+    index = JournalIndex.build(str(table), [str(output), str(tmp_path / "missing.json")])
+    assert len(index) == 1
+    assert index.lookup("", ["0022-1082"])["category"] == "Finance"
+    assert index.lookup("", ["9999-9999"]) is None
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from pydantic import BaseModel
+
+from llm_cache import ResponseCache, cached_llm, make_cache_key
+
+
+def test_cache_key_depends_on_every_part():
+    key = make_cache_key("prompt", "gpt-4o-mini", 0.5, "schema")
+    assert key == make_cache_key("prompt", "gpt-4o-mini", 0.5, "schema")
+    assert len({key, make_cache_key("prompt!", "gpt-4o-mini", 0.5, "schema"),
+                make_cache_key("prompt", "gpt-4.1", 0.5, "schema"), make_cache_key("prompt", "gpt-4o-mini", 0, "schema"),
+                make_cache_key("prompt", "gpt-4o-mini", 0.5, "other")}) == 5
+
+
+def test_get_set_and_stats():
+    cache = ResponseCache(":memory:")
+    assert cache.get("a") is None
+    cache.set("a", "1")
+    assert cache.get("a") == "1"
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_expired_entries_are_dropped():
+    cache = ResponseCache(":memory:", ttl=0.01)
+    cache.set("a", "1")
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+
+def count(cache):
+    return cache._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def test_evicts_least_recently_used_every_n_writes():
+    cache = ResponseCache(":memory:", max_entries=3, evict_every=2)
+    for key in "abc":
+        cache.set(key, key)
+        time.sleep(0.001)
+    cache.get("a")
+    cache.set("d", "d")
+    # 第 4 次写入时检查容量，淘汰最久未访问的 b
+    assert count(cache) == 3
+    assert cache.get("b") is None and cache.get("a") == "a"
+    cache.set("e", "e")
+    # 第 5 次写入不检查，短暂超出容量
+    assert count(cache) == 4
+
+
+class Answer(BaseModel):
+    value: str
+
+
+def test_cached_llm_only_calls_the_model_once():
+    model = FakeListChatModel(responses=['{"value": "first"}', '{"value": "second"}'])
+    parser = PydanticOutputParser(pydantic_object=Answer)
+    chain = ChatPromptTemplate.from_messages([("human", "{question}")]) | cached_llm(
+        model, parser, cache=ResponseCache(":memory:"))
+    assert chain.invoke({"question": "q"}).value == "first"
+    assert chain.invoke({"question": "q"}).value == "first"
+    assert chain.invoke({"question": "other"}).value == "second"
+
+
+def test_async_cache_io_runs_off_the_event_loop():
+    class RecordingCache(ResponseCache):
+        def get(self, key):
+            threads.append(threading.get_ident())
+            return super().get(key)
+
+        def set(self, key, value):
+            threads.append(threading.get_ident())
+            super().set(key, value)
+
+    threads = []
+    model = FakeListChatModel(responses=['{"value": "first"}'])
+    chain = ChatPromptTemplate.from_messages([("human", "{question}")]) | cached_llm(
+        model, PydanticOutputParser(pydantic_object=Answer), cache=RecordingCache(":memory:"))
+
+    async def main():
+        assert (await chain.ainvoke({"question": "q"})).value == "first"
+        assert (await chain.ainvoke({"question": "q"})).value == "first"
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    assert len(threads) == 3 and loop_thread not in threads
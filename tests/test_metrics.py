@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+import uuid
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import RunnableLambda
+
+import metrics
+from metrics import MetricsCallbackHandler, MetricsRecorder, estimate_cost, percentile
+
+
+def make_handler():
+    return MetricsCallbackHandler(MetricsRecorder(path=None))
+
+
+def test_percentile_interpolates():
+    assert percentile([], 0.5) is None
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile([0, 10], 0.95) == 9.5
+
+
+def test_estimate_cost_matches_longest_prefix_and_discounts_cached_tokens():
+    assert estimate_cost("gpt-4o-mini-2024-07-18", 1_000_000, 0) == 0.15
+    assert estimate_cost("gpt-4o", 1_000_000, 1_000_000, cached_tokens=1_000_000) == 1.25 + 10.0
+    assert estimate_cost("unknown", 100, 100) == 0.0
+
+
+def test_llm_run_is_recorded_with_tokens():
+    handler = make_handler()
+    run_id = uuid.uuid4()
+    handler.on_chat_model_start({}, [], run_id=run_id, metadata={"chain": "c"},
+                                invocation_params={"model_name": "gpt-4o-mini"})
+    handler.on_llm_new_token("a", run_id=run_id)
+    handler.on_llm_end(LLMResult(generations=[], llm_output={
+        "token_usage": {"prompt_tokens": 10, "completion_tokens": 5}, "model_name": "gpt-4o-mini"}), run_id=run_id)
+    summary = handler.recorder.summary()["c"]
+    assert summary["calls"] == 1 and summary["prompt_tokens"] == 10 and summary["completion_tokens"] == 5
+    assert summary["ttft_p50"] is not None
+    assert not handler._runs
+
+
+def test_parse_failure_counted_once_per_error():
+    handler = make_handler()
+    error = OutputParserException("bad")
+    outer, inner = uuid.uuid4(), uuid.uuid4()
+    handler.on_chain_start({}, {}, run_id=outer, metadata={"chain": "c"})
+    handler.on_chain_start({}, {}, run_id=inner, metadata={"chain": "c"})
+    handler.on_chain_error(error, run_id=inner)
+    handler.on_chain_error(error, run_id=outer)
+    assert handler.recorder.counters["c"]["parse_failures"] == 1
+    assert not handler._chains
+
+
+def test_cancelled_chain_is_removed():
+    handler = make_handler()
+
+    async def slow(x):
+        await asyncio.sleep(5)
+        return x
+
+    async def main():
+        chain = (RunnableLambda(slow) | RunnableLambda(lambda x: x)).with_config(
+            callbacks=[handler], metadata={"chain": "c"})
+        task = asyncio.create_task(chain.ainvoke(1))
+        await asyncio.sleep(0.05)
+        assert handler._chains
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    assert not handler._chains
+
+
+def test_stale_runs_are_pruned(monkeypatch):
+    monkeypatch.setattr(metrics, "STALE_RUNS_CHECK", 3)
+    monkeypatch.setattr(metrics, "STALE_RUN_SECONDS", 0.01)
+    handler = make_handler()
+    for _ in range(3):
+        handler.on_chain_start({}, {}, run_id=uuid.uuid4())
+        handler.on_llm_start({}, [], run_id=uuid.uuid4())
+    time.sleep(0.02)
+    handler.on_chain_start({}, {}, run_id=uuid.uuid4())
+    handler.on_llm_start({}, [], run_id=uuid.uuid4())
+    assert len(handler._chains) == 1 and len(handler._runs) == 1
+
+
+def test_concurrent_callbacks_from_threads():
+    handler = make_handler()
+
+    def worker():
+        for _ in range(200):
+            chain_id, llm_id = uuid.uuid4(), uuid.uuid4()
+            handler.on_chain_start({}, {}, run_id=chain_id, metadata={"chain": "c"})
+            handler.on_llm_start({}, [], run_id=llm_id, metadata={"chain": "c"})
+            handler.on_llm_error(RuntimeError("x"), run_id=llm_id)
+            handler.on_chain_end({}, run_id=chain_id)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert handler.recorder.summary()["c"]["errors"] == 1600
+    assert not handler._chains and not handler._runs
@@ -0,0 +1,161 @@
+import asyncio
+from typing import List
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
+from pydantic import BaseModel
+
+from llm_cache import ResponseCache, cached_llm
+from metrics import get_metrics
+from output_repair import PackedOutputParser, RepairingOutputParser, repairing
+
+
+class Story(BaseModel):
+    title: str
+    story: str
+
+
+class Step(BaseModel):
+    segment: str
+    options: List[str] = []
+
+
+class Journal(BaseModel):
+    title: str
+    issn: str
+    category: str
+
+
+def counters(chain):
+    return dict(get_metrics().counters[chain])
+
+
+def make(chain, fix_model=""):
+    return repairing(PydanticOutputParser(pydantic_object=Story), chain, fix_model=fix_model)
+
+
+def test_valid_output_is_parsed_without_repair():
+    parser = make("repair_valid")
+    assert parser.parse('{"title": "T", "story": "S"}') == Story(title="T", story="S")
+    assert counters("repair_valid") == {}
+
+
+def test_local_repair():
+    parser = make("repair_local")
+    assert parser.parse('```json\n{"title": "T", "story": "他说"走"",}\n```') == Story(title="T", story='他说"走"')
+    assert counters("repair_local") == {"repair_local": 1}
+
+
+def test_truncated_output_keeps_only_complete_fields():
+    parser = repairing(PydanticOutputParser(pydantic_object=Step), "repair_partial", fix_model="")
+    assert parser.parse('{"segment": "S", "options": ["A", "B') == Step(segment="S", options=["A"])
+    assert counters("repair_partial") == {"repair_partial": 1}
+
+
+def test_truncated_value_is_not_accepted():
+    parser = repairing(PydanticOutputParser(pydantic_object=Journal), "repair_truncated", fix_model="")
+    # 原解析器会把 "Comput" 当作完整的类别
+    with pytest.raises(OutputParserException):
+        parser.parse('{"title": "X", "issn": "1", "category": "Comput')
+    assert counters("repair_truncated") == {"repair_failed": 1}
+
+
+def test_truncated_outputs_are_not_cached():
+    model = FakeListChatModel(responses=['{"title": "X", "issn": "1", "category": "Comput',
+                                         '{"title": "X", "issn": "1", "category": "Computer Science"}'])
+    cache = ResponseCache(":memory:")
+    parser = repairing(PydanticOutputParser(pydantic_object=Journal), "repair_cache", fix_model="")
+    chain = ChatPromptTemplate.from_messages([("human", "{title}")]) | cached_llm(model, parser, cache=cache)
+    with pytest.raises(OutputParserException):
+        chain.invoke({"title": "X"})
+    assert chain.invoke({"title": "X"}).category == "Computer Science"
+    assert chain.invoke({"title": "X"}).category == "Computer Science"
+
+    model = FakeListChatModel(responses=['{"segment": "S", "options": ["A", "B'])
+    cache = ResponseCache(":memory:")
+    parser = repairing(PydanticOutputParser(pydantic_object=Step), "repair_cache_partial", fix_model="")
+    chain = ChatPromptTemplate.from_messages([("human", "{choice}")]) | cached_llm(model, parser, cache=cache)
+    assert asyncio.run(chain.ainvoke({"choice": "A"})) == Step(segment="S", options=["A"])
+    assert cache._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 0
+
+
+def test_broken_structure_falls_back_to_string_fields():
+    parser = make("repair_fields")
+    assert parser.parse('{"title": "T" "story": "S"}') == Story(title="T", story="S")
+    assert counters("repair_fields") == {"repair_partial": 1}
+
+
+def test_failure_without_fix_model_raises():
+    parser = make("repair_failed")
+    with pytest.raises(OutputParserException):
+        parser.parse("not json")
+    assert counters("repair_failed") == {"repair_failed": 1}
+
+
+def test_llm_repair_is_the_last_resort():
+    parser = make("repair_llm", fix_model="fake")
+    calls = []
+
+    def fix(inputs):
+        calls.append(inputs)
+        return Story(title="fixed", story="S")
+
+    parser._fix_chain = RunnableLambda(fix)
+    assert parser.parse("not json") == Story(title="fixed", story="S")
+    assert asyncio.run(parser.aparse("still not json")) == Story(title="fixed", story="S")
+    assert [call["text"] for call in calls] == ["not json", "still not json"]
+    assert counters("repair_llm") == {"repair_llm": 2}
+
+
+def test_llm_repair_failure_raises_the_original_error():
+    parser = make("repair_llm_failed", fix_model="fake")
+
+    def fail(inputs):
+        raise RuntimeError("down")
+
+    parser._fix_chain = RunnableLambda(fail)
+    with pytest.raises(OutputParserException):
+        parser.parse("not json")
+    assert counters("repair_llm_failed") == {"repair_failed": 1}
+
+
+def test_repairing_keeps_the_inner_parser_interface():
+    inner = PydanticOutputParser(pydantic_object=Story)
+    parser = repairing(inner, "repair_interface", fix_model="")
+    assert repairing(parser, "other") is parser
+    assert isinstance(parser, RepairingOutputParser)
+    assert parser.pydantic_object is Story
+    assert parser.get_format_instructions() == inner.get_format_instructions()
+
+
+def test_packed_output_accepts_arrays_and_wrapped_arrays():
+    parser = PackedOutputParser(chain_name="packed_ok")
+    assert parser.parse('```json\n[{"id": 0, "category": "A"}, {"id": 1, "category": "B"}]\n```') == [
+        {"id": 0, "category": "A"}, {"id": 1, "category": "B"}]
+    assert parser.parse('{"journals": [{"id": 0}, 1]}') == [{"id": 0}]
+    assert parser.parse('{"id": 0, "match": true}') == [{"id": 0, "match": True}]
+    assert counters("packed_ok") == {}
+
+
+def test_packed_output_drops_the_truncated_last_record():
+    parser = PackedOutputParser(chain_name="packed_truncated")
+    text = '[{"id": 0, "category": "A"}, {"id": 1, "category": "B", "publisher": "Spr'
+    assert parser.parse(text) == [{"id": 0, "category": "A"}]
+    assert counters("packed_truncated") == {"repair_partial": 1}
+    with pytest.raises(OutputParserException):
+        parser.parse("no json")
+
+
+def test_truncated_packed_output_is_not_cached():
+    model = FakeListChatModel(responses=['[{"id": 0, "category": "A"}, {"id": 1, "category": "Comp',
+                                         '[{"id": 0, "category": "A"}, {"id": 1, "category": "B"}]'])
+    chain = ChatPromptTemplate.from_messages([("human", "{journals}")]) | cached_llm(
+        model, PackedOutputParser(chain_name="packed_cache"), cache=ResponseCache(":memory:"))
+    assert chain.invoke({"journals": "[0] a\n[1] b"}) == [{"id": 0, "category": "A"}]
+    assert len(chain.invoke({"journals": "[0] a\n[1] b"})) == 2
+    # 完整的结果已缓存
+    assert len(chain.invoke({"journals": "[0] a\n[1] b"})) == 2
@@ -0,0 +1,61 @@
+import pytest
+
+from partial_json import (extract_partial_json_string, extract_string_fields, is_truncated, repair_json,
+                          strip_markdown)
+
+
+def test_extract_partial_string_while_streaming():
+    assert extract_partial_json_string('{"title": "A', "story") is None
+    assert extract_partial_json_string('{"story": "', "story") == ""
+    assert extract_partial_json_string('{"story": "line\\nnext', "story") == "line\nnext"
+    assert extract_partial_json_string('{"story": "done", "x": 1}', "story") == "done"
+
+
+def test_extract_partial_string_waits_for_incomplete_escapes():
+    assert extract_partial_json_string('{"story": "ab\\', "story") == "ab"
+    assert extract_partial_json_string('{"story": "ab\\u4e', "story") == "ab"
+    assert extract_partial_json_string('{"story": "ab\\u4e2d', "story") == "ab中"
+
+
+def test_strip_markdown():
+    assert strip_markdown('Here you go:\n```json\n{"a": 1}\n```\nthanks') == '{"a": 1}'
+    assert strip_markdown('```json\n{"a": 1') == '{"a": 1'
+    assert strip_markdown('result: [1, 2]') == '[1, 2]'
+
+
+def test_repair_unescaped_quotes_newlines_and_trailing_commas():
+    data, truncated = repair_json('{"story": "他说"你好"\n然后离开", "tags": ["a", "b",],}')
+    assert data == {"story": '他说"你好"\n然后离开', "tags": ["a", "b"]}
+    assert not truncated
+
+
+def test_repair_truncated_output():
+    assert repair_json('{"title": "T", "items": [1, 2') == ({"title": "T", "items": [1, 2]}, True)
+    # 被截断的字符串值整个丢弃，不把半个值当作完整结果
+    assert repair_json('{"title": "X", "issn": "1", "category": "Comput') == ({"title": "X", "issn": "1"}, True)
+    assert repair_json('{"options": ["A", "B') == ({"options": ["A"]}, True)
+    assert repair_json('{"title": "T", "story": "ab\\u4e') == ({"title": "T"}, True)
+    # 悬空的键被丢弃
+    assert repair_json('{"title": "T", "story": ') == ({"title": "T"}, True)
+    assert repair_json('{"title": "T", "sto') == ({"title": "T"}, True)
+
+
+def test_is_truncated():
+    assert is_truncated('{"category": "Comput')
+    assert is_truncated('```json\n{"a": [1, 2')
+    assert not is_truncated('{"a": "x"} trailing words')
+    assert not is_truncated("no json here")
+
+
+def test_repair_ignores_text_after_the_object():
+    assert repair_json('{"a": 1} and some words') == ({"a": 1}, False)
+
+
+def test_repair_raises_when_hopeless():
+    with pytest.raises(ValueError):
+        repair_json("no json here")
+
+
+def test_extract_string_fields_skips_missing_keys():
+    text = '{"title": "T", "story": "broken "quote" here'
+    assert extract_string_fields(text, ["title", "story", "missing"]) == {"title": "T", "story": "broken "}
@@ -0,0 +1,74 @@
+import os
+
+import pyarrow as pa
+import pytest
+
+from results_store import ParquetRunWriter, list_runs, run_summary
+
+SCHEMA = pa.schema([
+    ("category", pa.string()),
+    ("status", pa.string()),
+    ("latency_s", pa.float64()),
+    ("prompt_tokens", pa.int64()),
+    ("cache_hit", pa.bool_()),
+])
+
+
+def row(category, status="ok", latency=1.0, tokens=10, cache_hit=False):
+    return {"category": category, "status": status, "latency_s": latency, "prompt_tokens": tokens,
+            "cache_hit": cache_hit}
+
+
+def test_rows_are_readable_before_close(tmp_path):
+    root = str(tmp_path)
+    writer = ParquetRunWriter(root, SCHEMA, "run1", row_group_size=2)
+    writer.extend([row("a"), row("b"), row("a")])
+    # 前两行已写出为完整的文件，第三行还在缓冲中
+    assert writer.rows == 2 and list_runs(root) == ["run1"]
+    assert run_summary(root)["total"]["rows"] == 2
+    writer.close()
+    assert writer.rows == 3 and writer.row_groups == 2
+    assert run_summary(root)["total"]["rows"] == 3
+
+
+def test_flushes_after_interval(tmp_path):
+    writer = ParquetRunWriter(str(tmp_path), SCHEMA, "run1", row_group_size=1000, flush_seconds=0)
+    writer.append(row("a"))
+    assert writer.rows == 1
+
+
+def test_unfinished_temporary_files_are_ignored(tmp_path):
+    root = str(tmp_path)
+    with ParquetRunWriter(root, SCHEMA, "run1") as writer:
+        writer.append(row("a"))
+    with open(os.path.join(writer.directory, ".part-00001.parquet"), "wb") as f:
+        f.write(b"truncated")
+    assert run_summary(root)["total"]["rows"] == 1
+
+
+def test_existing_run_id_gets_a_suffix(tmp_path):
+    root = str(tmp_path)
+    for _ in range(2):
+        with ParquetRunWriter(root, SCHEMA, "run1") as writer:
+            writer.append(row("a"))
+    assert writer.run_id == "run1-2"
+    assert list_runs(root) == ["run1", "run1-2"]
+
+
+def test_run_summary_per_run_and_total(tmp_path):
+    root = str(tmp_path)
+    with ParquetRunWriter(root, SCHEMA, "a", row_group_size=2) as writer:
+        writer.extend([row("x", latency=1), row("x", latency=3, cache_hit=True), row("y", status="failed", latency=2)])
+    with ParquetRunWriter(root, SCHEMA, "b") as writer:
+        writer.append(row("y", tokens=5))
+    summary = run_summary(root, batch_size=1)
+    run_a = summary["runs"]["a"]
+    assert run_a["rows"] == 3
+    assert run_a["failure_rate"] == pytest.approx(1 / 3)
+    assert run_a["category_distribution"] == {"x": 1.0}
+    assert run_a["mean_latency_s"] == pytest.approx(2)
+    assert run_a["cache_hit_rate"] == pytest.approx(1 / 3)
+    assert run_a["prompt_tokens"] == 30
+    total = summary["total"]
+    assert total["rows"] == 4 and total["category_count"] == 2 and total["prompt_tokens"] == 35
+    assert run_summary(root, runs=["b"])["total"]["rows"] == 1
@@ -0,0 +1,102 @@
+import asyncio
+import itertools
+
+import pytest
+from langchain_core.runnables import RunnableGenerator, RunnableLambda
+
+from router import LatencyBudgetExceeded, LatencyTracker, Route, RoutedChain
+
+HEDGED = Route(models=["m"], hedge=True, hedge_delay=0.05, min_samples=1000, budget=5)
+
+
+def fake_chains(delays, fail=()):
+    """第 i 次调用等待 delays[i] 秒，序号在 fail 中的调用抛出异常；返回 (非流式链, 流式链)"""
+    calls = itertools.count()
+
+    async def call():
+        index = next(calls)
+        await asyncio.sleep(delays[index])
+        if index in fail:
+            raise RuntimeError(f"call {index} failed")
+        return index
+
+    async def invoke(_):
+        return await call()
+
+    async def stream(inputs):
+        async for _ in inputs:
+            yield await call()
+            yield "rest"
+
+    return RunnableLambda(invoke), RunnableGenerator(stream)
+
+
+def routed_chain(chain, route=HEDGED):
+    routed = RoutedChain("test", lambda llm: chain, route)
+    routed._chain = lambda model: chain
+    return routed
+
+
+def test_hedge_delay_uses_p95_once_enough_samples():
+    route = Route(models=["m"], hedge_delay=1, min_samples=5)
+    tracker = LatencyTracker()
+    assert tracker.hedge_delay("m", route) == 1
+    assert tracker.hedge_delay("m", route, max_tokens=100) == 3
+    for seconds in (1, 2, 3, 4, 10):
+        tracker.add("m", seconds)
+    assert 4 < tracker.hedge_delay("m", route, max_tokens=100) <= 10
+
+
+def test_hedge_wins_and_primary_latency_is_recorded():
+    async def main():
+        chain, _ = fake_chains([0.4, 0.01])
+        routed = routed_chain(chain)
+        result = await routed.ainvoke({})
+        assert not routed.latency.samples["m"]
+        await asyncio.sleep(0.5)
+        return result, list(routed.latency.samples["m"])
+
+    result, samples = asyncio.run(main())
+    assert result == 1
+    # 记录的是主请求自身的延迟，而不是先返回的对冲请求
+    assert len(samples) == 1 and samples[0] >= 0.4
+
+
+def test_hedge_covers_primary_failure():
+    chain, _ = fake_chains([0.2, 0.3], fail={0})
+    assert asyncio.run(routed_chain(chain).ainvoke({})) == 1
+
+
+def test_budget_exceeded():
+    chain, _ = fake_chains([1])
+    route = Route(models=["m"], budget=0.1)
+    with pytest.raises(LatencyBudgetExceeded):
+        asyncio.run(routed_chain(chain, route).ainvoke({}))
+
+
+async def collect(routed):
+    return [chunk async for chunk in routed.astream({})]
+
+
+def test_stream_hedge_wins_and_primary_latency_is_recorded():
+    async def main():
+        _, stream = fake_chains([0.4, 0.01])
+        routed = routed_chain(stream)
+        chunks = await collect(routed)
+        await asyncio.sleep(0.5)
+        return chunks, list(routed.latency.samples["m"])
+
+    chunks, samples = asyncio.run(main())
+    assert chunks == [1, "rest"]
+    assert len(samples) == 1 and samples[0] >= 0.4
+
+
+def test_stream_falls_over_to_hedge_when_primary_fails():
+    _, stream = fake_chains([0.2, 0.3], fail={0})
+    assert asyncio.run(collect(routed_chain(stream))) == [1, "rest"]
+
+
+def test_stream_raises_first_error_when_both_fail():
+    _, stream = fake_chains([0.2, 0.3], fail={0, 1})
+    with pytest.raises(RuntimeError, match="call 0 failed"):
+        asyncio.run(collect(routed_chain(stream)))
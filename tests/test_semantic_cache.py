@@ -0,0 +1,56 @@
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+
+from semantic_cache import SemanticCache, SemanticIndex, hashing_vector, semantic_cached
+
+
+def test_hashing_vector_is_normalized_and_similar_for_near_duplicates():
+    a = hashing_vector("主角在漂浮于云海之上的废弃图书馆中醒来")
+    b = hashing_vector("主角在漂浮于云海之上的废弃图书馆里醒来")
+    c = hashing_vector("完全不同的故事：深海潜艇的舱室")
+    assert abs(np.linalg.norm(a) - 1) < 1e-5
+    assert a @ b > 0.8 > 0.2 > a @ c
+
+
+def test_index_evicts_least_recently_used_slot():
+    index = SemanticIndex(dim=4, max_entries=2)
+    first = index.add(np.array([1, 0, 0, 0], dtype=np.float32), "a")
+    index.add(np.array([0, 1, 0, 0], dtype=np.float32), "b")
+    index.get(first)
+    index.add(np.array([0, 0, 1, 0], dtype=np.float32), "c")
+    assert sorted(index.values) == ["a", "c"]
+
+
+def counting_chain():
+    calls = []
+
+    def generate(value):
+        calls.append(value)
+        return f"result {len(calls)}"
+
+    return RunnableLambda(generate), calls
+
+
+def test_similar_input_reuses_result():
+    chain, calls = counting_chain()
+    cached = semantic_cached(chain, "test", SemanticCache(diversity=0.0, seed=0))
+    first = cached.invoke({"initial_state": "主角在漂浮于云海之上的废弃图书馆中醒来"})
+    assert cached.invoke({"initial_state": "主角在漂浮于云海之上的废弃图书馆里醒来"}) == first
+    assert cached.invoke({"initial_state": "老船长在雨夜的港口码头被陌生人追赶"}) != first
+    assert len(calls) == 2
+
+
+def test_diversity_regenerates_on_hit():
+    chain, calls = counting_chain()
+    cached = semantic_cached(chain, "test", SemanticCache(diversity=1.0, seed=0))
+    for _ in range(3):
+        cached.invoke({"initial_state": "主角在漂浮于云海之上的废弃图书馆中醒来"})
+    assert len(calls) == 3
+
+
+def test_empty_input_is_never_cached():
+    chain, calls = counting_chain()
+    cache = SemanticCache(diversity=0.0, seed=0)
+    cached = semantic_cached(chain, "test", cache)
+    assert cached.invoke({}) != cached.invoke({})
+    assert len(calls) == 2 and cache.stats()["entries"] == {}
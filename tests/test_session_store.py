@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from session_store import SessionStore
+from story_graph import new_story
+
+
+def play(store, session_id, steps, fold_at=None):
+    """推进 steps 步并逐步保存，fold_at 那一步把前面的段落并入梗概"""
+    state = new_story("起点", "终点")
+    for step in range(1, steps + 1):
+        state["segments"] = state["segments"] + [f"第{step}段"]
+        if step > 1:
+            state["choices"] = state["choices"] + [f"选择{step - 1}"]
+        state["question"] = f"问题{step}"
+        state["options"] = [f"A{step}", f"B{step}"]
+        if step == fold_at:
+            state["summary"] = f"前{step - 1}段的梗概"
+            state["summarized"] = step - 1
+        store.save_step(session_id, state)
+    return state
+
+
+def test_load_replays_every_step():
+    store = SessionStore(":memory:")
+    session_id = store.create("u", "起点", "终点")
+    state = play(store, session_id, 4, fold_at=3)
+    assert store.load(session_id) == state
+    assert store.get(session_id)["steps"] == 4
+
+
+def test_load_first_steps_only():
+    store = SessionStore(":memory:")
+    session_id = store.create("u", "起点", "终点")
+    play(store, session_id, 4, fold_at=3)
+    state = store.load(session_id, steps=2)
+    assert state["segments"] == ["第1段", "第2段"] and state["choices"] == ["选择1"]
+    assert state["question"] == "问题2" and state["summary"] == "" and state["summarized"] == 0
+
+
+def test_summary_is_restored_from_the_fold_step():
+    store = SessionStore(":memory:")
+    session_id = store.create("u", "起点", "终点")
+    play(store, session_id, 4, fold_at=3)
+    state = store.load(session_id)
+    assert state["summary"] == "前2段的梗概" and state["summarized"] == 2
+
+
+def test_resaving_an_earlier_step_drops_later_steps():
+    store = SessionStore(":memory:")
+    session_id = store.create("u", "起点", "终点")
+    play(store, session_id, 3)
+    retry = store.load(session_id, steps=2)
+    retry["segments"][-1] = "重写的第2段"
+    store.save_step(session_id, retry)
+    state = store.load(session_id)
+    assert state["segments"] == ["第1段", "重写的第2段"]
+    assert store.get(session_id)["steps"] == 2 and store.stats()["steps"] == 2
+
+
+def test_fork_copies_the_first_steps():
+    store = SessionStore(":memory:")
+    session_id = store.create("u", "起点", "终点")
+    play(store, session_id, 3)
+    fork_id = store.fork(session_id, 2, user="v")
+    info = store.get(fork_id)
+    assert info["parent_id"] == session_id and info["user"] == "v" and info["steps"] == 2
+    assert store.load(fork_id)["segments"] == ["第1段", "第2段"]
+    assert store.load(session_id)["segments"] == ["第1段", "第2段", "第3段"]
+    with pytest.raises(KeyError):
+        store.fork("missing", 1)
+
+
+def test_list_delete_and_finished():
+    store = SessionStore(":memory:")
+    first = store.create("u", "起点", "终点")
+    time.sleep(0.01)
+    second = store.create("u", "起点2", "终点2")
+    store.create("other", "起点", "终点")
+    store.mark_finished(first)
+    assert [session["id"] for session in store.list_sessions("u")] == [first, second]
+    assert store.get(first)["finished"] is True
+    store.delete(first)
+    assert store.get(first) is None and store.load(first) is None
+
+
+def test_evicts_least_recently_updated_sessions():
+    store = SessionStore(":memory:", max_sessions=2)
+    first = store.create("u", "a", "b")
+    time.sleep(0.01)
+    second = store.create("u", "a", "b")
+    time.sleep(0.01)
+    store.load(first)
+    time.sleep(0.01)
+    third = store.create("u", "a", "b")
+    assert store.get(second) is None
+    assert store.get(first) is not None and store.get(third) is not None
+
+
+def test_expired_sessions_are_hidden():
+    store = SessionStore(":memory:", ttl=0.01)
+    session_id = store.create("u", "a", "b")
+    time.sleep(0.02)
+    assert store.get(session_id) is None and store.load(session_id) is None
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import time
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import RunnableGenerator
+
+import llm
+from llm import SetupPool
+from story_graph import astream_story_opening, generate_opening
+
+OPENING = {
+    "initial_state": "起点",
+    "final_state": "终点",
+    "segment": "开篇剧情",
+    "question": "第一个问题",
+    "options": ["A", "B"],
+}
+
+
+@pytest.fixture
+def opening_chain(monkeypatch):
+    """把 story_opening_chain 换成按块产出给定 JSON 的流式链，并记录调用次数"""
+    calls = []
+
+    def use(payload):
+        text = json.dumps(payload, ensure_ascii=False)
+
+        async def stream(inputs):
+            async for _ in inputs:
+                calls.append(1)
+                for i in range(0, len(text), 8):
+                    yield text[i:i + 8]
+
+        monkeypatch.setitem(llm._components, "story_opening_chain", RunnableGenerator(stream))
+        return calls
+
+    return use
+
+
+def test_opening_is_one_call(opening_chain):
+    calls = opening_chain(OPENING)
+
+    async def collect():
+        return [item async for item in astream_story_opening()]
+
+    items = asyncio.run(collect())
+    texts = [text for text, state in items if state is None]
+    assert texts and texts[-1] == "开篇剧情" and all("开篇剧情".startswith(text) for text in texts)
+    text, state = items[-1]
+    assert text == "开篇剧情" and len(calls) == 1
+    assert (state["initial_state"], state["final_state"]) == ("起点", "终点")
+    assert state["segments"] == ["开篇剧情"] and state["choices"] == []
+    assert (state["question"], state["options"]) == ("第一个问题", ["A", "B"])
+
+
+def test_incomplete_opening_is_rejected(opening_chain):
+    opening_chain({**OPENING, "final_state": "", "options": []})
+    with pytest.raises(OutputParserException):
+        asyncio.run(generate_opening())
+
+
+def test_setup_pool_prefills_openings():
+    pool = SetupPool(size=2, generate=lambda: dict(OPENING)).start()
+    try:
+        deadline = time.time() + 5
+        while not pool._setups.full():
+            assert time.time() < deadline, "超时"
+            time.sleep(0.005)
+        assert pool.take() == OPENING and pool.hits == 1
+    finally:
+        pool.stop()
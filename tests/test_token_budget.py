@@ -0,0 +1,83 @@
+import pytest
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+import token_budget
+from metrics import get_metrics
+from token_budget import (PromptBudget, PromptTooLong, completion_tokens, context_window, count_messages,
+                          count_tokens, estimate_batch, estimate_tokens, max_output_tokens, trim_text)
+
+PROMPT = ChatPromptTemplate.from_messages([("system", "你是一位小说家。"), ("human", "梗概：{summary}\n\n选择：{choice}")])
+
+
+def test_model_limits_match_longest_prefix():
+    assert context_window("gpt-4o-mini-2024-07-18") == 128_000
+    assert max_output_tokens("gpt-4.1-nano") == 32_768
+    assert context_window("unknown") == token_budget.DEFAULT_CONTEXT_WINDOW
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("中文") == 2
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("中文abcde") == 4
+
+
+def test_count_messages_adds_per_message_overhead():
+    messages = [SystemMessage("hello"), HumanMessage("world")]
+    expected = (token_budget.TOKENS_PER_REPLY + 2 * token_budget.TOKENS_PER_MESSAGE
+                + count_tokens("hello", "gpt-4o") + count_tokens("world", "gpt-4o"))
+    assert count_messages(messages, "gpt-4o") == expected
+    assert count_messages([{"role": "user", "content": "hello"}, {"role": "user", "content": "world"}],
+                          "gpt-4o") == expected
+
+
+def test_completion_tokens_leaves_slack_and_respects_the_output_limit():
+    tokens = completion_tokens(1000, "gpt-4o-mini")
+    assert tokens > 1000 * token_budget.tokens_per_char("gpt-4o-mini")
+    assert completion_tokens(1_000_000, "gpt-3.5-turbo") == 4_096
+
+
+def test_trim_text_keeps_the_end():
+    text = "".join(f"第{i}段剧情。" for i in range(200))
+    trimmed = trim_text(text, 50, "gpt-4o")
+    assert text.endswith(trimmed) and 0 < count_tokens(trimmed, "gpt-4o") <= 50
+    assert trim_text("短", 50, "gpt-4o") == "短"
+    assert trim_text(text, 0, "gpt-4o") == ""
+
+
+def test_trim_text_without_encoding(monkeypatch):
+    monkeypatch.setattr(token_budget, "get_encoding", lambda name: None)
+    text = "很长的剧情" * 100
+    trimmed = trim_text(text, 30, "gpt-4o")
+    assert text.endswith(trimmed) and estimate_tokens(trimmed) <= 30
+
+
+def test_prompt_budget_passes_small_inputs_through():
+    payload = {"summary": "开始", "choice": "A"}
+    budget = PromptBudget(PROMPT, "gpt-4o-mini", max_tokens=100, trim=["summary"], chain_name="budget_ok")
+    assert budget.fit(payload) is payload
+    assert budget.limit == 128_000 - 100
+
+
+def test_prompt_budget_trims_then_rejects():
+    budget = PromptBudget(PROMPT, "gpt-4o-mini", max_tokens=100, max_input_tokens=200, trim=["summary"],
+                          chain_name="budget_trim")
+    summary = "".join(f"第{i}段剧情。" for i in range(300))
+    payload = budget.fit({"summary": summary, "choice": "A"})
+    assert summary.endswith(payload["summary"]) and budget.count(payload) <= 200
+    assert get_metrics().counters["budget_trim"]["trimmed"] == 1
+
+    with pytest.raises(PromptTooLong):
+        budget.fit({"summary": summary, "choice": "选择" * 500})
+    assert get_metrics().counters["budget_trim"]["rejected"] == 1
+
+
+def test_estimate_batch_takes_the_tightest_limit():
+    estimate = estimate_batch(range(100), lambda item: 1000, "gpt-4o-mini", max_tokens=200,
+                              concurrency=10, rpm=50, tpm=60_000, latency=3.0)
+    assert estimate["requests"] == 100
+    assert estimate["input_tokens"] == 100_000 and estimate["max_output_tokens"] == 20_000
+    # 并发 0.5 分钟、rpm 2 分钟、tpm 2 分钟
+    assert estimate["minutes"] == 2.0 and estimate["requests_per_minute"] == 50.0
+    assert estimate["max_cost_usd"] == round((100_000 * 0.15 + 20_000 * 0.6) / 1_000_000, 4)
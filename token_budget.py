@@ -0,0 +1,213 @@
+"""发送前的 token 预算：统计渲染后提示词的 token 数、按要求的输出长度设置 max_tokens、超长输入先裁剪或拒绝。
+
+- 计数使用 tiktoken (按模型选择编码)；编码文件无法加载 (如离线环境) 时退回按字符估算并记录一次警告
+- count_tokens 按 (文本, 编码) 缓存：每条链的 system 前缀 (角色、要求、格式说明) 对所有调用都相同，只编码一次
+- completion_tokens(chars, model): 按该模型编码下中文每字的 token 数换算“约 1000 字”这类长度要求，留出余量避免截断
+- PromptBudget: 提示词 + max_tokens 超出上下文窗口 (或路由的 max_input_tokens) 时，按顺序从头裁剪指定的输入字段
+  (保留最近的内容)，仍然超出则抛出 PromptTooLong，不发出请求
+- estimate_batch: 批处理开始前估算输入/输出 token、成本和耗时下限
+
+用法:
+    budget = PromptBudget(prompt, "gpt-3.5-turbo", max_tokens=completion_tokens(300, "gpt-3.5-turbo"), trim=["recent"])
+    payload = budget.fit(payload)
+"""
+import logging
+import math
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# 上下文窗口和单次输出上限 (token)，带日期后缀的模型名按最长前缀匹配
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16_385,
+    "gpt-4o-mini": 128_000,
+    "gpt-4o": 128_000,
+    "gpt-4.1": 1_047_576,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4.1-nano": 1_047_576,
+}
+MAX_OUTPUT_TOKENS = {
+    "gpt-3.5-turbo": 4_096,
+    "gpt-4o-mini": 16_384,
+    "gpt-4o": 16_384,
+    "gpt-4.1": 32_768,
+    "gpt-4.1-mini": 32_768,
+    "gpt-4.1-nano": 32_768,
+}
+DEFAULT_CONTEXT_WINDOW = 16_385
+DEFAULT_ENCODING = "o200k_base"
+
+# 每条消息的固定开销 (角色和分隔符) 以及回复的起始标记，见 OpenAI 的计数说明
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# 输出长度的余量：要求“约 N 字”时模型常常写得更长，截断的 JSON 无法解析，宁可多留
+OUTPUT_SLACK = 1.5
+OUTPUT_OVERHEAD = 100
+
+# 用于测量中文每字 token 数的样本
+_CJK_SAMPLE = ("他从昏迷中醒来，眼前是一片纯白的墙壁和天花板，地面却是深邃的黑色混凝土。"
+               "头脑一片混乱，试图回忆，却发现记忆像被撕裂的书页。远处传来脚步声，有人在低声说着什么。")
+_CJK = re.compile(r"[⺀-鿿가-힯豈-﫿＀-￯]")
+
+
+class PromptTooLong(ValueError):
+    pass
+
+
+def _lookup(table: Dict[str, int], model: str, default: int) -> int:
+    for name in sorted(table, key=len, reverse=True):
+        if model and model.startswith(name):
+            return table[name]
+    return default
+
+
+def context_window(model: str) -> int:
+    return _lookup(CONTEXT_WINDOWS, model, DEFAULT_CONTEXT_WINDOW)
+
+
+def max_output_tokens(model: str) -> int:
+    return _lookup(MAX_OUTPUT_TOKENS, model, 4_096)
+
+
+@lru_cache(maxsize=None)
+def encoding_name(model: str) -> str:
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        # tiktoken 尚不认识的新模型 (如 gpt-4.1) 与 gpt-4o 使用同一编码
+        return DEFAULT_ENCODING
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str):
+    """tiktoken 编码；首次使用需要下载编码文件，失败时返回 None (改为估算)"""
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning(f"无法加载 tiktoken 编码 {name}，改为按字符估算 token 数: {e!r}")
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """无编码文件时的估算：中日韩字符每字 1 个 token，其余约 4 个字符 1 个 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+@lru_cache(maxsize=4096)
+def _count(text: str, name: str) -> int:
+    encoding = get_encoding(name)
+    return len(encoding.encode(text, disallowed_special=())) if encoding else estimate_tokens(text)
+
+
+def count_tokens(text: str, model: str) -> int:
+    return _count(text, encoding_name(model))
+
+
+def count_messages(messages: Sequence[Any], model: str) -> int:
+    """聊天消息 (BaseMessage 或 {"role", "content"} 字典) 的输入 token 数"""
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        content = message["content"] if isinstance(message, dict) else message.content
+        if not isinstance(content, str):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        total += TOKENS_PER_MESSAGE + count_tokens(content, model)
+    return total
+
+
+@lru_cache(maxsize=None)
+def tokens_per_char(model: str) -> float:
+    """该模型编码下中文每字的 token 数 (cl100k 约 1.2，o200k 约 0.8)"""
+    return count_tokens(_CJK_SAMPLE, model) / len(_CJK_SAMPLE)
+
+
+def completion_tokens(chars: int, model: str, slack: float = OUTPUT_SLACK, overhead: int = OUTPUT_OVERHEAD) -> int:
+    """要求输出约 chars 字时的 max_tokens，不超过模型的单次输出上限"""
+    return min(max_output_tokens(model), math.ceil(chars * tokens_per_char(model) * slack) + overhead)
+
+
+def trim_text(text: str, max_tokens: int, model: str) -> str:
+    """从头裁剪到不超过 max_tokens 个 token，保留末尾 (最近) 的内容"""
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(encoding_name(model))
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[-max_tokens:])
+    # 每个字符至多 1 个 token：每次至少丢掉超出的 token 数那么多个字符
+    while estimate_tokens(text) > max_tokens:
+        text = text[estimate_tokens(text) - max_tokens:]
+    return text
+
+
+class PromptBudget:
+    """单条链在单个模型上的输入预算：上下文窗口减去 max_tokens，再与 max_input_tokens 取小"""
+
+    def __init__(self, prompt, model: str, max_tokens: Optional[int] = None, max_input_tokens: Optional[int] = None,
+                 trim: Sequence[str] = (), chain_name: Optional[str] = None):
+        self.prompt = prompt
+        self.model = model
+        self.max_tokens = max_tokens or max_output_tokens(model)
+        self.limit = context_window(model) - self.max_tokens
+        if max_input_tokens:
+            self.limit = min(self.limit, max_input_tokens)
+        self.trim = list(trim)
+        self.chain_name = chain_name or "unknown"
+
+    def count(self, payload: dict) -> int:
+        # 按“格式说明 + 解析器”路径渲染：原生结构化输出的 schema 比格式说明短，这里得到的是上限
+        return count_messages(self.prompt.format_messages(**payload), self.model)
+
+    def fit(self, payload: dict) -> dict:
+        """原样返回或返回裁剪后的输入；无法放进预算时抛出 PromptTooLong"""
+        from metrics import get_metrics
+
+        tokens = self.count(payload)
+        if tokens <= self.limit:
+            return payload
+        original = tokens
+        payload = dict(payload)
+        for key in self.trim:
+            text = str(payload.get(key) or "")
+            payload[key] = trim_text(text, count_tokens(text, self.model) - (tokens - self.limit), self.model)
+            tokens = self.count(payload)
+            if tokens <= self.limit:
+                get_metrics().count(self.chain_name, "trimmed")
+                logger.warning(f"{self.chain_name} 的输入 {original} token 超出预算 {self.limit}，已裁剪到 {tokens}")
+                return payload
+        get_metrics().count(self.chain_name, "rejected")
+        raise PromptTooLong(f"{self.chain_name} 的输入 {tokens} token 超出预算 {self.limit} (模型 {self.model}，"
+                            f"max_tokens={self.max_tokens})")
+
+
+def estimate_batch(items: Iterable, prompt_tokens: Callable[[Any], int], model: str, max_tokens: int,
+                   concurrency: int = 1, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                   latency: float = 3.0) -> dict:
+    """批处理开始前的估算：输出 token 按 max_tokens 计 (上限)，耗时取并发、rpm、tpm 三者中最紧的约束"""
+    from metrics import estimate_cost
+
+    counts: List[int] = [prompt_tokens(item) for item in items]
+    requests = len(counts)
+    input_tokens = sum(counts)
+    output_tokens = requests * max_tokens
+    minutes = [requests * latency / max(concurrency, 1) / 60]
+    if rpm:
+        minutes.append(requests / rpm)
+    if tpm:
+        # 限流按输入 + max_tokens 计算占用的额度
+        minutes.append((input_tokens + output_tokens) / tpm)
+    return {
+        "requests": requests,
+        "input_tokens": input_tokens,
+        "max_output_tokens": output_tokens,
+        "max_cost_usd": round(estimate_cost(model, input_tokens, output_tokens), 4),
+        "minutes": round(max(minutes), 2),
+        "requests_per_minute": round(requests / max(minutes), 1) if requests and max(minutes) else None,
+    }